@@ -0,0 +1,6 @@
+#!/bin/bash
+# Allow streaming replication connections to the primary database.
+# Mounted in /docker-entrypoint-initdb.d/ by docker/docker-compose.replica.yaml.
+set -e
+
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
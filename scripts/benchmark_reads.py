@@ -0,0 +1,164 @@
+"""Compare time and memory of ORM objects and column-projected reads on the hot paths.
+
+For each path, the `orm` variant loads ORM instances and converts them, as the code did
+before, while the `rows` variant uses the column-projected functions of `crud`. The
+database is read from the DATABASE_URL environment variable; the results are read for
+the most recent inference with results.
+"""
+
+from mlprod.database import DataBase, crud
+from mlprod.database.crud import RESULT_LOCATION_FIELDS
+from mlprod.database.tables import Inference, Location, Result, User
+from mlprod.logs import setup_logs
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy.orm import Session
+from time import perf_counter
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+import tracemalloc
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the reads benchmark."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """Number of repetitions of each read."""
+    n: int = 20
+    """Features used to build the input of a model."""
+    features: list[str] = [
+        "people_num",
+        "children_num",
+        "age_avg",
+        "budget",
+        "nights",
+        "price",
+        "has_pool",
+        "family_rating",
+        "user_score",
+    ]
+
+
+def orm_dicts(objects: list) -> list[dict]:
+    """ORM instances converted to dictionaries, as done when they are serialized."""
+    return [
+        {k: v for k, v in vars(o).items() if not k.startswith("_sa")} for o in objects
+    ]
+
+
+def orm_results_locations(db: Session, task_id: str, limit: int = 10) -> list[dict]:
+    """Best scored results joined with their locations, from ORM instances."""
+    db_results = (
+        db.query(Result)
+        .join(Inference, Result.inference_id == Inference.inference_id)
+        .join(Location, Result.location_id == Location.location_id)
+        .filter(Inference.task_id == task_id)
+        .order_by(Result.score.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {"score": r.score} | {f: getattr(r.location, f) for f in RESULT_LOCATION_FIELDS}
+        for r in db_results
+    ]
+
+
+def orm_prepare_data(db: Session, user_id: int, features: list[str]) -> pd.DataFrame:
+    """Input of a model built from ORM instances."""
+    user = db.query(User).filter(User.user_id == user_id).one()
+    locs = db.query(Location).all()
+    return pd.DataFrame(
+        [user.__dict__ | loc.__dict__ for loc in locs], columns=features
+    )
+
+
+def rows_prepare_data(db: Session, user_id: int, features: list[str]) -> pd.DataFrame:
+    """Input of a model built from column-projected reads, as the inference task does."""
+    user = crud.read_user(db, user_id, features)
+    locs = crud.read_locations(db, features)
+    df = locs.assign(**{k: v for k, v in user.items() if k not in locs.columns})
+    return df.reindex(columns=features)
+
+
+def measure(fn: Callable[[Session], Any], n: int) -> tuple[float, float]:
+    """Returns the median time in milliseconds and the peak memory in MB of a read.
+
+    Each read uses a new session, so no instance is reused from the identity map.
+    """
+    times, peak = [], 0
+
+    for _ in range(n):
+        with DataBase().session() as session:
+            tracemalloc.start()
+            start = perf_counter()
+
+            fn(session)
+
+            times.append((perf_counter() - start) * 1000)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    return float(np.median(times)), peak / 2**20
+
+
+if __name__ == "__main__":
+    setup_logs()
+
+    c = Config()
+
+    with DataBase().session() as session:
+        row = (
+            session.query(Inference.task_id, Inference.user_id)
+            .join(Result, Result.inference_id == Inference.inference_id)
+            .order_by(Inference.time_creation.desc())
+            .first()
+        )
+
+    if row is None:
+        raise ValueError("No inference with results found in the database")
+
+    task_id, user_id = row
+
+    paths: list[tuple[str, Callable[[Session], Any], Callable[[Session], Any]]] = [
+        (
+            "locations",
+            lambda s: orm_dicts(s.query(Location).all()),
+            lambda s: crud.get_locations_rows(s),
+        ),
+        (
+            "users",
+            lambda s: orm_dicts(s.query(User).all()),
+            lambda s: crud.get_users_rows(s),
+        ),
+        (
+            "results",
+            lambda s: orm_dicts(crud.get_results(s, task_id)),
+            lambda s: crud.get_results_rows(s, task_id),
+        ),
+        (
+            "results_locations",
+            lambda s: orm_results_locations(s, task_id),
+            lambda s: crud.get_results_locations(s, task_id),
+        ),
+        (
+            "prepare_data",
+            lambda s: orm_prepare_data(s, user_id, c.features),
+            lambda s: rows_prepare_data(s, user_id, c.features),
+        ),
+    ]
+
+    print(f"{'path':18} {'orm ms':>8} {'rows ms':>8} {'orm MB':>8} {'rows MB':>8}")
+
+    for name, orm, rows in paths:
+        t_orm, m_orm = measure(orm, c.n)
+        t_rows, m_rows = measure(rows, c.n)
+
+        print(f"{name:18} {t_orm:8.2f} {t_rows:8.2f} {m_orm:8.2f} {m_rows:8.2f}")
@@ -0,0 +1,113 @@
+"""Compare the database work done to schedule an inference, per request.
+
+The `separate` mode stores the user, the inference and the event with one commit each,
+as /inference/start used to do. The `single` mode stores the user and the inference in a
+single transaction, as /inference/start does now. The database is read from the
+DATABASE_URL environment variable; the created rows are deleted at the end.
+"""
+
+from mlprod.data import read_user_config, generate_user_data
+from mlprod.database import DataBase, crud
+from mlprod.database.tables import Event, Inference, User
+from mlprod.logs import setup_logs
+
+from pathlib import Path
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+from time import perf_counter
+from typing import Callable
+from uuid import uuid4
+
+import numpy as np
+
+# event stored by the benchmark, so the events of the application are not deleted
+EVENT = "benchmark_scheduling"
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the scheduling benchmark."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """Number of requests for each mode."""
+    n: int = 1000
+    """User config file to use."""
+    config: Path = Path("./configs/user.tsv")
+    seed: int = 42
+
+
+def schedule_separate(db: Session, user_data: dict) -> str:
+    """Store the user, the inference, and the event with a commit each."""
+    task_id = str(uuid4())
+
+    user = crud.create_user_data(db, user_data)
+    crud.create_inference(db, task_id, "PENDING", user.user_id)
+    crud.create_event(db, EVENT)
+
+    return task_id
+
+
+def schedule_single(db: Session, user_data: dict) -> str:
+    """Store the user and the inference in a single transaction."""
+    task_id = str(uuid4())
+
+    crud.create_inference_request(db, task_id, user_data, "PENDING")
+
+    return task_id
+
+
+def run(
+    db: Session, users: list[dict], schedule: Callable[[Session, dict], str]
+) -> tuple[np.ndarray, list[str]]:
+    """Returns the latency of each request in milliseconds and the created task ids."""
+    latencies, task_ids = [], []
+
+    for user_data in users:
+        start = perf_counter()
+        task_ids.append(schedule(db, user_data))
+        latencies.append((perf_counter() - start) * 1000)
+
+    return np.array(latencies), task_ids
+
+
+def cleanup(db: Session, task_ids: list[str]) -> None:
+    """Delete the users, inferences, and events created by the benchmark."""
+    user_ids = db.query(Inference.user_id).where(Inference.task_id.in_(task_ids)).all()
+    db.execute(delete(Inference).where(Inference.task_id.in_(task_ids)))
+    db.execute(delete(User).where(User.user_id.in_([u for (u,) in user_ids])))
+    db.execute(delete(Event).where(Event.event == EVENT))
+    db.commit()
+
+
+if __name__ == "__main__":
+    setup_logs()
+
+    c = Config()
+
+    r = np.random.default_rng(c.seed)
+    configs = read_user_config(c.config)
+    start_date = np.datetime64("2024-01-01")
+
+    users = []
+    for _ in range(c.n):
+        data = generate_user_data(r, r.choice(configs), start_date).model_dump()  # type: ignore
+        users.append(data)
+
+    print(f"{'mode':10} {'requests':>8} {'p50 ms':>8} {'p99 ms':>8}")
+
+    with DataBase().session() as session:
+        for mode, schedule in [
+            ("separate", schedule_separate),
+            ("single", schedule_single),
+        ]:
+            latencies, task_ids = run(session, users, schedule)
+            cleanup(session, task_ids)
+
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(f"{mode:10} {c.n:8} {p50:8.2f} {p99:8.2f}")
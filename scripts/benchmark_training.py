@@ -0,0 +1,105 @@
+from mlprod.worker.models import train_model, train_model_distributed
+from mlprod.worker.models.parallel import available_cores
+from pathlib import Path
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the training benchmark."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """Dataset in TSV format with a label column, if not set random data are used."""
+    dataset: Path | None = None
+    """Number of random records to generate."""
+    n_records: int = 100_000
+    """Number of random features to generate."""
+    n_features: int = 26
+    """Maximum number of processes to test, 0 means one for each core."""
+    max_world_size: int = 0
+    epochs: int = 5
+    batch_size: int = 64
+    seed: int = 42
+
+
+def random_dataset(n_records: int, n_features: int, seed: int) -> pd.DataFrame:
+    """Generate a random dataset with a label that depends on the features."""
+    r = np.random.default_rng(seed)
+
+    X = r.random((n_records, n_features))
+    w = r.normal(size=n_features)
+    y = (X @ w + r.normal(scale=0.5, size=n_records)) > (w.sum() / 2)
+
+    df = pd.DataFrame(X, columns=[f"f{i}" for i in range(n_features)])
+    df["label"] = y.astype("int")
+    return df
+
+
+if __name__ == "__main__":
+    c = Config()
+
+    print("Input parameters:\n", c.model_dump_json(indent=4))
+
+    if c.dataset is not None:
+        df = pd.read_csv(c.dataset, sep="\t")
+    else:
+        df = random_dataset(c.n_records, c.n_features, c.seed)
+
+    max_world_size = c.max_world_size or available_cores()
+    k_best = min(20, df.shape[1] - 1)
+
+    print(f"Dataset of shape {df.shape}, testing 1 to {max_world_size} processes")
+
+    rows = []
+    for world_size in range(1, max_world_size + 1):
+        with TemporaryDirectory() as tmp:
+            begin = perf_counter()
+
+            if world_size == 1:
+                metrics = train_model(
+                    df,
+                    path=Path(tmp),
+                    k_best=k_best,
+                    epochs=c.epochs,
+                    batch_size=c.batch_size,
+                    random_state=c.seed,
+                    metrics_list=["auc"],
+                )
+            else:
+                metrics = train_model_distributed(
+                    df,
+                    path=Path(tmp),
+                    world_size=world_size,
+                    k_best=k_best,
+                    epochs=c.epochs,
+                    batch_size=c.batch_size,
+                    random_state=c.seed,
+                    metrics_list=["auc"],
+                )
+
+            elapsed = perf_counter() - begin
+
+        rows.append(
+            {
+                "processes": world_size,
+                "time": elapsed,
+                "speedup": rows[0]["time"] / elapsed if rows else 1.0,
+                "auc": metrics["auc"],
+            }
+        )
+        print(
+            f"processes={world_size:3d} time={elapsed:8.2f}s "
+            f"speedup={rows[-1]['speedup']:5.2f} auc={metrics['auc']:.4f}"
+        )
+
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,107 @@
+"""Check with EXPLAIN that the hot queries on the results table use their indexes.
+
+The lookup of an inference by task id, needed to find its results, is also checked.
+
+The database is read from the DATABASE_URL environment variable. Pending migrations are
+applied before the check. On PostgreSQL sequential scans are disabled for the check, so
+the result does not depend on the size of the tables.
+"""
+
+from mlprod.database import DataBase
+from mlprod.database.migrations import run_migrations
+from mlprod.database.tables import Inference, Result
+from mlprod.logs import setup_logs
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import Select, select, text
+from sqlalchemy.orm import Session
+
+import sys
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the index check."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """Task id used in the queries."""
+    task_id: str = "check"
+    """Inference id used in the queries."""
+    inference_id: int = 0
+    """Location id used in the queries."""
+    location_id: int = 0
+
+
+def hot_queries(c: Config) -> list[tuple[str, Select]]:
+    """Queries on the results table, with the index each one is expected to use."""
+    return [
+        (
+            "ix_inferences_task_id",
+            select(Inference).where(Inference.task_id == c.task_id),
+        ),
+        (
+            "ix_results_inference_id_location_id",
+            select(Result)
+            .where(Result.inference_id == c.inference_id)
+            .where(Result.location_id == c.location_id),
+        ),
+        (
+            "ix_results_inference_id_score",
+            select(Result)
+            .where(Result.inference_id == c.inference_id)
+            .order_by(Result.score.desc())
+            .limit(10),
+        ),
+        (
+            "ix_results_shown_result_id",
+            select(Result)
+            .where(Result.shown)
+            .order_by(Result.result_id.desc())
+            .limit(1000),
+        ),
+    ]
+
+
+def explain(session: Session, query: Select) -> str:
+    """Returns the plan of a query as text."""
+    bind = session.get_bind()
+    sql = str(query.compile(bind, compile_kwargs={"literal_binds": True}))
+
+    if bind.dialect.name == "postgresql":
+        rows = session.execute(text(f"EXPLAIN {sql}")).all()
+    else:
+        rows = session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+
+    return "\n".join(str(r[-1]) for r in rows)
+
+
+if __name__ == "__main__":
+    setup_logs()
+
+    c = Config()
+
+    failed = 0
+
+    with DataBase().session() as session:
+        run_migrations(session)
+
+        if session.get_bind().dialect.name == "postgresql":
+            session.execute(text("SET enable_seqscan = off"))
+
+        for index, query in hot_queries(c):
+            plan = explain(session, query)
+
+            if index in plan:
+                print(f"OK      {index}")
+            else:
+                print(f"MISSING {index}\n{plan}\n")
+                failed += 1
+
+        session.rollback()
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,107 @@
+"""Measure the size of the tables that refer to inferences and models, and of their indexes.
+
+The database is read from the DATABASE_URL environment variable and must be PostgreSQL.
+With --migrate, the pending migrations are applied and the tables are measured again:
+run it on a copy of a database with the old schema to see the reduction given by the
+integer ids. Use --vacuum to rewrite the tables after the migration, so the space of
+the dropped task ids is reclaimed.
+"""
+
+from mlprod.database import DataBase
+from mlprod.database.migrations import run_migrations
+from mlprod.logs import setup_logs
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import Connection, text
+
+TABLES = ["results", "datasets", "inferences"]
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the size measurement."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """Apply the pending migrations and measure again."""
+    migrate: bool = False
+    """Rewrite the tables with VACUUM FULL after the migrations."""
+    vacuum: bool = False
+
+
+def measure(conn: Connection, table: str) -> tuple[int, int, int]:
+    """Returns the number of rows, the size of the data, and the size of the indexes.
+
+    Sizes are in bytes and include all the partitions of the table.
+    """
+    rows = conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+    data, indexes = conn.execute(
+        text(
+            "SELECT COALESCE(sum(pg_table_size(relid)), 0), "
+            "COALESCE(sum(pg_indexes_size(relid)), 0) "
+            "FROM pg_partition_tree(CAST(:table AS regclass))"
+        ),
+        {"table": table},
+    ).one()
+
+    return rows or 0, int(data), int(indexes)
+
+
+def report(conn: Connection) -> dict[str, tuple[int, int, int]]:
+    """Print and return the measures of all the tables."""
+    sizes = {table: measure(conn, table) for table in TABLES}
+
+    print(f"{'table':12} {'rows':>12} {'data MB':>10} {'index MB':>10} {'B/row':>8}")
+    for table, (rows, data, indexes) in sizes.items():
+        per_row = (data + indexes) / rows if rows else 0
+        print(
+            f"{table:12} {rows:12} {data / 2**20:10.2f} {indexes / 2**20:10.2f} "
+            f"{per_row:8.1f}"
+        )
+
+    return sizes
+
+
+if __name__ == "__main__":
+    setup_logs()
+
+    c = Config()
+
+    engine = DataBase().engine
+
+    if engine.dialect.name != "postgresql":
+        raise ValueError("Table sizes can be measured only on PostgreSQL")
+
+    with engine.connect() as conn:
+        before = report(conn)
+
+    if c.migrate:
+        with DataBase().session() as session:
+            run_migrations(session)
+
+        if c.vacuum:
+            with engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT"
+            ) as conn:
+                for table in TABLES:
+                    conn.execute(text(f"VACUUM FULL {table}"))
+
+        print()
+
+        with engine.connect() as conn:
+            after = report(conn)
+
+        print()
+        print(f"{'table':12} {'data %':>10} {'index %':>10}")
+        for table in TABLES:
+            _, data_0, indexes_0 = before[table]
+            _, data_1, indexes_1 = after[table]
+            print(
+                f"{table:12} {100 * (data_1 - data_0) / max(data_0, 1):+10.1f} "
+                f"{100 * (indexes_1 - indexes_0) / max(indexes_0, 1):+10.1f}"
+            )
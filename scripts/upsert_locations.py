@@ -0,0 +1,56 @@
+"""Insert or update locations in bulk from a CSV or NDJSON file.
+
+Each record must have a location_id: existing locations are updated, the others are
+inserted. The file is streamed to the database in a single transaction, the version of
+the catalog is increased and the changed ids are logged, so the workers update their
+cached copies of the catalog with only the changed locations. The database is read from
+the DATABASE_URL environment variable.
+"""
+
+from mlprod.database import DataBase
+from mlprod.database.catalog import FORMATS, upsert_locations_stream
+from mlprod.database.locks import advisory_lock, LOCK_CONTENT
+from mlprod.logs import setup_logs
+
+from pathlib import Path
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Config(BaseSettings):
+    """Configure the parameters of the bulk update."""
+
+    model_config = SettingsConfigDict(
+        cli_parse_args=True,
+        cli_ignore_unknown_args=True,
+        cli_implicit_flags=True,
+        extra="forbid",
+    )
+
+    """File with the locations to insert or update."""
+    path: Path
+    """Format of the file, from its extension if not set."""
+    format: str | None = None
+
+
+if __name__ == "__main__":
+    setup_logs()
+
+    c = Config()
+
+    fmt = c.format or c.path.suffix.lstrip(".").lower()
+    if fmt == "jsonl":
+        fmt = "ndjson"
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, must be one of {FORMATS}")
+
+    with (
+        DataBase().session() as session,
+        advisory_lock(session, LOCK_CONTENT, wait=True),
+        open(c.path, "rb") as f,
+    ):
+        inserted, updated, version = upsert_locations_stream(session, f, fmt)
+
+    print(
+        f"{inserted} locations inserted, {updated} updated, catalog version {version}"
+    )
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
-from datetime import date
+from pydantic import BaseModel, model_validator
+from typing import Any, Self
+from datetime import date, datetime
 
 
 class TaskStatus(BaseModel):
@@ -58,8 +59,94 @@ class LabelData(BaseModel):
     location_id: int
 
 
+class LabelStatus(BaseModel):
+    """Class that defines the outcome of a label."""
+
+    task_id: str
+    location_id: int
+    updated: bool
+
+
 class ContentInfo(BaseModel):
-    """Class for return all users and locations."""
+    """Class for return all users and locations, and the activity of the last day."""
 
     locations: int
     users: int
+    stats: str = "exact"  # how the rows have been counted
+    inferences: int = 0
+    results: int = 0  # requests of the results of an inference
+    labels: int = 0
+    label_rate: float = 0.0  # labels per inference
+    good_rate: float = 0.0  # labels with a selected location per label
+
+
+class CatalogUpdate(BaseModel):
+    """Class that defines the outcome of a bulk update of the catalog."""
+
+    inserted: int
+    updated: int
+    version: int
+
+
+class EventCount(BaseModel):
+    """Class that defines the number of events of a type in a time bucket."""
+
+    time_bucket: datetime
+    event: str
+    count: int
+
+
+# parameters of `train_model` that can be changed by a sweep
+GRID_PARAMS = ("k_best", "epochs", "batch_size", "frac1", "random_state")
+
+
+class TrainingParams(BaseModel):
+    """Class that defines the optional parameters of a training task."""
+
+    sweep: bool = False
+    grid: dict[str, list[Any]] | None = None
+    world_size: int = 1
+    streaming: bool = False
+    distill: bool = False
+    student_hidden: int = 8
+
+    @model_validator(mode="after")
+    def check_modes(self) -> Self:
+        """Checks that the training modes can be used together, and the sweep grid."""
+        if self.world_size < 1:
+            raise ValueError("World size must be at least 1")
+
+        if sum([self.sweep, self.world_size > 1, self.streaming]) > 1:
+            raise ValueError(
+                "Sweep, data-parallel, and streaming training cannot be used together"
+            )
+
+        if self.grid is not None:
+            unknown = set(self.grid) - set(GRID_PARAMS)
+            if unknown:
+                raise ValueError(
+                    f"Unknown grid parameters {sorted(unknown)}, "
+                    f"must be among {list(GRID_PARAMS)}"
+                )
+
+            empty = [k for k, values in self.grid.items() if not values]
+            if empty:
+                raise ValueError(f"Grid parameters without values: {empty}")
+
+        if self.student_hidden < 0:
+            raise ValueError("Hidden units of the student cannot be negative")
+
+        return self
+
+
+class ShadowReport(BaseModel):
+    """Class that defines the comparison between the active and a candidate model."""
+
+    model_id: str
+    inferences: int
+    top_k_overlap: float
+    rank_correlation: float
+    score_mae: float
+    labelled: int
+    metrics_active: dict[str, float]
+    metrics_shadow: dict[str, float]
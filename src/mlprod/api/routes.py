@@ -1,22 +1,72 @@
 from contextlib import asynccontextmanager
 from celery.result import AsyncResult
-from fastapi import FastAPI, HTTPException, Depends
+from datetime import datetime, timedelta
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from mlprod.api.middleware.metrics import PrometheusMiddleware, metrics_route
 from mlprod.api import requests
-from mlprod.database import crud, init_content, get_session, DataBase
+from mlprod.database import (
+    cache,
+    catalog,
+    crud,
+    events,
+    stats,
+    init_content,
+    get_session,
+    get_read_session,
+    DataBase,
+)
+from mlprod.database.locks import advisory_lock, LOCK_CONTENT
 from mlprod.logs import setup_logs
 from mlprod.worker.tasks.inference import inference
 from mlprod.worker.tasks.train import training
+from mlprod.worker.models import evaluate
 from mlprod import __version__
 
+from tempfile import SpooledTemporaryFile
+from typing import IO, Callable, TypeVar
+from uuid import uuid4
+
 import logging
 
 setup_logs()
 
 LOGGER = logging.getLogger("mlprod")
 
+T = TypeVar("T")
+
+# content types accepted by the bulk updates of the catalog
+CATALOG_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+}
+
+
+def read_after_write(db_read: Session, read: Callable[[Session], T]) -> T:
+    """Read from the given session, or from the primary if data are missing.
+
+    Data just written to the primary (i.e. the results of an inference) can still be
+    missing on the read replica: when the read finds nothing, it is repeated on the
+    primary.
+    """
+    inst = DataBase()
+
+    try:
+        data = read(db_read)
+        if data or not inst.is_replica(db_read):
+            return data
+    except ValueError:
+        if not inst.is_replica(db_read):
+            raise
+
+    LOGGER.debug("data not found on read replica, reading from primary")
+
+    with inst.session() as session:
+        return read(session)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -51,8 +101,14 @@ async def shutdown() -> None:
     """Dispose the database engine on shutdown."""
     LOGGER.info("server shutdown procedure started")
     inst = DataBase()
+
+    with inst.session() as session:
+        events.flush_events(session)
+
     if inst.engine:
         inst.engine.dispose()
+    if inst.read_engine:
+        inst.read_engine.dispose()
 
 
 @api.get("/")
@@ -65,31 +121,37 @@ def root():
 async def schedule_inference(
     user_data: requests.UserData, db: Session = Depends(get_session)
 ):
-    """This is the endpoint used for schedule an inference."""
+    """This is the endpoint used for schedule an inference.
+
+    The user and the inference are stored in a single transaction, then the task is
+    sent to the workers.
+    """
     LOGGER.debug(f"Scheduling inference for user data: {user_data}")
 
-    crud.create_event(db, "inference_start")
-    ud = crud.create_user_data(db, user_data.model_dump())
-    task: AsyncResult = inference.delay(ud.user_id)
+    task_id = str(uuid4())
+    status = "PENDING"
 
-    if task.task_id is None:
-        LOGGER.error("Invalid task id returned from inference task")
-        raise HTTPException(500, "Invalid task id")
+    user_id = crud.create_inference_request(db, task_id, user_data.model_dump(), status)
 
-    db_inf = crud.create_inference(db, task.task_id, task.status, ud.user_id)
-    status = requests.TaskStatus(
-        task_id=db_inf.task_id, status=db_inf.status, type="inference"
-    )
+    # the task is sent only after the commit, so the worker always finds the user
+    try:
+        inference.apply_async(args=(user_id,), task_id=task_id)
+    except Exception as e:
+        LOGGER.error(f"Inference task {task_id} could not be scheduled: {e}")
+        crud.update_inference(db, task_id, "FAILED")
+        raise HTTPException(500, "Inference could not be scheduled")
+
+    events.record_event(db, "inference_start")
 
-    LOGGER.debug(f"Inference scheduled with status: {status}")
+    LOGGER.debug(f"Inference {task_id} scheduled with status: {status}")
 
-    return status
+    return requests.TaskStatus(task_id=task_id, status=status, type="inference")
 
 
 @api.get("/inference/status/{task_id}", response_model=requests.TaskStatus)
 async def get_inference_status(task_id: str, db: Session = Depends(get_session)):
     """This is the endpoint to get the results of an inference."""
-    crud.create_event(db, "status")
+    events.record_event(db, "status")
 
     task = AsyncResult(task_id)
 
@@ -122,19 +184,20 @@ async def get_inference_status(task_id: str, db: Session = Depends(get_session))
 
 @api.get("/inference/results/{task_id}")
 async def get_inference_results(
-    task_id: str, limit: int = 10, db: Session = Depends(get_session)
+    task_id: str,
+    limit: int = 10,
+    db: Session = Depends(get_session),
 ):
     """This is the endpoint to get the results with scores after the inference.
 
+    The returned results are marked as shown in the same statement, so this endpoint
+    always reads from the primary database.
+
     Note: check the status of the task with the '/inference/status' endpoint.
     """
-    crud.create_event(db, "results")
-
-    locations = crud.get_results_locations(db, task_id, limit)
+    events.record_event(db, "results")
 
-    crud.mark_locations_as_shown(db, task_id, locations)
-
-    return locations
+    return crud.show_results_locations(db, task_id, limit)
 
 
 @api.put("/inference/select/")
@@ -143,14 +206,14 @@ async def get_click(label: requests.LabelData, db: Session = Depends(get_session
 
     A click will be registered as a label on the data.
     """
-    crud.create_event(db, "selection")
+    events.record_event(db, "selection")
 
     if label.location_id == -1:
-        crud.create_event(db, "bad_inference")
+        events.record_event(db, "bad_inference")
         return
 
     else:
-        crud.create_event(db, "good_inference")
+        events.record_event(db, "good_inference")
         db_result = crud.update_result_label(db, label.task_id, label.location_id)
 
         if db_result is None:
@@ -165,62 +228,246 @@ async def get_click(label: requests.LabelData, db: Session = Depends(get_session
         return db_result
 
 
+@api.put("/inference/select/batch", response_model=list[requests.LabelStatus])
+async def get_clicks(
+    labels: list[requests.LabelData], db: Session = Depends(get_session)
+) -> list[requests.LabelStatus]:
+    """This is the endpoint used to register many clicks at once.
+
+    All the labels are assigned with a single update. Clicks with location_id equal
+    to -1 are counted as bad inferences and never updated.
+    """
+    good = [
+        (label.task_id, label.location_id)
+        for label in labels
+        if label.location_id != -1
+    ]
+
+    events.record_event(db, "selection", len(labels))
+    if len(good) < len(labels):
+        events.record_event(db, "bad_inference", len(labels) - len(good))
+    if good:
+        events.record_event(db, "good_inference", len(good))
+
+    updated = crud.update_result_labels(db, good)
+
+    return [
+        requests.LabelStatus(
+            task_id=label.task_id,
+            location_id=label.location_id,
+            updated=(label.task_id, label.location_id) in updated,
+        )
+        for label in labels
+    ]
+
+
 @api.post("/train/start")
-async def schedule_training(db: Session = Depends(get_session)):
-    """This is the endpoint to start the training of a new model."""
-    crud.create_event(db, "training")
+async def schedule_training(
+    params: requests.TrainingParams | None = None,
+    db: Session = Depends(get_session),
+):
+    """This is the endpoint to start the training of a new model.
+
+    Optional parameters can enable a parallel sweep over multiple configurations.
+    """
+    events.record_event(db, "training")
+
+    params = params or requests.TrainingParams()
+
+    # the model is stored before the task is sent, so the worker always finds it
+    db_model = crud.create_model(db, str(uuid4()), "PENDING")
+
+    try:
+        training.apply_async(kwargs=params.model_dump(), task_id=db_model.task_id)
+    except Exception as e:
+        LOGGER.error(f"Training task {db_model.task_id} could not be scheduled: {e}")
+        crud.update_model(db, db_model.task_id, "FAILED")
+        raise HTTPException(500, "Training could not be scheduled")
+
+    return requests.TaskStatus(
+        task_id=db_model.task_id, status=db_model.status, type="training"
+    )
+
+
+@api.get("/train/shadow/{task_id}", response_model=requests.ShadowReport)
+async def get_shadow_report(
+    task_id: str, db: Session = Depends(get_session)
+) -> requests.ShadowReport:
+    """This is the endpoint to compare a candidate model with the active one.
 
-    task: AsyncResult = training.delay()
+    The comparison uses the inferences scored in shadow mode by the candidate model.
+    """
+    agreement = crud.get_shadow_agreement(db, task_id)
+
+    if agreement["inferences"] == 0:
+        raise HTTPException(404, "No shadow inferences found for this model")
+
+    df = crud.get_shadow_scores(db, task_id)
+
+    metrics_list = ["acc", "pre", "rec", "f1"]
+    if df["label"].nunique() > 1:
+        metrics_list.append("auc")
+
+    metrics_active, metrics_shadow = dict(), dict()
+    if df.shape[0] > 0:
+        metrics_active = evaluate(df["label"], df["score"], metrics_list)
+        metrics_shadow = evaluate(df["label"], df["score_shadow"], metrics_list)
+
+    return requests.ShadowReport(
+        model_id=task_id,
+        labelled=df.shape[0],
+        metrics_active=metrics_active,
+        metrics_shadow=metrics_shadow,
+        **agreement,
+    )
+
+
+@api.post("/train/promote/{task_id}")
+async def promote_model(
+    task_id: str, db: Session = Depends(get_session)
+) -> requests.TaskStatus:
+    """This is the endpoint to make a trained model the active one."""
+    events.record_event(db, "promote")
+
+    try:
+        db_model = crud.set_active_model(db, task_id)
+    except ValueError:
+        raise HTTPException(404, "Model not found or not trained")
 
-    db_model = crud.create_model(db, task.task_id or "", task.status)
     return requests.TaskStatus(
         task_id=db_model.task_id, status=db_model.status, type="training"
     )
 
 
 @api.get("/content/info")
-async def get_content_info(db: Session = Depends(get_session)):
-    """This is the endpoint to get some information about the content in the database."""
-    n_locations = crud.count_locations(db)
-    n_users = crud.count_users(db)
-
-    return requests.ContentInfo(
-        locations=n_locations,
-        users=n_users,
+async def get_content_info(db: Session = Depends(get_read_session)):
+    """This is the endpoint to get some information about the content in the database.
+
+    The number of rows is read as configured by CONTENT_STATS, see `stats`.
+    """
+    return requests.ContentInfo(**stats.content_info(db))
+
+
+@api.get("/content/events", response_model=list[requests.EventCount])
+async def get_content_events(
+    since: datetime,
+    until: datetime | None = None,
+    event: list[str] | None = Query(None),
+    bucket: int = 1,
+    db: Session = Depends(get_session),
+    db_read: Session = Depends(get_read_session),
+) -> list[dict]:
+    """This is the endpoint to get the number of events in a time interval.
+
+    Counts are grouped in buckets with the given width in minutes.
+    """
+    if bucket < 1:
+        raise HTTPException(400, "Bucket width must be at least one minute")
+
+    events.flush_events(db)
+
+    return crud.get_event_counts(
+        db_read, since, until, event, timedelta(minutes=bucket)
     )
 
 
 @api.get("/content/location/{location_id}")
-async def get_content_location(location_id: int, db: Session = Depends(get_session)):
+async def get_content_location(
+    location_id: int, db: Session = Depends(get_read_session)
+):
     """This is the endpoint to get a location by its ID."""
-    return crud.get_location(db, location_id)
+    return cache.get_location_row(db, location_id)
 
 
 @api.get("/content/locations")
-async def get_content_locations(db: Session = Depends(get_session)):
+async def get_content_locations(db: Session = Depends(get_read_session)):
     """This is the endpoint to get all the locations."""
-    return crud.get_locations(db)
+    return cache.get_locations_rows(db)
+
+
+def upsert_locations(
+    db: Session, stream: IO[bytes], fmt: str
+) -> tuple[int, int, int] | None:
+    """Merge the locations in the catalog, if no other process is changing it.
+
+    :return:
+        The result of `catalog.upsert_locations_stream`, or None if the catalog is
+        locked by another process.
+    """
+    with advisory_lock(db, LOCK_CONTENT) as acquired:
+        if not acquired:
+            return None
+
+        return catalog.upsert_locations_stream(db, stream, fmt)
+
+
+@api.put("/content/locations", response_model=requests.CatalogUpdate)
+async def put_content_locations(
+    request: Request, db: Session = Depends(get_session)
+) -> requests.CatalogUpdate:
+    """This is the endpoint to insert or update locations in bulk.
+
+    The body is a CSV file with a header, or an NDJSON file, with a location_id for each
+    record. The body is spooled to disk while received, then merged in the catalog in a
+    single transaction, outside of the event loop. If the catalog is being changed by
+    another process, the update is refused with 409.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+
+    if content_type not in CATALOG_CONTENT_TYPES:
+        raise HTTPException(
+            415, f"Content type must be one of {list(CATALOG_CONTENT_TYPES)}"
+        )
+
+    with SpooledTemporaryFile(max_size=1 << 24) as f:
+        async for block in request.stream():
+            f.write(block)
+        f.seek(0)
+
+        try:
+            result = await run_in_threadpool(
+                upsert_locations,
+                db,
+                f,  # type: ignore
+                CATALOG_CONTENT_TYPES[content_type],
+            )
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        except Exception as e:
+            LOGGER.error(f"Catalog update failed: {e}")
+            raise HTTPException(500, "Catalog could not be updated")
+
+    if result is None:
+        raise HTTPException(409, "The catalog is being updated, retry later")
+
+    inserted, updated, version = result
+
+    events.record_event(db, "catalog_update")
+
+    return requests.CatalogUpdate(inserted=inserted, updated=updated, version=version)
 
 
 @api.get("/content/user/{user_id}")
-async def get_content_user(user_id: int, db: Session = Depends(get_session)):
+async def get_content_user(user_id: int, db: Session = Depends(get_read_session)):
     """This is the endpoint to get a user by its ID."""
-    return crud.get_user(db, user_id)
+    return read_after_write(db, lambda s: crud.get_user(s, user_id))
 
 
 @api.get("/content/users")
-async def get_content_users(db: Session = Depends(get_session)):
+async def get_content_users(db: Session = Depends(get_read_session)):
     """This is the endpoint to get all the users."""
-    return crud.get_users(db)
+    return crud.get_users_rows(db)
 
 
 @api.get("/content/result/{result_id}")
-async def get_content_result_byid(result_id: int, db: Session = Depends(get_session)):
+async def get_content_result_byid(
+    result_id: int, db: Session = Depends(get_read_session)
+):
     """This is the endpoint to get a result by its ID."""
-    return crud.get_result(db, result_id)
+    return read_after_write(db, lambda s: crud.get_result(s, result_id))
 
 
 @api.get("/content/results/{result_id}")
-async def get_content_result(task_id: int, db: Session = Depends(get_session)):
+async def get_content_result(task_id: str, db: Session = Depends(get_read_session)):
     """This is the endpoint to get all results for a given task ID."""
-    return crud.get_results(db, task_id)
+    return read_after_write(db, lambda s: crud.get_results_rows(s, task_id))
@@ -2,6 +2,7 @@ __all__ = [
     "Base",
     "DataBase",
     "get_session",
+    "get_read_session",
     "init_content",
     "Session",
 ]
@@ -11,5 +12,6 @@ from .database import (
     DataBase,
     Session,
     get_session,
+    get_read_session,
 )
 from .startup import init_content
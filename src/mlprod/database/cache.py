@@ -0,0 +1,284 @@
+"""Process-local cache of the catalog tables.
+
+The catalog changes rarely, but it is read by each inference and by the API. A cached
+copy is used as long as the version of the table in the `catalog_versions` table does
+not change. The version is checked at most every CATALOG_CACHE_TTL seconds. When all
+the changes since the cached version are logged in the `catalog_changes` table, as done
+by the bulk updates, only the changed records are read.
+
+When CATALOG_REDIS_URL is set, the copies are also shared between processes through
+Redis, keyed by version and by the time the version was set, so copies of another
+database with the same version are never read. A process that misses its local copy
+reads the one stored by another process, instead of the whole table. The copies are
+stored as Parquet (or JSON, without pyarrow) for the frames and as JSON for the rows.
+"""
+
+from datetime import datetime
+from sqlalchemy.orm import Session
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Generic, TypeVar
+
+from . import crud
+from .snapshot import HAS_PARQUET
+
+import io
+import json
+import logging
+import os
+
+import pandas as pd
+import redis
+
+LOGGER = logging.getLogger("mlprod.database.cache")
+
+# use cached copies of the catalog tables
+CATALOG_CACHE = os.environ.get("CATALOG_CACHE", "true") == "true"
+# seconds between two checks of the version of a table
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "1"))
+# Redis database shared by all the processes, empty to disable
+CATALOG_REDIS_URL = os.environ.get("CATALOG_REDIS_URL", "")
+# seconds after which the copies stored in Redis expire
+CATALOG_REDIS_TTL = int(os.environ.get("CATALOG_REDIS_TTL", "3600"))
+
+T = TypeVar("T")
+
+_redis: redis.Redis | None = None
+
+
+def _shared() -> redis.Redis | None:
+    """Client of the shared Redis tier, None if disabled."""
+    global _redis
+
+    if CATALOG_REDIS_URL and _redis is None:
+        _redis = redis.Redis.from_url(CATALOG_REDIS_URL)
+
+    return _redis
+
+
+def _dump_frame(df: pd.DataFrame) -> bytes:
+    """Serialize a frame for the shared tier."""
+    if HAS_PARQUET:
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, engine="pyarrow", index=False)
+        return buffer.getvalue()
+
+    data: str = df.to_json(orient="table", index=False)
+    return data.encode()
+
+
+def _load_frame(data: bytes) -> pd.DataFrame:
+    """Deserialize a frame written by `_dump_frame`."""
+    if HAS_PARQUET:
+        return pd.read_parquet(io.BytesIO(data), engine="pyarrow")
+
+    return pd.read_json(io.BytesIO(data), orient="table")
+
+
+def _encode(value: Any) -> Any:
+    """Encode the values not supported by JSON."""
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+
+    raise TypeError(f"{type(value).__name__} is not serializable")
+
+
+def _decode(obj: dict) -> Any:
+    """Decode the values encoded by `_encode`."""
+    if "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+
+    return obj
+
+
+def _dump_rows(rows: dict[int, dict]) -> bytes:
+    """Serialize the rows, keyed by id, for the shared tier."""
+    return json.dumps(list(rows.values()), default=_encode).encode()
+
+
+def _load_rows(data: bytes) -> dict[int, dict]:
+    """Deserialize the rows written by `_dump_rows`."""
+    return {row["location_id"]: row for row in json.loads(data, object_hook=_decode)}
+
+
+class CatalogCache(Generic[T]):
+    """Cached copy of a catalog table, in the format built by a loader."""
+
+    def __init__(
+        self,
+        table: str,
+        kind: str,
+        loader: Callable[[Session], T],
+        dump: Callable[[T], bytes],
+        load: Callable[[bytes], T],
+        patch: Callable[[Session, T, list[int]], T] | None = None,
+    ) -> None:
+        """Create an empty cache.
+
+        :param table:
+            Name of the cached table, as stored in the `catalog_versions` table.
+        :param kind:
+            Name of the format built by the loader, used as key in the shared tier.
+        :param loader:
+            Function that reads the table from the database.
+        :param dump:
+            Function that serializes a value for the shared tier.
+        :param load:
+            Function that deserializes a value from the shared tier.
+        :param patch:
+            Function that returns a copy of a cached value with the given records read
+            again from the database. If not set, the whole table is read on changes.
+        """
+        self.table = table
+        self.kind = kind
+        self.loader = loader
+        self.dump = dump
+        self.load = load
+        self.patch = patch
+
+        self.lock = Lock()
+        self.value: T | None = None
+        self.version: int = -1
+        self.checked: float = 0.0
+
+    def _key(self, version: int, time: datetime) -> str:
+        epoch = int(time.timestamp() * 1_000_000)
+        return f"mlprod:catalog:{self.table}:{self.kind}:{version}.{epoch}"
+
+    def _read(self, db: Session, version: int) -> T:
+        """Read a version of the table from the database, only the changes if logged."""
+        if self.value is not None and self.patch is not None:
+            ids = crud.get_catalog_changes(db, self.table, self.version, version)
+
+            if ids is not None:
+                LOGGER.info(f"updating {len(ids)} records of {self.table} in cache")
+                return self.patch(db, self.value, ids)
+
+        LOGGER.info(f"loading {self.table} version {version} in cache")
+        return self.loader(db)
+
+    def _load(self, db: Session, version: int, time: datetime | None) -> T:
+        """Read a version of the table from the shared tier, or from the database.
+
+        Versions without a time, never changed, are not shared.
+        """
+        shared = _shared()
+
+        if shared is None or time is None:
+            return self._read(db, version)
+
+        key = self._key(version, time)
+
+        try:
+            data = shared.get(key)
+            if isinstance(data, bytes):
+                LOGGER.debug(f"{self.table} version {version} read from Redis")
+                return self.load(data)
+        except Exception as e:
+            LOGGER.warning(f"Could not read {self.table} from Redis: {e}")
+
+        value = self._read(db, version)
+
+        try:
+            shared.set(key, self.dump(value), ex=CATALOG_REDIS_TTL)
+        except Exception as e:
+            LOGGER.warning(f"Could not write {self.table} to Redis: {e}")
+
+        return value
+
+    def get(self, db: Session) -> T:
+        """Returns the cached copy of the table, reloaded if the table changed.
+
+        :param db:
+            Session with the connection to the database.
+        """
+        if not CATALOG_CACHE:
+            return self.loader(db)
+
+        with self.lock:
+            now = monotonic()
+
+            if self.value is not None and now - self.checked < CATALOG_CACHE_TTL:
+                return self.value
+
+            version, time = crud.get_catalog_stamp(db, self.table)
+            self.checked = now
+
+            if self.value is None or version != self.version:
+                self.value = self._load(db, version, time)
+                self.version = version
+
+            return self.value
+
+
+def _patch_locations_frame(
+    db: Session, df: pd.DataFrame, ids: list[int]
+) -> pd.DataFrame:
+    """Copy of the locations with the given ones read again from the database."""
+    changed = crud.read_locations(db, ids=ids)
+
+    return pd.concat(
+        [df[~df["location_id"].isin(ids)], changed], ignore_index=True
+    ).sort_values("location_id", ignore_index=True)
+
+
+def _patch_locations_rows(
+    db: Session, rows: dict[int, dict], ids: list[int]
+) -> dict[int, dict]:
+    """Copy of the locations with the given ones read again from the database."""
+    changed = crud.get_locations_rows(db, ids=ids)
+
+    return dict(sorted((rows | {row["location_id"]: row for row in changed}).items()))
+
+
+_locations_frame: CatalogCache[pd.DataFrame] = CatalogCache(
+    "locations",
+    "frame.parquet" if HAS_PARQUET else "frame.json",
+    crud.read_locations,
+    _dump_frame,
+    _load_frame,
+    _patch_locations_frame,
+)
+_locations_rows: CatalogCache[dict[int, dict]] = CatalogCache(
+    "locations",
+    "rows.json",
+    lambda db: {row["location_id"]: row for row in crud.get_locations_rows(db)},
+    _dump_rows,
+    _load_rows,
+    _patch_locations_rows,
+)
+
+
+def read_locations(db: Session, columns: list[str] | None = None) -> pd.DataFrame:
+    """Cached version of `crud.read_locations`.
+
+    :param db:
+        Session with the connection to the database.
+    :param columns:
+        If set, only the location_id and these columns are returned. Names that are not
+        fields of the locations are ignored.
+    """
+    df = _locations_frame.get(db)
+
+    if columns is None:
+        return df.copy()
+
+    return df[
+        ["location_id"] + [c for c in df.columns if c in columns and c != "location_id"]
+    ]
+
+
+def get_locations_rows(db: Session) -> list[dict]:
+    """Cached version of `crud.get_locations_rows`."""
+    return list(_locations_rows.get(db).values())
+
+
+def get_location_row(db: Session, location_id: int) -> dict:
+    """Returns the location with the given ID as a dictionary, from the cache."""
+    row = _locations_rows.get(db).get(location_id)
+
+    if row is None:
+        LOGGER.error(f"Location with id {location_id} not found!")
+        raise ValueError(f"Location with id {location_id} not found!")
+
+    return row
@@ -0,0 +1,366 @@
+"""Loading of the catalog of locations from a TSV file, and bulk updates.
+
+The checksum of the loaded file is stored in the `catalog_sources` table: when the file
+did not change, nothing is loaded. An empty table is filled with PostgreSQL's COPY,
+streaming the file without parsing it. Otherwise, the locations are updated in place,
+the n-th record of the file being the location with id n.
+
+Bulk updates read CSV or NDJSON streams with explicit location ids. On PostgreSQL the
+stream is copied in a temporary table, then the existing locations are updated and the
+new ones inserted, with one statement each.
+The whole update is a single transaction that increases the version of the catalog, and
+the changed ids are logged in the `catalog_changes` table, so cached copies of the
+catalog can be updated incrementally.
+"""
+
+from pathlib import Path
+from sqlalchemy import text
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+from typing import IO, Iterator
+
+from . import crud
+from .tables import Location
+
+import csv
+import hashlib
+import io
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+LOGGER = logging.getLogger("mlprod.database.catalog")
+
+# file with the catalog of locations loaded at startup
+LOCATIONS_FILE = Path(os.environ.get("LOCATIONS_FILE", "./data/dataset_locations.tsv"))
+# records parsed at a time from the streams of the bulk updates
+CATALOG_CHUNK_SIZE = int(os.environ.get("CATALOG_CHUNK_SIZE", "10000"))
+# versions of a catalog table whose changes are kept in the log
+CATALOG_CHANGES_KEEP = int(os.environ.get("CATALOG_CHANGES_KEEP", "1000"))
+
+# formats accepted by the bulk updates
+FORMATS = ("csv", "ndjson")
+
+
+def file_checksum(path: Path) -> str:
+    """SHA-256 checksum of the content of a file."""
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def _check_columns(columns: list[str], source: str) -> list[str]:
+    """Columns of a source, checked against the locations table."""
+    unknown = set(columns) - set(Location.__table__.columns.keys())
+    if unknown:
+        raise ValueError(f"Unknown columns in {source}: {sorted(unknown)}")
+
+    return columns
+
+
+def _columns(path: Path) -> list[str]:
+    """Columns in the header of a TSV file, checked against the locations table."""
+    with open(path, "r") as f:
+        columns = f.readline().rstrip("\r\n").split("\t")
+
+    return _check_columns(columns, str(path))
+
+
+def copy_locations(db: Session, path: Path) -> int:
+    """Load a TSV file in the locations table with PostgreSQL's COPY.
+
+    :param db:
+        Session with the connection to the database.
+    :param path:
+        TSV file with a header, columns must be fields of the locations table.
+
+    :return:
+        The number of loaded records.
+    """
+    columns = _columns(path)
+
+    dbapi_conn = db.connection().connection.dbapi_connection
+
+    with open(path, "r") as f, dbapi_conn.cursor() as cursor:  # type: ignore
+        cursor.copy_expert(
+            f"COPY locations ({', '.join(columns)}) "
+            "FROM STDIN WITH (FORMAT csv, HEADER true, DELIMITER E'\\t')",
+            f,
+        )
+        n: int = cursor.rowcount
+
+    db.commit()
+
+    return n
+
+
+def load_locations(db: Session, path: Path = LOCATIONS_FILE) -> int:
+    """Load the catalog of locations from a TSV file, if it changed since the last load.
+
+    Call it while holding the `LOCK_CONTENT` lock, so concurrent processes do not load
+    the same file twice.
+
+    :param db:
+        Session with the connection to the database.
+    :param path:
+        TSV file with a header, columns must be fields of the locations table.
+
+    :return:
+        The number of loaded records, 0 if the file did not change.
+    """
+    checksum = file_checksum(path)
+    n_locations = crud.count_locations(db)
+
+    if n_locations > 0 and crud.get_catalog_checksum(db, path.name) == checksum:
+        LOGGER.info(f"catalog {path} unchanged, loading skipped")
+        return 0
+
+    if n_locations == 0 and db.get_bind().dialect.name == "postgresql":
+        LOGGER.info(f"no locations found in database, copying from {path}")
+        n = copy_locations(db, path)
+
+    else:
+        LOGGER.info(f"loading locations from {path}")
+
+        df = pd.read_csv(path, sep="\t", usecols=_columns(path))
+        df["location_id"] = np.arange(1, df.shape[0] + 1)
+        n = crud.upsert_locations(db, df)
+
+    crud.set_catalog_checksum(db, path.name, checksum, n)
+
+    LOGGER.info(f"catalog {path} loaded with {n} locations")
+
+    return n
+
+
+def _chunks(stream: IO[bytes], fmt: str) -> Iterator[pd.DataFrame]:
+    """Parse a CSV or NDJSON stream in chunks of records with the same columns."""
+    if fmt == "csv":
+        reader = pd.read_csv(stream, chunksize=CATALOG_CHUNK_SIZE)
+    elif fmt == "ndjson":
+        reader = pd.read_json(stream, lines=True, chunksize=CATALOG_CHUNK_SIZE)
+    else:
+        raise ValueError(f"Unknown format {fmt}, must be one of {FORMATS}")
+
+    columns = None
+
+    for df in reader:
+        if columns is None:
+            columns = _check_columns(list(df.columns), fmt.upper())
+
+            if "location_id" not in columns:
+                raise ValueError("Records must have a location_id")
+
+        elif list(df.columns) != columns:
+            raise ValueError("All the records must have the same fields")
+
+        if df["location_id"].isna().any():
+            raise ValueError("Records must have a location_id")
+
+        yield df
+
+
+def _create_staging(db: Session, columns: list[str]) -> None:
+    """Create a temporary table for the given columns of the locations.
+
+    The table has no constraints, so records with only some of the fields can be
+    copied, and the position of each record in the stream.
+    """
+    db.execute(
+        text(
+            "CREATE TEMPORARY TABLE locations_staging ON COMMIT DROP AS "
+            f"SELECT {', '.join(columns)} FROM locations WITH NO DATA"
+        )
+    )
+    db.execute(
+        text(
+            "ALTER TABLE locations_staging "
+            "ADD COLUMN staging_line bigint GENERATED ALWAYS AS IDENTITY"
+        )
+    )
+
+
+def _copy_staging(db: Session, stream: IO[bytes], fmt: str) -> list[str]:
+    """Copy a stream in a temporary table with the same columns of the locations.
+
+    CSV streams are copied as they are, NDJSON streams are converted in chunks.
+
+    :return:
+        The columns found in the stream.
+    """
+    dbapi_conn = db.connection().connection.dbapi_connection
+
+    def copy(f: IO, columns: list[str]) -> None:
+        with dbapi_conn.cursor() as cursor:  # type: ignore
+            cursor.copy_expert(
+                f"COPY locations_staging ({', '.join(columns)}) "
+                "FROM STDIN WITH (FORMAT csv)",
+                f,
+            )
+
+    if fmt == "csv":
+        header = next(csv.reader([stream.readline().decode()]))
+        columns = _check_columns(header, "CSV")
+
+        if "location_id" not in columns:
+            raise ValueError("Records must have a location_id")
+
+        _create_staging(db, columns)
+        copy(stream, columns)
+
+        return columns
+
+    columns = []
+
+    for df in _chunks(stream, fmt):
+        if not columns:
+            columns = list(df.columns)
+            _create_staging(db, columns)
+
+        copy(io.StringIO(df.to_csv(index=False, header=False)), columns)
+
+    if not columns:
+        raise ValueError("No records found")
+
+    return columns
+
+
+def _merge_staging(db: Session, columns: list[str]) -> tuple[list[int], int]:
+    """Update or insert the locations with the records of the temporary table.
+
+    Existing locations are updated only in the copied fields, then the new ones are
+    inserted. An upsert would check the constraints of the whole new row, also for the
+    existing locations.
+
+    :return:
+        The ids of the changed locations and the number of inserted ones.
+    """
+    # the last record of each location is used
+    db.execute(
+        text(
+            "DELETE FROM locations_staging s USING locations_staging t "
+            "WHERE s.location_id = t.location_id AND s.staging_line < t.staging_line"
+        )
+    )
+    db.execute(text("ANALYZE locations_staging"))
+
+    fields = ", ".join(columns)
+    updates = ", ".join(f"{c} = s.{c}" for c in columns if c != "location_id")
+
+    updated: list[int] = []
+
+    if updates:
+        updated = list(
+            db.execute(
+                text(
+                    f"UPDATE locations l SET {updates} FROM locations_staging s "
+                    "WHERE l.location_id = s.location_id RETURNING l.location_id"
+                )
+            ).scalars()
+        )
+
+    inserted: list[int] = list(
+        db.execute(
+            text(
+                f"INSERT INTO locations ({fields}) "
+                f"SELECT {fields} FROM locations_staging s WHERE NOT EXISTS "
+                "(SELECT 1 FROM locations l WHERE l.location_id = s.location_id) "
+                "RETURNING location_id"
+            )
+        ).scalars()
+    )
+
+    if inserted:
+        # ids are explicit: the sequence must continue after the highest one
+        db.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('locations', 'location_id'), "
+                "(SELECT max(location_id) FROM locations))"
+            )
+        )
+
+    return updated + inserted, len(inserted)
+
+
+def upsert_locations_stream(
+    db: Session, stream: IO[bytes], fmt: str = "csv"
+) -> tuple[int, int, int]:
+    """Insert new locations or update the existing ones from a CSV or NDJSON stream.
+
+    Each record must have a location_id, and all the records must have the same fields.
+    Fields missing from the stream are not changed for existing locations, new locations
+    must have all the fields without a default. If a location_id is repeated, the last
+    record is used. All the records are stored in a single transaction.
+
+    Call it while holding the `LOCK_CONTENT` lock, so it does not run concurrently with
+    the loading of the catalog.
+
+    :param db:
+        Session with the connection to the database.
+    :param stream:
+        Binary stream with a CSV file with a header, or an NDJSON file.
+    :param fmt:
+        Format of the stream, one of `FORMATS`.
+
+    :return:
+        The number of inserted and of updated locations, and the new version of the
+        catalog.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, must be one of {FORMATS}")
+
+    try:
+        # locks the version until the commit, so no other change can happen in between
+        crud.bump_catalog_version(db, "locations")
+        previous = crud.get_catalog_version(db, "locations") - 1
+
+        if db.get_bind().dialect.name == "postgresql":
+            columns = _copy_staging(db, stream, fmt)
+            ids, inserted = _merge_staging(db, columns)
+
+        else:
+            ids, inserted = [], 0
+
+            for df in _chunks(stream, fmt):
+                chunk = df["location_id"].astype(int).tolist()
+                existing = crud.read_locations(db, ["location_id"], ids=chunk)
+
+                crud.upsert_locations(db, df, commit=False)
+
+                ids += chunk
+                inserted += len(set(chunk) - set(existing["location_id"]))
+
+        version = crud.get_catalog_version(db, "locations")
+
+        crud.log_catalog_changes(db, "locations", previous, version, ids)
+        crud.delete_catalog_changes_before(
+            db, "locations", version - CATALOG_CHANGES_KEEP
+        )
+
+        db.commit()
+
+    except Exception as e:
+        db.rollback()
+
+        # COPY raises the errors of the driver, not wrapped by SQLAlchemy
+        dbapi = db.get_bind().dialect.loaded_dbapi
+        invalid = (DataError, IntegrityError, dbapi.DataError, dbapi.IntegrityError)
+
+        if isinstance(e, invalid):
+            raise ValueError(f"Invalid records: {getattr(e, 'orig', e)}") from e
+        raise
+
+    n = len(set(ids))
+
+    LOGGER.info(
+        f"catalog locations updated to version {version}: "
+        f"{inserted} inserted, {n - inserted} updated"
+    )
+
+    return inserted, n - inserted, version
@@ -1,25 +1,98 @@
 import numpy as np
 import pandas as pd
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
-from sqlalchemy.orm import Session
-
-from .tables import Dataset, Location, Inference, Event, Result, User, Model
+from sqlalchemy import (
+    Column,
+    ColumnElement,
+    Engine,
+    Table,
+    Select,
+    Sequence,
+    exists,
+    func,
+    insert,
+    literal,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import InstrumentedAttribute, Query, Session
+from typing import Iterator, TypedDict, cast
+
+from .tables import (
+    INFERENCE_ID_SEQ,
+    Base,
+    MODEL_ID_SEQ,
+    CatalogChange,
+    CatalogSource,
+    CatalogVersion,
+    ContentCounter,
+    Dataset,
+    Location,
+    Inference,
+    Event,
+    EventCount,
+    Result,
+    ResultScores,
+    User,
+    Model,
+    ShadowInference,
+    ShadowResult,
+)
 
 import logging
 
 LOGGER = logging.getLogger("mlprod.database.crud")
 
 
-def create_user_data(db: Session, user_data: dict) -> User:
-    """Store the data from a user in the database.
+def _next_id(
+    db: Session, column: InstrumentedAttribute[int], sequence: Sequence
+) -> ColumnElement:
+    """SQL expression with the next value of an id, computed by the database."""
+    if db.get_bind().dialect.name == "postgresql":
+        return sequence.next_value()
 
-    :param db:
-        Session with the connection to the database.
-    :param user_data:
-        Content to be saved to the database.
+    # without sequences, continue after the highest id
+    return select(func.coalesce(func.max(column), 0) + 1).scalar_subquery()
+
+
+def _inference_id(task_id: str) -> ColumnElement:
+    """Subquery with the id of the inference of the given task."""
+    return (
+        select(Inference.inference_id)
+        .where(Inference.task_id == task_id)
+        .scalar_subquery()
+    )
+
+
+def _check_new_inference(db: Session, task_id: str) -> None:
+    """Raise an error if an inference of the given task already exists.
+
+    The primary key of the inferences includes the time of creation, the partition key,
+    so it does not prevent two inferences with the same task_id. On PostgreSQL, a lock
+    on the task_id held until the end of the transaction serializes concurrent inserts.
     """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext('inferences'), hashtext(:id))"),
+            {"id": task_id},
+        )
+
+    if db.execute(select(exists().where(Inference.task_id == task_id))).scalar():
+        raise ValueError(f"Inference with task_id {task_id} already exists!")
+
+
+def _model_id(task_id: str) -> ColumnElement:
+    """Subquery with the id of the model of the given training task."""
+    return select(Model.model_id).where(Model.task_id == task_id).scalar_subquery()
+
+
+def _user_values(user_data: dict) -> dict:
+    """Fields of the users table from the data received with a request."""
     data = dict() | user_data
     ages = np.array(data["people_age"], dtype="float")
 
@@ -30,6 +103,40 @@ def create_user_data(db: Session, user_data: dict) -> User:
 
     del data["people_age"]
 
+    return data
+
+
+def _projection(table: type[Base], columns: list[str] | None, key: str) -> list[Column]:
+    """Columns of a table to read: all, or the key and the given ones that exist."""
+    t = cast(Table, table.__table__)
+
+    if columns is None:
+        return list(t.columns)
+
+    return [t.c[key]] + [c for c in t.columns if c.name in columns and c.name != key]
+
+
+def _frame(db: Session, query: Select) -> pd.DataFrame:
+    """Reads the rows of a column-projected query in a DataFrame, without ORM objects."""
+    result = db.execute(query)
+    return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+
+def _rows(db: Session, query: Select) -> list[dict]:
+    """Reads the rows of a column-projected query as dictionaries, without ORM objects."""
+    return [dict(row) for row in db.execute(query).mappings()]
+
+
+def create_user_data(db: Session, user_data: dict) -> User:
+    """Store the data from a user in the database.
+
+    :param db:
+        Session with the connection to the database.
+    :param user_data:
+        Content to be saved to the database.
+    """
+    data = _user_values(user_data)
+
     LOGGER.debug(f"Creating user with data: {data}")
 
     db_user = User(**data)
@@ -51,13 +158,60 @@ def create_inference(db: Session, task_id: str, status: str, user_id: int) -> In
     """
     LOGGER.debug(f"Creating inference task_id={task_id}, status={status}")
 
-    db_pred = Inference(task_id=task_id, status=status, user_id=user_id)
+    _check_new_inference(db, task_id)
+
+    db_pred = Inference(
+        task_id=task_id,
+        inference_id=_next_id(db, Inference.inference_id, INFERENCE_ID_SEQ),
+        status=status,
+        user_id=user_id,
+    )
     db.add(db_pred)
     db.commit()
     db.refresh(db_pred)
     return db_pred
 
 
+def create_inference_request(
+    db: Session, task_id: str, user_data: dict, status: str = "PENDING"
+) -> int:
+    """Store the data from a user and a new inference for it, in a single transaction.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the task that will run the inference.
+    :param user_data:
+        Content to be saved to the database.
+    :param status:
+        Initial status of the task.
+
+    :return:
+        The id of the new user.
+    """
+    data = _user_values(user_data)
+
+    LOGGER.debug(f"Creating inference task_id={task_id} for user with data: {data}")
+
+    _check_new_inference(db, task_id)
+
+    user_id = db.execute(
+        insert(User).values(**data).returning(User.user_id)
+    ).scalar_one()
+
+    db.execute(
+        insert(Inference).values(
+            task_id=task_id,
+            inference_id=_next_id(db, Inference.inference_id, INFERENCE_ID_SEQ),
+            status=status,
+            user_id=user_id,
+        )
+    )
+    db.commit()
+
+    return user_id
+
+
 def get_inference(db: Session, task_id: str) -> Inference:
     """Extract from the database the first Celery's task that match the given task_id.
 
@@ -106,7 +260,7 @@ def create_results(db: Session, df: pd.DataFrame) -> list[Result]:
         Session with the connection to the database.
     :param df:
         A dataframe with the columns 'user_id', 'location_id', 'score', and
-        'task_id'.
+        'inference_id'.
     """
     LOGGER.debug(f"Creating results from dataframe with shape {df.shape}")
 
@@ -116,7 +270,7 @@ def create_results(db: Session, df: pd.DataFrame) -> list[Result]:
             user_id=row["user_id"],
             location_id=row["location_id"],
             score=row["score"],
-            task_id=row["task_id"],
+            inference_id=row["inference_id"],
             label=0,
         )
 
@@ -131,6 +285,189 @@ def create_results(db: Session, df: pd.DataFrame) -> list[Result]:
     return db_results
 
 
+# types of the packed arrays of the result_scores table
+PACKED_LOCATION_DTYPE = "<i4"
+PACKED_SCORE_DTYPE = "<f4"
+
+
+def create_result_scores(
+    db: Session,
+    inference_id: int,
+    user_id: int,
+    location_ids: np.ndarray,
+    scores: np.ndarray,
+) -> None:
+    """Store all the scores of an inference as packed arrays.
+
+    :param db:
+        Session with the connection to the database.
+    :param inference_id:
+        Id of the inference.
+    :param user_id:
+        Id of the user of the inference.
+    :param location_ids:
+        Ids of the scored locations.
+    :param scores:
+        Score of each location.
+    """
+    LOGGER.debug(
+        f"Creating packed scores for inference_id={inference_id} "
+        f"with {len(location_ids)} locations"
+    )
+
+    scores = np.asarray(scores).reshape(-1)
+    order = np.argsort(-scores, kind="mergesort")
+
+    db.execute(
+        insert(ResultScores).values(
+            inference_id=inference_id,
+            user_id=user_id,
+            location_ids=np.asarray(location_ids)[order]
+            .astype(PACKED_LOCATION_DTYPE)
+            .tobytes(),
+            scores=scores[order].astype(PACKED_SCORE_DTYPE).tobytes(),
+        )
+    )
+    db.commit()
+
+
+def _read_result_scores(
+    db: Session, task_id: str
+) -> tuple[int, int, np.ndarray, np.ndarray] | None:
+    """Packed scores of the inference of a task, if stored in packed mode.
+
+    :return:
+        The inference id, the user id, the location ids and the scores sorted by
+        descending score, or None.
+    """
+    row = (
+        db.query(
+            ResultScores.inference_id,
+            ResultScores.user_id,
+            ResultScores.location_ids,
+            ResultScores.scores,
+        )
+        .filter(ResultScores.inference_id == _inference_id(task_id))
+        .first()
+    )
+
+    if row is None:
+        return None
+
+    return (
+        row[0],
+        row[1],
+        np.frombuffer(row[2], dtype=PACKED_LOCATION_DTYPE),
+        np.frombuffer(row[3], dtype=PACKED_SCORE_DTYPE),
+    )
+
+
+def _shown_by_location(
+    db: Session, inference_id: int, location_ids: np.ndarray
+) -> dict[int, bool]:
+    """Shown flag of the existing rows of an inference, for the given locations."""
+    return {
+        location_id: shown
+        for location_id, shown in db.query(Result.location_id, Result.shown)
+        .filter(Result.inference_id == inference_id)
+        .filter(Result.location_id.in_(location_ids.tolist()))
+    }
+
+
+def _materialize_results(
+    db: Session,
+    inference_id: int,
+    user_id: int,
+    location_ids: np.ndarray,
+    scores: np.ndarray,
+    shown: bool,
+) -> int:
+    """Create the rows of the results table for some of the packed scores.
+
+    Existing rows are not created again. The results table is partitioned by result_id,
+    so no unique index on (inference_id, location_id) is available: before writing, the
+    packed scores of the inference are locked, so concurrent calls wait for each other
+    and the rows created by the first are seen by the others. Without a commit, the
+    caller decides the transaction.
+
+    :param shown:
+        If True, the rows are also marked as shown.
+
+    :return:
+        The number of created or updated rows.
+    """
+    existing = _shown_by_location(db, inference_id, location_ids)
+
+    if all(int(loc) in existing for loc in location_ids) and (
+        not shown or all(existing.values())
+    ):
+        return 0
+
+    db.query(ResultScores.inference_id).filter(
+        ResultScores.inference_id == inference_id
+    ).with_for_update().first()
+
+    # rows created while waiting for the lock
+    existing = _shown_by_location(db, inference_id, location_ids)
+
+    values = [
+        {
+            "inference_id": inference_id,
+            "user_id": user_id,
+            "location_id": int(loc),
+            "score": float(score),
+            "label": 0,
+            "shown": shown,
+        }
+        for loc, score in zip(location_ids, scores)
+        if int(loc) not in existing
+    ]
+
+    if values:
+        db.execute(insert(Result), values)
+
+    hidden = [loc for loc, s in existing.items() if shown and not s]
+
+    if hidden:
+        db.query(Result).filter(Result.inference_id == inference_id).filter(
+            Result.location_id.in_(hidden)
+        ).update({Result.shown: True}, synchronize_session=False)
+
+    return len(values) + len(hidden)
+
+
+def _materialize_labelled(db: Session, task_id: str, location_ids: list[int]) -> int:
+    """Create the rows of the results table for packed scores about to be labelled."""
+    packed = _read_result_scores(db, task_id)
+
+    if packed is None:
+        return 0
+
+    inference_id, user_id, locs, scores = packed
+    mask = np.isin(locs, location_ids)
+
+    return _materialize_results(
+        db, inference_id, user_id, locs[mask], scores[mask], shown=False
+    )
+
+
+def _packed_locations(
+    db: Session, location_ids: np.ndarray, scores: np.ndarray
+) -> list[dict]:
+    """Packed scores joined with their locations, in the format of the results."""
+    query = select(
+        *[Location.__table__.c[field] for field in RESULT_LOCATION_FIELDS]
+    ).where(Location.location_id.in_(location_ids.tolist()))
+
+    locations = {row["location_id"]: row for row in _rows(db, query)}
+
+    return [
+        {"score": score} | locations[loc]
+        for loc, score in zip(location_ids.tolist(), scores.tolist())
+        if loc in locations
+    ]
+
+
 def get_results_locations(db: Session, task_id: str, limit: int = 10) -> list[dict]:
     """Get all the scored results based on the given task_id.
 
@@ -145,42 +482,24 @@ def get_results_locations(db: Session, task_id: str, limit: int = 10) -> list[di
     """
     LOGGER.debug(f"Getting results locations for task_id={task_id} with limit={limit}")
 
-    db_results = (
-        db.query(Result)
-        .filter(Result.task_id == task_id)
+    packed = _read_result_scores(db, task_id)
+
+    if packed is not None:
+        _, _, locs, scores = packed
+        return _packed_locations(db, locs[:limit], scores[:limit])
+
+    query = (
+        select(
+            Result.score,
+            *[Location.__table__.c[field] for field in RESULT_LOCATION_FIELDS],
+        )
         .join(Location, Result.location_id == Location.location_id)
+        .where(Result.inference_id == _inference_id(task_id))
         .order_by(Result.score.desc())
         .limit(limit)
-        .all()
     )
 
-    results = []
-    for db_result in db_results:
-        results.append(
-            {
-                "score": db_result.score,
-                "location_id": db_result.location.location_id,
-                "children": db_result.location.children,
-                "breakfast": db_result.location.breakfast,
-                "lunch": db_result.location.lunch,
-                "dinner": db_result.location.dinner,
-                "price": db_result.location.price,
-                "has_pool": db_result.location.has_pool,
-                "has_spa": db_result.location.has_spa,
-                "animals": db_result.location.animals,
-                "near_lake": db_result.location.near_lake,
-                "near_mountains": db_result.location.near_mountains,
-                "has_sport": db_result.location.has_sport,
-                "family_rating": db_result.location.family_rating,
-                "outdoor_rating": db_result.location.outdoor_rating,
-                "food_rating": db_result.location.food_rating,
-                "leisure_rating": db_result.location.leisure_rating,
-                "service_rating": db_result.location.service_rating,
-                "user_score": db_result.location.user_score,
-            }
-        )
-
-    return results
+    return _rows(db, query)
 
 
 def mark_locations_as_shown(db: Session, task_id: str, locations: list[dict]) -> None:
@@ -197,16 +516,341 @@ def mark_locations_as_shown(db: Session, task_id: str, locations: list[dict]) ->
 
     loc_ids = [location["location_id"] for location in locations]
 
-    db.query(Result).filter(Result.task_id == task_id).filter(
+    db.query(Result).filter(Result.inference_id == _inference_id(task_id)).filter(
         Result.location_id.in_(loc_ids)
-    ).update({Result.shown: True})
+    ).update({Result.shown: True}, synchronize_session=False)
+
+    db.commit()
+
+
+# fields of the locations returned with the results of an inference
+RESULT_LOCATION_FIELDS = (
+    "location_id",
+    "children",
+    "breakfast",
+    "lunch",
+    "dinner",
+    "price",
+    "has_pool",
+    "has_spa",
+    "animals",
+    "near_lake",
+    "near_mountains",
+    "has_sport",
+    "family_rating",
+    "outdoor_rating",
+    "food_rating",
+    "leisure_rating",
+    "service_rating",
+    "user_score",
+)
+
+
+def show_results_locations(db: Session, task_id: str, limit: int = 10) -> list[dict]:
+    """Get the best scored results of a task and mark them as shown to the user.
+
+    On PostgreSQL, a single statement selects the results, marks them as shown, and
+    returns them joined with their locations. Results already shown are not updated
+    again, so repeated calls for the same task do not write.
+
+    For scores stored in packed mode, the rows of the shown results are created.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the task where the score was calculated.
+    :param limit:
+        Limit the results with this parameter.
+
+    :return:
+        The results ordered by score, in the same format of `get_results_locations`.
+    """
+    LOGGER.debug(f"Showing results locations for task_id={task_id} with limit={limit}")
+
+    packed = _read_result_scores(db, task_id)
+
+    if packed is not None:
+        # the rows of the results are created when they are shown
+        inference_id, user_id, locs, scores = packed
+        locs, scores = locs[:limit], scores[:limit]
+
+        if _materialize_results(db, inference_id, user_id, locs, scores, shown=True):
+            db.commit()
+
+        return _packed_locations(db, locs, scores)
+
+    top = (
+        select(Result.result_id, Result.location_id, Result.score)
+        .where(Result.inference_id == _inference_id(task_id))
+        .order_by(Result.score.desc())
+        .limit(limit)
+        .cte("top")
+    )
+
+    mark = (
+        update(Result)
+        .where(Result.result_id.in_(select(top.c.result_id)))
+        .where(Result.shown.is_(False))
+        .values(shown=True)
+        .execution_options(synchronize_session=False)
+    )
+
+    query = (
+        select(
+            top.c.score,
+            *[Location.__table__.c[field] for field in RESULT_LOCATION_FIELDS],
+        )
+        .join(Location, top.c.location_id == Location.location_id)
+        .order_by(top.c.score.desc())
+    )
+
+    if db.get_bind().dialect.name == "postgresql":
+        # data-modifying CTEs are always executed, even if not referenced
+        query = query.add_cte(mark.returning(Result.result_id).cte("marked"))
+        rows = db.execute(query).mappings().all()
+    else:
+        db.execute(mark)
+        rows = db.execute(query).mappings().all()
+
+    db.commit()
+
+    return [dict(row) for row in rows]
+
+
+def get_task_scores(db: Session, task_id: str) -> tuple[np.ndarray, np.ndarray]:
+    """Get the scores assigned by the active model to all locations for a task.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the inference task.
+
+    :return:
+        Two arrays with the location ids and the scores.
+    """
+    packed = _read_result_scores(db, task_id)
+
+    if packed is not None:
+        _, _, locs, scores = packed
+        return locs.astype("int"), scores.astype("float")
+
+    rows = (
+        db.query(Result.location_id, Result.score)
+        .filter(Result.inference_id == _inference_id(task_id))
+        .all()
+    )
+
+    location_ids = np.array([r[0] for r in rows], dtype="int")
+    scores = np.array([r[1] for r in rows], dtype="float")
+
+    return location_ids, scores
+
+
+def create_shadow_results(
+    db: Session,
+    task_id: str,
+    model_id: str,
+    agreement: dict[str, float],
+    location_ids: np.ndarray,
+    scores: np.ndarray,
+) -> ShadowInference:
+    """Store the results of a candidate model that scored an inference in shadow mode.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the inference task scored by the candidate.
+    :param model_id:
+        Id of the candidate model.
+    :param agreement:
+        Dictionary with the 'top_k', 'top_k_overlap', 'rank_correlation', and
+        'score_mae' values between the active and the candidate model.
+    :param location_ids:
+        Locations scored by the candidate to be stored.
+    :param scores:
+        Scores of the candidate for each location.
+    """
+    LOGGER.debug(f"Creating shadow results for task_id={task_id} model_id={model_id}")
+
+    db_shadow = ShadowInference(task_id=task_id, model_id=model_id, **agreement)
+    db.add(db_shadow)
+    db.flush()
+
+    db.execute(
+        insert(ShadowResult),
+        [
+            {"task_id": task_id, "location_id": int(loc), "score": float(score)}
+            for loc, score in zip(location_ids, scores)
+        ],
+    )
+    db.commit()
+
+    return db_shadow
+
+
+class ShadowAgreement(TypedDict):
+    """Average agreement between the active model and a candidate model."""
+
+    inferences: int
+    top_k_overlap: float
+    rank_correlation: float
+    score_mae: float
+
+
+def get_shadow_agreement(db: Session, model_id: str) -> ShadowAgreement:
+    """Average agreement between the active model and a candidate model.
+
+    :param db:
+        Session with the connection to the database.
+    :param model_id:
+        Id of the candidate model.
+    """
+    row = (
+        db.query(
+            func.count(ShadowInference.task_id),
+            func.avg(ShadowInference.top_k_overlap),
+            func.avg(ShadowInference.rank_correlation),
+            func.avg(ShadowInference.score_mae),
+        )
+        .filter(ShadowInference.model_id == model_id)
+        .one()
+    )
+
+    return {
+        "inferences": int(row[0]),
+        "top_k_overlap": row[1] or 0.0,
+        "rank_correlation": row[2] or 0.0,
+        "score_mae": row[3] or 0.0,
+    }
+
+
+def get_shadow_scores(db: Session, model_id: str) -> pd.DataFrame:
+    """Labels and scores of both active and candidate models for the shown locations.
+
+    :param db:
+        Session with the connection to the database.
+    :param model_id:
+        Id of the candidate model.
+
+    :return:
+        A DataFrame with the columns 'label', 'score' (active model), and
+        'score_shadow' (candidate model).
+    """
+    query = (
+        db.query(
+            Result.label,
+            Result.score,
+            ShadowResult.score.label("score_shadow"),
+        )
+        .select_from(ShadowInference)
+        .join(ShadowResult, ShadowResult.task_id == ShadowInference.task_id)
+        .join(Inference, Inference.task_id == ShadowInference.task_id)
+        .join(
+            Result,
+            (Result.inference_id == Inference.inference_id)
+            & (Result.location_id == ShadowResult.location_id),
+        )
+        .filter(ShadowInference.model_id == model_id)
+        .filter(Result.shown)
+    )
+
+    bind = db.bind
+
+    if bind is None:
+        LOGGER.error("Database not available!")
+        raise ValueError("Database not available!")
+
+    return pd.read_sql(query.statement, bind)
+
+
+def read_expired_results(db: Session, before: datetime, limit: int) -> pd.DataFrame:
+    """Reads the oldest results never shown to the users and not used in a dataset.
+
+    :param db:
+        Session with the connection to the database.
+    :param before:
+        Only results of inferences created before this time are returned.
+    :param limit:
+        Maximum number of records to read.
+    """
+    query = (
+        db.query(Result)
+        .join(Inference, Result.inference_id == Inference.inference_id)
+        .filter(Inference.time_creation < before)
+        .filter(~Result.shown)
+        .filter(~exists().where(Dataset.result_id == Result.result_id))
+        .order_by(Result.result_id)
+        .limit(limit)
+    )
+
+    bind = db.bind
+
+    if bind is None:
+        LOGGER.error("Database not available!")
+        raise ValueError("Database not available!")
 
+    return pd.read_sql(query.statement, bind)
+
+
+def delete_results(db: Session, result_ids: list[int]) -> int:
+    """Delete the results with the given ids.
+
+    :param db:
+        Session with the connection to the database.
+    :param result_ids:
+        Ids of the results to delete.
+
+    :return:
+        The number of deleted results.
+    """
+    n = (
+        db.query(Result)
+        .filter(Result.result_id.in_(result_ids))
+        .delete(synchronize_session=False)
+    )
     db.commit()
 
+    LOGGER.debug(f"Deleted {n} results")
+
+    return n
+
+
+def delete_result_scores_before(db: Session, before: datetime) -> int:
+    """Delete the packed scores of the inferences created before the given time.
+
+    Rows of the results table created for shown or labelled locations are kept.
 
-def get_results(db: Session, task_id: int) -> list[Result]:
+    :param db:
+        Session with the connection to the database.
+    :param before:
+        Scores created before this time are deleted.
+
+    :return:
+        The number of deleted records.
+    """
+    n = (
+        db.query(ResultScores)
+        .filter(ResultScores.time_creation < before)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+
+    LOGGER.debug(f"Deleted {n} packed scores before {before}")
+
+    return n
+
+
+def get_results(db: Session, task_id: str) -> list[Result]:
     """Get all the results for the given task_id."""
-    return db.query(Result).filter(Result.task_id == task_id).all()
+    return db.query(Result).filter(Result.inference_id == _inference_id(task_id)).all()
+
+
+def get_results_rows(db: Session, task_id: str) -> list[dict]:
+    """Get all the results for the given task_id, as dictionaries."""
+    return _rows(
+        db,
+        select(Result.__table__).where(Result.inference_id == _inference_id(task_id)),
+    )
 
 
 def get_result(db: Session, result_id: int) -> Result:
@@ -230,30 +874,381 @@ def update_result_label(db: Session, task_id: str, location_id: int) -> Result |
     :param location_id:
         Id of the location to update.
     """
-    db_result = (
-        db.query(Result)
-        .filter(Result.task_id == task_id)
-        .filter(Result.location_id == location_id)
-        .first()
+    stmt = (
+        update(Result)
+        .where(Result.inference_id == _inference_id(task_id))
+        .where(Result.location_id == location_id)
+        .values(label=1)
+        .returning(Result)
+        .execution_options(synchronize_session=False)
+    )
+
+    db_result = db.execute(stmt).scalar_one_or_none()
+
+    # scores stored in packed mode have a row only once shown or labelled
+    if db_result is None and _materialize_labelled(db, task_id, [location_id]):
+        db_result = db.execute(stmt).scalar_one_or_none()
+
+    db.commit()
+
+    if db_result is None:
+        LOGGER.warning(
+            f"Result not found for task_id={task_id} and location_id={location_id}"
+        )
+
+    return db_result
+
+
+def update_result_labels(
+    db: Session, labels: list[tuple[str, int]]
+) -> set[tuple[str, int]]:
+    """Assign the label 1 to many results with a single update.
+
+    Results with scores stored in packed mode and never shown need a second update,
+    once their rows are created.
+
+    :param db:
+        Session with the connection to the database.
+    :param labels:
+        Pairs of (task_id, location_id) of the results to update.
+
+    :return:
+        The pairs of (task_id, location_id) of the updated results.
+    """
+    pairs = list(set(labels))
+
+    if not pairs:
+        return set()
+
+    # task of each inference, and inference of each task
+    tasks = dict(
+        db.query(Inference.inference_id, Inference.task_id)
+        .filter(Inference.task_id.in_({task_id for task_id, _ in pairs}))
+        .all()
+    )
+    inferences = {task_id: i for i, task_id in tasks.items()}
+
+    keys = [(inferences[t], loc) for t, loc in pairs if t in inferences]
+
+    def label(keys: list[tuple[int, int]]) -> set[tuple[str, int]]:
+        if not keys:
+            return set()
+
+        rows = db.execute(
+            update(Result)
+            .where(tuple_(Result.inference_id, Result.location_id).in_(keys))
+            .values(label=1)
+            .returning(Result.inference_id, Result.location_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        return {(tasks[i], loc) for i, loc in rows}
+
+    updated = label(keys)
+
+    # scores stored in packed mode have a row only once shown or labelled
+    missing: dict[str, list[int]] = dict()
+    for t, loc in pairs:
+        if t in inferences and (t, loc) not in updated:
+            missing.setdefault(t, []).append(loc)
+
+    if sum(_materialize_labelled(db, t, locs) for t, locs in missing.items()):
+        updated |= label(
+            [(inferences[t], loc) for t, locs in missing.items() for loc in locs]
+        )
+
+    db.commit()
+
+    if len(updated) < len(pairs):
+        LOGGER.warning(f"Results not found for {len(pairs) - len(updated)} labels")
+
+    return updated
+
+
+def get_label_stamp(db: Session, watermark: int, size: int) -> int:
+    """Returns the stamp of the labels of a dataset: its number of positive labels.
+
+    Labels only change from 0 to 1, so datasets with the same watermark and size have
+    the same labels if and only if they have the same stamp. The stamp is computed on
+    the results of the dataset when read, so labelling does not write anything else.
+
+    :param db:
+        Session with the connection to the database.
+    :param watermark:
+        Watermark of the dataset, see `get_dataset_watermark`.
+    :param size:
+        Size of the dataset.
+    """
+    window = (
+        select(Result.label)
+        .where(Result.shown)
+        .where(Result.result_id <= watermark)
+        .order_by(Result.result_id.desc())
+        .limit(size)
+        .subquery()
+    )
+
+    stamp = db.execute(select(func.coalesce(func.sum(window.c.label), 0))).scalar()
+    return int(stamp or 0)
+
+
+def get_dataset_watermark(db: Session) -> int:
+    """Returns the highest result_id that can be part of a dataset.
+
+    Datasets are built only from results shown to the users: with the same watermark,
+    the same dataset is produced.
+
+    :param db:
+        Session with the connection to the database.
+    """
+    watermark = db.query(func.max(Result.result_id)).filter(Result.shown).scalar()
+    return watermark or 0
+
+
+def _dataset_query(
+    db: Session, size: int, watermark: int | None = None, offset: int = 0
+) -> Query:
+    """Query for the newest results shown to the users, with users and locations."""
+    query = db.query(Result, Location, User).filter(Result.shown)
+
+    if watermark is not None:
+        query = query.filter(Result.result_id <= watermark)
+
+    return (
+        query.order_by(Result.result_id.desc())
+        .join(Location, Result.location_id == Location.location_id)
+        .join(User, Result.user_id == User.user_id)
+        .offset(offset)
+        .limit(size)
+    )
+
+
+def get_model_watermark(db: Session, task_id: str) -> int | None:
+    """Returns the highest result_id in the dataset used to train a model.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task of the model.
+
+    :return:
+        The watermark, or None if the model has no registered dataset.
+    """
+    watermark: int | None = (
+        db.query(func.max(Dataset.result_id))
+        .filter(Dataset.model_id == _model_id(task_id))
+        .scalar()
+    )
+    return watermark
+
+
+def get_last_dataset_watermark(db: Session) -> int:
+    """Returns the highest result_id in all the datasets used for training.
+
+    :param db:
+        Session with the connection to the database.
+    """
+    return db.query(func.max(Dataset.result_id)).scalar() or 0
+
+
+def get_last_trained_model(db: Session) -> Model | None:
+    """Returns the newest model with a registered dataset, promoted or not.
+
+    :param db:
+        Session with the connection to the database.
+    """
+    return (
+        db.query(Model)
+        .filter(exists().where(Dataset.model_id == Model.model_id))
+        .order_by(Model.time_creation.desc())
+        .first()
+    )
+
+
+def count_labelled_since(db: Session, watermark: int) -> tuple[int, int]:
+    """Counts the results shown to the users after the given watermark.
+
+    :param db:
+        Session with the connection to the database.
+    :param watermark:
+        Only results with a result_id greater than this value are counted.
+
+    :return:
+        The number of results and how many of them have a positive label.
+    """
+    count, positives = (
+        db.query(func.count(Result.result_id), func.coalesce(func.sum(Result.label), 0))
+        .filter(Result.shown)
+        .filter(Result.result_id > watermark)
+        .one()
+    )
+    return int(count), int(positives)
+
+
+def count_dataset_labels(db: Session, task_id: str) -> tuple[int, int]:
+    """Counts the results in the dataset used to train a model.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task of the model.
+
+    :return:
+        The number of results and how many of them have a positive label.
+    """
+    count, positives = (
+        db.query(func.count(Result.result_id), func.coalesce(func.sum(Result.label), 0))
+        .join(Dataset, Dataset.result_id == Result.result_id)
+        .filter(Dataset.model_id == _model_id(task_id))
+        .one()
+    )
+    return int(count), int(positives)
+
+
+def create_dataset(
+    db: Session, task_id: str, size: int, watermark: int | None = None
+) -> pd.DataFrame:
+    """Creates a dataset in Pandas' DataFrame forma from the data shown to the users and stored in the database.
+
+    Only the newer data will be returned.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task to be used as id of the dataset.
+    :param size:
+        Size of the dataset.
+    :param watermark:
+        If set, only results with a result_id lower or equal to this value are used.
+    """
+    LOGGER.debug(
+        f"Creating dataset for task_id={task_id} with size={size} watermark={watermark}"
+    )
+
+    df = read_dataset(db, size, watermark)
+
+    register_dataset(db, task_id, df["result_id"].to_numpy())
+
+    return df
+
+
+def read_dataset(
+    db: Session, size: int, watermark: int | None = None, offset: int = 0
+) -> pd.DataFrame:
+    """Reads the newest data shown to the users, without registering a dataset.
+
+    :param db:
+        Session with the connection to the database.
+    :param size:
+        Size of the dataset.
+    :param watermark:
+        If set, only results with a result_id lower or equal to this value are used.
+    :param offset:
+        Number of newest records to skip.
+    """
+    query = _dataset_query(db, size, watermark, offset)
+
+    bind = db.bind
+
+    if bind is None:
+        LOGGER.error("Database not available!")
+        raise ValueError("Database not available!")
+
+    return pd.read_sql(query.statement, bind)
+
+
+def get_labelled_since(
+    db: Session, watermark: int, limit: int, min_age: timedelta
+) -> pd.DataFrame:
+    """Reads the oldest data shown to the users after the given watermark.
+
+    Only results of inferences older than the given age are returned: newer ones can
+    still receive a label from the user.
+
+    :param db:
+        Session with the connection to the database.
+    :param watermark:
+        Only results with a result_id greater than this value are used.
+    :param limit:
+        Maximum number of records to read.
+    :param min_age:
+        Minimum age of the inference of a result.
+    """
+    LOGGER.debug(f"Getting labelled data since watermark={watermark} limit={limit}")
+
+    query = (
+        db.query(Result, Location, User)
+        .filter(Result.shown)
+        .filter(Result.result_id > watermark)
+        .join(Inference, Result.inference_id == Inference.inference_id)
+        .filter(Inference.time_creation < datetime.now() - min_age)
+        .join(Location, Result.location_id == Location.location_id)
+        .join(User, Result.user_id == User.user_id)
+        .order_by(Result.result_id.asc())
+        .limit(limit)
+    )
+
+    bind = db.bind
+
+    if bind is None:
+        LOGGER.error("Database not available!")
+        raise ValueError("Database not available!")
+
+    return pd.read_sql(query.statement, bind)
+
+
+def iter_dataset(
+    db: Session,
+    size: int,
+    watermark: int,
+    chunk_size: int = 10_000,
+    offset: int = 0,
+    columns: list[str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    """Reads a dataset in chunks, without loading it all in memory.
+
+    Rows are streamed with a server-side cursor on a dedicated connection. Use the
+    `register_dataset_query` function to store the results used in the dataset.
+
+    :param db:
+        Session with the connection to the database.
+    :param size:
+        Size of the dataset.
+    :param watermark:
+        Only results with a result_id lower or equal to this value are used, so that
+        multiple reads return the same data.
+    :param chunk_size:
+        Number of records in each chunk.
+    :param offset:
+        Number of newest records to skip.
+    :param columns:
+        If set, only these columns are returned.
+    """
+    LOGGER.debug(
+        f"Streaming dataset with size={size} watermark={watermark} offset={offset}"
     )
 
-    if db_result is None:
-        LOGGER.warning(
-            f"Result not found for task_id={task_id} and location_id={location_id}"
-        )
-        return None
+    query = _dataset_query(db, size, watermark, offset)
 
-    db_result.label = 1
-    db.commit()
-    db.refresh(db_result)
+    bind = db.bind
 
-    return db_result
+    if bind is None:
+        LOGGER.error("Database not available!")
+        raise ValueError("Database not available!")
 
+    with cast(Engine, bind).connect() as conn:
+        conn = conn.execution_options(stream_results=True)
 
-def create_dataset(db: Session, task_id: str, size: int) -> pd.DataFrame:
-    """Creates a dataset in Pandas' DataFrame forma from the data shown to the users and stored in the database.
+        for chunk in pd.read_sql(query.statement, conn, chunksize=chunk_size):
+            yield chunk if columns is None else chunk[columns]
 
-    Only the newer data will be returned.
+
+def register_dataset_query(
+    db: Session, task_id: str, size: int, watermark: int
+) -> None:
+    """Stores the results used as dataset by a training task, directly in the database.
+
+    Same results as `iter_dataset` with the same size and watermark.
 
     :param db:
         Session with the connection to the database.
@@ -261,36 +1256,60 @@ def create_dataset(db: Session, task_id: str, size: int) -> pd.DataFrame:
         Id of the training task to be used as id of the dataset.
     :param size:
         Size of the dataset.
+    :param watermark:
+        Only results with a result_id lower or equal to this value are used.
     """
-    LOGGER.debug(f"Creating dataset for task_id={task_id} with size={size}")
+    LOGGER.debug(f"Registering dataset for task_id={task_id} with size={size}")
 
-    query = (
-        db.query(Result, Location, User)
-        .filter(Result.shown)
+    model_id = get_model(db, task_id).model_id
+
+    ids = (
+        select(
+            literal(model_id).label("model_id"),
+            Result.result_id,
+            func.now().label("time_creation"),
+        )
+        .where(Result.shown)
+        .where(Result.result_id <= watermark)
         .order_by(Result.result_id.desc())
-        .join(Location, Result.location_id == Location.location_id)
-        .join(User, Result.user_id == User.user_id)
         .limit(size)
     )
 
-    bind = db.bind
+    db.execute(
+        insert(Dataset).from_select(["model_id", "result_id", "time_creation"], ids)
+    )
+    db.commit()
 
-    if bind is None:
-        LOGGER.error("Database not available!")
-        raise ValueError("Database not available!")
 
-    df = pd.read_sql(query.statement, bind)
+def register_dataset(db: Session, task_id: str, result_ids: np.ndarray) -> None:
+    """Stores the list of results used as dataset by a training task.
 
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task to be used as id of the dataset.
+    :param result_ids:
+        Ids of the results in the dataset.
+    """
+    LOGGER.debug(
+        f"Registering dataset for task_id={task_id} with {len(result_ids)} results"
+    )
+
+    if len(result_ids) == 0:
+        return
+
+    model_id = get_model(db, task_id).model_id
     now = datetime.now()
 
-    for _, row in df[["result_id"]].iterrows():
-        db.add(
-            Dataset(task_id=task_id, result_id=int(row["result_id"]), time_creation=now)
-        )
+    db.execute(
+        insert(Dataset),
+        [
+            {"model_id": model_id, "result_id": int(result_id), "time_creation": now}
+            for result_id in result_ids
+        ],
+    )
     db.commit()
 
-    return df
-
 
 def create_model(
     db: Session,
@@ -317,6 +1336,7 @@ def create_model(
     )
     args = {
         "task_id": task_id,
+        "model_id": _next_id(db, Model.model_id, MODEL_ID_SEQ),
         "use_percentage": use_percentage,
         "path": path,
         "status": status,
@@ -382,6 +1402,23 @@ def update_model(
     db.commit()
 
 
+def get_model(db: Session, task_id: str) -> Model:
+    """Return the model with the given task_id.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task of the model.
+    """
+    r = db.query(Model).filter(Model.task_id == task_id).first()
+
+    if r is None:
+        LOGGER.error(f"Model with task_id {task_id} not found!")
+        raise ValueError(f"Model with task_id {task_id} not found!")
+
+    return r
+
+
 def get_active_model(db: Session) -> Model:
     """Return the current active model.
 
@@ -401,6 +1438,64 @@ def get_active_model(db: Session) -> Model:
     return r
 
 
+def get_candidate_model(db: Session) -> Model | None:
+    """Return the most recent trained model that is not active, if any.
+
+    Candidate models can score the inference requests in shadow mode.
+
+    :param db:
+        Session with the connection to the database.
+    """
+    return (
+        db.query(Model)
+        .filter(Model.status == "SUCCESS")
+        .filter(Model.use_percentage == 0)
+        .order_by(Model.time_creation.desc())
+        .first()
+    )
+
+
+def set_active_model(db: Session, task_id: str) -> Model:
+    """Make the given model the only active one.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the model to activate.
+    """
+    db_model = db.query(Model).filter(Model.task_id == task_id).first()
+
+    if db_model is None or db_model.status != "SUCCESS":
+        LOGGER.error(f"Model with task_id {task_id} not found or not trained!")
+        raise ValueError(f"Model with task_id {task_id} not found or not trained!")
+
+    LOGGER.debug(f"Activating model task_id={task_id}")
+
+    db.query(Model).filter(Model.task_id != task_id).update({Model.use_percentage: 0.0})
+    db_model.use_percentage = 1.0
+
+    db.commit()
+    db.refresh(db_model)
+
+    return db_model
+
+
+def count_models_in_progress(db: Session, max_age: timedelta) -> int:
+    """Counts the models scheduled or in training, created in the given time.
+
+    :param db:
+        Session with the connection to the database.
+    :param max_age:
+        Older models are ignored, as their task has been lost.
+    """
+    return (
+        db.query(Model)
+        .filter(Model.status.in_(["PENDING", "SETUP", "TRAINING"]))
+        .filter(Model.time_creation > datetime.now() - max_age)
+        .count()
+    )
+
+
 def count_models(db: Session) -> int:
     """Counts the number of available models."""
     return db.query(Model).count()
@@ -424,6 +1519,120 @@ def create_event(db: Session, event: str) -> Event:
     return db_event
 
 
+def upsert_event_counts(db: Session, counts: dict[tuple[datetime, str], int]) -> None:
+    """Add the given counts to the counts of the events already in the database.
+
+    :param db:
+        Session with the connection to the database.
+    :param counts:
+        Number of events for each pair of time bucket and event.
+    """
+    if not counts:
+        return
+
+    LOGGER.debug(f"Adding counts for {len(counts)} event buckets")
+
+    values = [
+        {"time_bucket": bucket, "event": event, "count": count}
+        for (bucket, event), count in counts.items()
+    ]
+
+    stmt: postgresql.Insert | sqlite.Insert
+
+    if db.get_bind().dialect.name == "postgresql":
+        stmt = postgresql.insert(EventCount).values(values)
+    else:
+        stmt = sqlite.insert(EventCount).values(values)
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[EventCount.time_bucket, EventCount.event],
+        set_={"count": EventCount.count + stmt.excluded.count},
+    )
+
+    db.execute(stmt)
+    db.commit()
+
+
+def get_event_counts(
+    db: Session,
+    since: datetime,
+    until: datetime | None = None,
+    events: list[str] | None = None,
+    bucket: timedelta = timedelta(minutes=1),
+) -> list[dict]:
+    """Get the number of events in the given time interval.
+
+    :param db:
+        Session with the connection to the database.
+    :param since:
+        Begin of the interval.
+    :param until:
+        End of the interval, excluded (default: None, no end).
+    :param events:
+        If set, only these events are returned.
+    :param bucket:
+        Width of the buckets, multiple of one minute (default: one minute).
+
+    :return:
+        A list with the begin of the bucket, the event, and its count.
+    """
+    query = db.query(EventCount).filter(EventCount.time_bucket >= since)
+
+    if until is not None:
+        query = query.filter(EventCount.time_bucket < until)
+    if events:
+        query = query.filter(EventCount.event.in_(events))
+
+    width = max(int(bucket.total_seconds() // 60), 1)
+
+    counts: dict[tuple[datetime, str], int] = dict()
+    for ec in query.order_by(EventCount.time_bucket).all():
+        minutes = int(ec.time_bucket.timestamp() // 60)
+        begin = datetime.fromtimestamp(
+            (minutes - minutes % width) * 60, tz=ec.time_bucket.tzinfo
+        )
+        counts[begin, ec.event] = counts.get((begin, ec.event), 0) + ec.count
+
+    return [
+        {"time_bucket": begin, "event": event, "count": count}
+        for (begin, event), count in counts.items()
+    ]
+
+
+def sum_event_counts(db: Session, since: datetime, events: list[str]) -> dict[str, int]:
+    """Returns the total number of each of the given events since the given time.
+
+    Events never counted in the interval are returned with a count of zero.
+    """
+    rows = db.execute(
+        select(EventCount.event, func.sum(EventCount.count))
+        .where(EventCount.time_bucket >= since)
+        .where(EventCount.event.in_(events))
+        .group_by(EventCount.event)
+    ).all()
+
+    return {event: 0 for event in events} | {e: int(n or 0) for e, n in rows}
+
+
+def delete_events_before(db: Session, time: datetime) -> int:
+    """Delete the raw events older than the given time.
+
+    :param db:
+        Session with the connection to the database.
+    :param time:
+        Events registered before this time are deleted.
+
+    :return:
+        The number of deleted events.
+    """
+    n = db.query(Event).filter(Event.time_event < time).delete()
+    db.commit()
+
+    LOGGER.debug(f"Deleted {n} events before {time}")
+
+    return n
+
+
 def get_location(db: Session, id: int) -> Location:
     """Fetch a location by its ID."""
     r = db.query(Location).filter(Location.location_id == id).first()
@@ -435,6 +1644,47 @@ def get_location(db: Session, id: int) -> Location:
     return r
 
 
+def read_locations(
+    db: Session, columns: list[str] | None = None, ids: list[int] | None = None
+) -> pd.DataFrame:
+    """Reads all the locations in a DataFrame, ordered by location_id.
+
+    :param db:
+        Session with the connection to the database.
+    :param columns:
+        If set, only the location_id and these columns are read. Names that are not
+        fields of the locations are ignored.
+    :param ids:
+        If set, only the locations with these ids are read.
+    """
+    query = select(*_projection(Location, columns, "location_id")).order_by(
+        Location.location_id
+    )
+
+    if ids is not None:
+        query = query.where(Location.location_id.in_(ids))
+
+    return _frame(db, query)
+
+
+def get_locations_rows(
+    db: Session, limit: int = 0, ids: list[int] | None = None
+) -> list[dict]:
+    """Get all the locations available, as dictionaries.
+
+    Can be limited to the first locations, or to the locations with the given ids.
+    """
+    query = select(Location.__table__).order_by(Location.location_id)
+
+    if ids is not None:
+        query = query.where(Location.location_id.in_(ids))
+
+    if limit > 0:
+        query = query.limit(limit)
+
+    return _rows(db, query)
+
+
 def get_locations(db: Session, limit: int = 0) -> list[Location]:
     """Get all the locations available.
 
@@ -446,6 +1696,237 @@ def get_locations(db: Session, limit: int = 0) -> list[Location]:
     return db.query(Location).all()
 
 
+def _existing_location_ids(db: Session, ids: list[int]) -> set[int]:
+    """Ids among the given ones of the locations already stored."""
+    existing: set[int] = set()
+
+    # bounded lists, SQLite limits the number of parameters of a statement
+    for i in range(0, len(ids), 10000):
+        existing.update(
+            db.execute(
+                select(Location.location_id).where(
+                    Location.location_id.in_(ids[i : i + 10000])
+                )
+            ).scalars()
+        )
+
+    return existing
+
+
+def upsert_locations(db: Session, df: pd.DataFrame, commit: bool = True) -> int:
+    """Insert new locations or update the existing ones with the same location_id.
+
+    Existing locations are updated only in the given fields, new locations must have
+    all the fields without a default. If a location_id is repeated, the last record is
+    used.
+
+    :param db:
+        Session with the connection to the database.
+    :param df:
+        DataFrame with a `location_id` column and a column for each field to set.
+    :param commit:
+        If False, the changes are left in the current transaction.
+
+    :return:
+        The number of inserted or updated locations.
+    """
+    if df.shape[0] == 0:
+        return 0
+
+    df = df.drop_duplicates("location_id", keep="last")
+
+    values = df.to_dict(orient="records")
+    existing = _existing_location_ids(db, df["location_id"].astype(int).tolist())
+
+    # an upsert checks the fields of the new row even if it updates an existing one
+    updates = [v for v in values if v["location_id"] in existing]
+    inserts = [v for v in values if v["location_id"] not in existing]
+
+    if updates and df.shape[1] > 1:
+        db.execute(update(Location), updates)
+
+    if inserts:
+        db.execute(insert(Location), inserts)
+
+    if db.get_bind().dialect.name == "postgresql":
+        # ids are explicit: the sequence must continue after the highest one
+        db.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('locations', 'location_id'), "
+                "(SELECT max(location_id) FROM locations))"
+            )
+        )
+    else:
+        # on PostgreSQL, the version is increased by a trigger
+        bump_catalog_version(db, "locations")
+
+    if commit:
+        db.commit()
+
+    LOGGER.debug(f"Upserted {len(values)} locations")
+
+    return len(values)
+
+
+def get_catalog_checksum(db: Session, name: str) -> str | None:
+    """Returns the checksum of the last file loaded with the given name, if any."""
+    checksum: str | None = (
+        db.query(CatalogSource.checksum).filter(CatalogSource.name == name).scalar()
+    )
+    return checksum
+
+
+def set_catalog_checksum(db: Session, name: str, checksum: str, records: int) -> None:
+    """Store the checksum of a file loaded in the catalog.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the loaded file.
+    :param checksum:
+        Checksum of the content of the file.
+    :param records:
+        Number of records loaded from the file.
+    """
+    db.merge(CatalogSource(name=name, checksum=checksum, records=records))
+    db.commit()
+
+
+def get_catalog_version(db: Session, name: str) -> int:
+    """Returns the current version of a catalog table, 0 if never changed."""
+    return (
+        db.query(CatalogVersion.version).filter(CatalogVersion.name == name).scalar()
+        or 0
+    )
+
+
+def get_catalog_stamp(db: Session, name: str) -> tuple[int, datetime | None]:
+    """Returns the current version of a catalog table and the time it was set.
+
+    The time distinguishes equal versions of different databases, i.e. after the
+    database has been recreated.
+    """
+    row = (
+        db.query(CatalogVersion.version, CatalogVersion.time_update)
+        .filter(CatalogVersion.name == name)
+        .first()
+    )
+
+    if row is None:
+        return 0, None
+
+    return row[0], row[1]
+
+
+def bump_catalog_version(db: Session, name: str) -> None:
+    """Increase the version of a catalog table, without a commit.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the changed table.
+    """
+    stmt: postgresql.Insert | sqlite.Insert
+
+    if db.get_bind().dialect.name == "postgresql":
+        stmt = postgresql.insert(CatalogVersion)
+    else:
+        stmt = sqlite.insert(CatalogVersion)
+
+    stmt = stmt.values(name=name, version=1).on_conflict_do_update(
+        index_elements=[CatalogVersion.name],
+        set_={"version": CatalogVersion.version + 1, "time_update": func.now()},
+    )
+
+    db.execute(stmt)
+
+
+def log_catalog_changes(
+    db: Session, name: str, previous: int, version: int, ids: list[int]
+) -> None:
+    """Log the records changed by an update of a catalog table, without a commit.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the changed table.
+    :param previous:
+        Version of the table before the update.
+    :param version:
+        Version of the table after the update.
+    :param ids:
+        Primary keys of the changed records.
+    """
+    if not ids:
+        return
+
+    db.execute(
+        insert(CatalogChange),
+        [
+            {"name": name, "version": version, "previous": previous, "record_id": i}
+            for i in set(ids)
+        ],
+    )
+
+
+def get_catalog_changes(
+    db: Session, name: str, since: int, until: int
+) -> list[int] | None:
+    """Returns the records of a catalog table changed between two versions.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the table.
+    :param since:
+        Version of the table known by the caller.
+    :param until:
+        Current version of the table.
+
+    :return:
+        The primary keys of the changed records, or None if some of the updates between
+        the two versions have not been logged.
+    """
+    rows = db.execute(
+        select(CatalogChange.previous, CatalogChange.version, CatalogChange.record_id)
+        .where(CatalogChange.name == name)
+        .where(CatalogChange.previous >= since)
+        .where(CatalogChange.version <= until)
+    ).all()
+
+    # the logged updates must cover all the versions from since to until
+    version = since
+    for previous, next_version in sorted({(r.previous, r.version) for r in rows}):
+        if previous != version:
+            return None
+        version = next_version
+
+    if version != until:
+        return None
+
+    return sorted({r.record_id for r in rows})
+
+
+def delete_catalog_changes_before(db: Session, name: str, version: int) -> int:
+    """Delete the logged updates of a catalog table before a version, without a commit.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the table.
+    :param version:
+        Updates that ended before this version are deleted.
+
+    :return:
+        The number of deleted records.
+    """
+    return (
+        db.query(CatalogChange)
+        .filter(CatalogChange.name == name, CatalogChange.version < version)
+        .delete(synchronize_session=False)
+    )
+
+
 def count_locations(db: Session) -> int:
     """Returns the number of locations available."""
     return db.query(Location).count()
@@ -462,6 +1943,49 @@ def get_user(db: Session, id: int) -> User:
     return r
 
 
+def read_user(db: Session, id: int, columns: list[str] | None = None) -> dict:
+    """Reads the user with the given ID as a dictionary.
+
+    :param db:
+        Session with the connection to the database.
+    :param id:
+        ID of the user.
+    :param columns:
+        If set, only the user_id and these columns are read. Names that are not fields
+        of the users are ignored.
+    """
+    query = select(*_projection(User, columns, "user_id")).where(User.user_id == id)
+    r = db.execute(query).mappings().first()
+
+    if r is None:
+        LOGGER.debug(f"User with id {id} not found!")
+        raise ValueError(f"User with id {id} not found!")
+
+    return dict(r)
+
+
+def read_sample_users(
+    db: Session, n: int, columns: list[str] | None = None
+) -> pd.DataFrame:
+    """Reads up to n users chosen at random in a DataFrame.
+
+    :param db:
+        Session with the connection to the database.
+    :param n:
+        Number of users.
+    :param columns:
+        If set, only the user_id and these columns are read. Names that are not fields
+        of the users are ignored.
+    """
+    query = select(*_projection(User, columns, "user_id")).order_by(func.random())
+    return _frame(db, query.limit(n))
+
+
+def get_users_rows(db: Session) -> list[dict]:
+    """Returns all users, as dictionaries."""
+    return _rows(db, select(User.__table__).order_by(User.user_id))
+
+
 def get_users(db: Session) -> list[User]:
     """Returns all users."""
     return db.query(User).all()
@@ -470,3 +1994,41 @@ def get_users(db: Session) -> list[User]:
 def count_users(db: Session) -> int:
     """Returns the number of all the users available."""
     return db.query(User).count()
+
+
+def get_content_counters(db: Session, names: list[str]) -> dict[str, int]:
+    """Returns the number of rows of the given tables, as maintained by the triggers.
+
+    Tables without a counter are missing in the output.
+    """
+    rows = db.execute(
+        select(ContentCounter.name, ContentCounter.value).where(
+            ContentCounter.name.in_(names)
+        )
+    ).all()
+
+    return {name: value for name, value in rows}
+
+
+def estimate_rows(db: Session, table: str) -> int | None:
+    """Returns the number of rows of a table estimated by the PostgreSQL planner.
+
+    The estimate is updated by VACUUM and ANALYZE, including the automatic ones, and
+    sums all the partitions of the table.
+
+    :return:
+        The estimated number of rows, None if the table has never been analyzed.
+    """
+    estimate, missing = db.execute(
+        text(
+            "SELECT sum(GREATEST(c.reltuples, 0)), bool_or(c.reltuples < 0) "
+            "FROM pg_partition_tree(CAST(:table AS regclass)) p "
+            "JOIN pg_class c ON c.oid = p.relid WHERE p.isleaf"
+        ),
+        {"table": table},
+    ).one()
+
+    if missing or estimate is None:
+        return None
+
+    return int(estimate)
@@ -1,26 +1,105 @@
 from __future__ import annotations
-from typing import Any, Generator
+from time import monotonic
+from typing import Any, ClassVar, Generator
 
-from sqlalchemy.engine import Engine, create_engine, URL
+from sqlalchemy.engine import Connection, Engine, create_engine, URL
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, sessionmaker
 
+from .telemetry import InstrumentedQueuePool, instrument_engine, instrument_queries
+
 import logging
 import os
 
 LOGGER = logging.getLogger("mlprod.database")
 
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
+# optional read-only replica, used by the endpoints that only read data
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL", "")
+# seconds during which reads go to the primary after the replica could not be reached
+DATABASE_READ_RETRY = float(os.environ.get("DATABASE_READ_RETRY", "30"))
+
+# number of connections kept open in the pool of each process
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "5"))
+# number of connections that can be opened above the size of the pool
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", "10"))
+# seconds to wait for a connection before giving up
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "30"))
+# connections older than this (in seconds) are replaced, -1 to disable
+DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", "1800"))
+# test connections before using them
+DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "true") == "true"
+# drop the connections inherited from the parent in forked processes
+DATABASE_DISPOSE_AFTER_FORK = (
+    os.environ.get("DATABASE_DISPOSE_AFTER_FORK", "true") == "true"
+)
+
+
+def engine_options(database_url: URL | str, name: str = "primary") -> dict[str, Any]:
+    """Options of the engine for the given database, from the environment variables.
+
+    :param database_url:
+        Url of the database.
+    :param name:
+        Name of the pool, used as label of its metrics.
+    """
+    if str(database_url).startswith("sqlite"):
+        # SQLite uses its own pools, without sizing
+        return {"pool_pre_ping": DATABASE_POOL_PRE_PING}
+
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DATABASE_POOL_SIZE,
+        "max_overflow": DATABASE_MAX_OVERFLOW,
+        "pool_timeout": DATABASE_POOL_TIMEOUT,
+        "pool_recycle": DATABASE_POOL_RECYCLE,
+        "pool_pre_ping": DATABASE_POOL_PRE_PING,
+        "pool_logging_name": name,
+    }
+
+
+class _ReplicaSession(Session):
+    """Session on the replica, moved to the primary if the replica cannot be reached.
+
+    Only the first connection of the session is moved: the replica is not reached until
+    a statement is executed, without probing it when the session is created.
+    """
+
+    def _connection_for_bind(
+        self,
+        engine: Engine | Connection,
+        execution_options: Any = None,
+        **kw: Any,
+    ) -> Connection:
+        try:
+            return super()._connection_for_bind(engine, execution_options, **kw)
+        except OperationalError as e:
+            db = DataBase()
+
+            if engine is not db.read_engine:
+                raise
+
+            db.replica_failed(e)
+
+            self.rollback()
+            self.bind = db.engine
+            return super()._connection_for_bind(db.engine, execution_options, **kw)
 
 
 class DataBase:
     """Singleton class to manage the connection to the database."""
 
+    instance: ClassVar[DataBase]
+
     def __init__(self) -> None:
         """Initialize the database connection parameters."""
         self.database_url: URL | str | None
         self.engine: Engine
         self.session_factory: Any
-        self.sync_session: Any
+        self.sync_session: sessionmaker[Session]
+        self.read_engine: Engine | None
+        self.read_session_factory: sessionmaker[Session]
+        self.read_retry_at: float
 
     def __new__(cls) -> DataBase:
         """Create a singleton instance of the DataBase class."""
@@ -33,7 +112,13 @@ class DataBase:
             if cls.instance.database_url is None:
                 raise ValueError("Connection to database is not set!")
 
-            cls.instance.engine = create_engine(cls.instance.database_url)
+            cls.instance.engine = create_engine(
+                cls.instance.database_url,
+                **engine_options(cls.instance.database_url),
+            )
+            instrument_engine(cls.instance.engine)
+            instrument_queries(cls.instance.engine)
+
             cls.instance.sync_session = sessionmaker(
                 bind=cls.instance.engine,
                 class_=Session,
@@ -42,17 +127,89 @@ class DataBase:
                 autoflush=False,
             )
 
+            # without a replica, reads go to the primary
+            cls.instance.read_engine = None
+            cls.instance.read_session_factory = cls.instance.sync_session
+            cls.instance.read_retry_at = 0.0
+
+            if DATABASE_READ_URL:
+                cls.instance.read_engine = create_engine(
+                    DATABASE_READ_URL,
+                    **engine_options(DATABASE_READ_URL, "replica"),
+                )
+                instrument_engine(cls.instance.read_engine)
+                instrument_queries(cls.instance.read_engine)
+                cls.instance.read_session_factory = sessionmaker(
+                    bind=cls.instance.read_engine,
+                    class_=_ReplicaSession,
+                    expire_on_commit=False,
+                    autocommit=False,
+                    autoflush=False,
+                )
+
+                LOGGER.info("read replica configured")
+
+            if DATABASE_DISPOSE_AFTER_FORK:
+                os.register_at_fork(after_in_child=cls.instance.dispose_after_fork)
+
             LOGGER.info("dataBase connection established")
 
         return cls.instance
 
+    def dispose_after_fork(self) -> None:
+        """Replace the pool in a forked process, without closing the parent's connections.
+
+        Connections are not safe to share between processes: each process (i.e. the
+        prefork Celery children) opens its own.
+        """
+        self.engine.dispose(close=False)
+
+        if self.read_engine is not None:
+            self.read_engine.dispose(close=False)
+
     def session(self) -> Session:
         """Create a new session to interact with the database."""
         return self.sync_session()
 
+    def read_session(self) -> Session:
+        """Create a new session to read from the replica.
+
+        If no replica is configured, or the replica cannot be reached by the first
+        statement of the session, the session reads from the primary. Data just written
+        to the primary can still be missing on the replica: use `is_replica` to check
+        where the session reads from, after its first statement.
+
+        After the replica could not be reached, it is not tried again for
+        DATABASE_READ_RETRY seconds, so the requests do not wait for a connection
+        timeout each time.
+        """
+        if self.read_engine is None or monotonic() < self.read_retry_at:
+            return self.session()
+
+        return self.read_session_factory()
+
+    def replica_failed(self, e: OperationalError) -> None:
+        """Send the reads to the primary for DATABASE_READ_RETRY seconds."""
+        self.read_retry_at = monotonic() + DATABASE_READ_RETRY
+        LOGGER.warning(
+            f"read replica not available, using primary for "
+            f"{DATABASE_READ_RETRY:.0f}s: {e.orig}"
+        )
+
+    def is_replica(self, session: Session) -> bool:
+        """Returns True if the given session reads from the replica."""
+        return self.read_engine is not None and session.get_bind() is self.read_engine
+
 
 def get_session() -> Generator[Session, None, None]:
     """This is a generator for obtain the session to the database through SQLAlchemy."""
     db = DataBase()
     with db.session() as session:
         yield session
+
+
+def get_read_session() -> Generator[Session, None, None]:
+    """This is a generator for obtain a read-only session, on the replica if available."""
+    db = DataBase()
+    with db.read_session() as session:
+        yield session
@@ -0,0 +1,142 @@
+"""Counters of the events generated by the application.
+
+Events are counted in memory in buckets of one minute, and the counts are added to the
+`event_counts` table at most every EVENTS_FLUSH_INTERVAL seconds. A background thread
+of each process writes the counts left in memory when no new event arrives, and the
+remaining counts are written when the process exits. Storing each event as a row in
+the `events` table is optional.
+"""
+
+from datetime import datetime, timezone
+from sqlalchemy.orm import Session
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from . import crud
+from .database import DataBase
+
+import atexit
+import logging
+import os
+
+LOGGER = logging.getLogger("mlprod.database.events")
+
+# seconds between two writes of the counts to the database, 0 to write on each event
+# (only meant for tests)
+EVENTS_FLUSH_INTERVAL = float(os.environ.get("EVENTS_FLUSH_INTERVAL", "5"))
+# also store each event in the events table
+EVENTS_RAW = os.environ.get("EVENTS_RAW", "false") == "true"
+# days after which raw events are deleted, 0 to keep them forever
+EVENTS_TTL_DAYS = float(os.environ.get("EVENTS_TTL_DAYS", "7"))
+
+_lock = Lock()
+_counts: dict[tuple[datetime, str], int] = dict()
+_last_flush: float = monotonic()
+# process that started the background flush, threads do not survive a fork
+_flusher_pid: int = 0
+
+
+def _bucket(time: datetime) -> datetime:
+    """Begin of the bucket of one minute of the given time."""
+    return time.replace(second=0, microsecond=0)
+
+
+def record_event(db: Session, event: str, n: int = 1) -> None:
+    """Count new events.
+
+    :param db:
+        Session with the connection to the database, used when the counts are written.
+    :param event:
+        Event to be counted. Technically, it is a string field, avoid typos and put
+        single words.
+    :param n:
+        Number of events to count.
+    """
+    key = _bucket(datetime.now(timezone.utc)), event
+
+    _start_flusher()
+
+    with _lock:
+        _counts[key] = _counts.get(key, 0) + n
+        flush = monotonic() - _last_flush >= EVENTS_FLUSH_INTERVAL
+
+    if EVENTS_RAW:
+        for _ in range(n):
+            crud.create_event(db, event)
+
+    if flush:
+        flush_events(db)
+
+
+def flush_events(db: Session) -> None:
+    """Write the counted events to the database.
+
+    :param db:
+        Session with the connection to the database.
+    """
+    global _counts, _last_flush
+
+    with _lock:
+        counts, _counts = _counts, dict()
+        _last_flush = monotonic()
+
+    try:
+        crud.upsert_event_counts(db, counts)
+
+    except Exception as e:
+        # counts are kept for the next flush
+        LOGGER.error(f"Could not write the counts of {len(counts)} event buckets")
+        LOGGER.exception(e)
+        db.rollback()
+
+        with _lock:
+            for key, count in counts.items():
+                _counts[key] = _counts.get(key, 0) + count
+
+
+def _flush_pending() -> None:
+    """Write the counts still in memory with a new session, if any."""
+    if not _counts:
+        return
+
+    try:
+        with DataBase().session() as session:
+            flush_events(session)
+    except Exception as e:
+        LOGGER.error(f"Could not write the pending event counts: {e}")
+
+
+def _flush_periodically() -> None:
+    """Write the counts left in memory every EVENTS_FLUSH_INTERVAL seconds."""
+    while True:
+        sleep(EVENTS_FLUSH_INTERVAL)
+
+        if monotonic() - _last_flush >= EVENTS_FLUSH_INTERVAL:
+            _flush_pending()
+
+
+def _start_flusher() -> None:
+    """Start the background flush of the current process, if the counts are buffered."""
+    global _flusher_pid
+
+    if EVENTS_FLUSH_INTERVAL <= 0 or _flusher_pid == os.getpid():
+        return
+
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    Thread(target=_flush_periodically, name="events-flush", daemon=True).start()
+
+
+def _reset_after_fork() -> None:
+    """Drop the counts inherited from the parent, they are written by the parent."""
+    global _lock, _counts
+
+    _lock = Lock()
+    _counts = dict()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(_flush_pending)
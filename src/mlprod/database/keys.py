@@ -0,0 +1,129 @@
+"""Integer ids used as keys in place of the Celery task ids.
+
+Inferences and models are found by the id of their Celery task, a UUID stored as a
+string. The largest tables refer to them with compact integer ids instead: the results
+by `inference_id` and the datasets by `model_id`, both generated by a sequence. This
+makes rows, indexes, and joins smaller.
+
+Existing databases are converted by `surrogate_keys`, on PostgreSQL only. The indexes on
+the new ids are built by a later migration, concurrently. The space of the dropped
+columns is reclaimed when the rows are rewritten, i.e. by a VACUUM FULL.
+"""
+
+from sqlalchemy import Connection, Sequence, inspect, text
+
+from .tables import INFERENCE_ID_SEQ, MODEL_ID_SEQ
+
+import logging
+
+LOGGER = logging.getLogger("mlprod.database.keys")
+
+
+def _columns(conn: Connection, table: str) -> set[str]:
+    """Names of the columns of a table."""
+    return {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+def _add_id(
+    conn: Connection, table: str, column: str, sequence: Sequence, sql_type: str
+) -> None:
+    """Add a column to a table, filled with the values of a sequence."""
+    sequence.create(conn, checkfirst=True)
+
+    conn.execute(
+        text(
+            f"ALTER TABLE {table} ADD COLUMN {column} {sql_type} NOT NULL "
+            f"DEFAULT nextval('{sequence.name}')"
+        )
+    )
+    # new rows get their id from the application, as for a new database
+    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT"))
+
+
+def _replace_task_id(
+    conn: Connection, table: str, column: str, parent: str, sql_type: str
+) -> int:
+    """Replace the task_id column of a table with the integer id of the parent table.
+
+    :return:
+        The number of rows without a parent, left with a null id.
+    """
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}"))
+    conn.execute(
+        text(
+            f"UPDATE {table} t SET {column} = p.{column} FROM {parent} p "
+            "WHERE p.task_id = t.task_id"
+        )
+    )
+
+    orphans = conn.execute(
+        text(f"SELECT count(*) FROM {table} WHERE {column} IS NULL")
+    ).scalar()
+
+    # indexes and constraints on the task_id are dropped with it
+    conn.execute(text(f"ALTER TABLE {table} DROP COLUMN task_id"))
+
+    return orphans or 0
+
+
+def surrogate_keys(conn: Connection) -> None:
+    """Convert the results and datasets tables to refer to inferences and models by id.
+
+    Tables already converted are left untouched.
+
+    :param conn:
+        Connection to the database, inside a transaction.
+    """
+    if "task_id" not in _columns(conn, "results") | _columns(conn, "datasets"):
+        return
+
+    if conn.dialect.name != "postgresql":
+        raise RuntimeError(
+            "Task ids can be converted to integer ids only on PostgreSQL, "
+            "recreate the database to use the new schema"
+        )
+
+    if "inference_id" not in _columns(conn, "inferences"):
+        LOGGER.info("adding inference ids to inferences")
+        _add_id(conn, "inferences", "inference_id", INFERENCE_ID_SEQ, "bigint")
+
+    if "model_id" not in _columns(conn, "models"):
+        LOGGER.info("adding model ids to models")
+        _add_id(conn, "models", "model_id", MODEL_ID_SEQ, "integer")
+        conn.execute(
+            text(
+                "ALTER TABLE models ADD CONSTRAINT models_model_id_key UNIQUE (model_id)"
+            )
+        )
+
+    if "task_id" in _columns(conn, "results"):
+        LOGGER.info("replacing task ids with inference ids in results")
+
+        orphans = _replace_task_id(
+            conn, "results", "inference_id", "inferences", "bigint"
+        )
+        if orphans:
+            # results cannot be deleted, they can be part of a dataset
+            LOGGER.warning(f"{orphans} results without inference, set to inference 0")
+            conn.execute(
+                text("UPDATE results SET inference_id = 0 WHERE inference_id IS NULL")
+            )
+
+        conn.execute(text("ALTER TABLE results ALTER COLUMN inference_id SET NOT NULL"))
+
+    if "task_id" in _columns(conn, "datasets"):
+        LOGGER.info("replacing task ids with model ids in datasets")
+
+        orphans = _replace_task_id(conn, "datasets", "model_id", "models", "integer")
+        if orphans:
+            LOGGER.warning(f"{orphans} dataset records without model, deleted")
+            conn.execute(text("DELETE FROM datasets WHERE model_id IS NULL"))
+
+        conn.execute(text("ALTER TABLE datasets ALTER COLUMN model_id SET NOT NULL"))
+        conn.execute(text("ALTER TABLE datasets ADD PRIMARY KEY (model_id, result_id)"))
+        conn.execute(
+            text(
+                "ALTER TABLE datasets ADD CONSTRAINT datasets_model_id_fkey "
+                "FOREIGN KEY (model_id) REFERENCES models (model_id)"
+            )
+        )
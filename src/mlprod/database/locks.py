@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+from time import sleep
+from typing import Generator, cast
+
+from sqlalchemy import Engine, text
+from sqlalchemy.orm import Session
+
+import logging
+import os
+import zlib
+
+LOGGER = logging.getLogger("mlprod.database.locks")
+
+LOCK_TRAINING: str = "training"
+LOCK_MIGRATIONS: str = "migrations"
+LOCK_CONTENT: str = "content"
+
+# seconds between two attempts to acquire a lock when waiting for it
+LOCK_RETRY_INTERVAL = float(os.environ.get("LOCK_RETRY_INTERVAL", "1"))
+
+
+def _lock_key(name: str) -> int:
+    """Stable 32-bit integer key for the given lock name."""
+    return zlib.crc32(name.encode())
+
+
+@contextmanager
+def advisory_lock(
+    db: Session, name: str, wait: bool = False
+) -> Generator[bool, None, None]:
+    """Acquire a lock shared by all the processes connected to the database.
+
+    On PostgreSQL a session-level advisory lock is used, held by a dedicated connection
+    for the whole duration of the context, so the given session can commit freely. On
+    other databases, locking is not available and the lock is always acquired.
+
+    When waiting, the lock is polled instead of blocking in `pg_advisory_lock`: a waiting
+    statement holds a snapshot, and a CREATE INDEX CONCURRENTLY run by the holder of the
+    lock would wait for it to end.
+
+    :param db:
+        Session with the connection to the database.
+    :param name:
+        Name of the lock.
+    :param wait:
+        If True, wait until the lock is available, otherwise give up immediately.
+
+    :return:
+        A context that yields True if the lock has been acquired.
+    """
+    bind = db.get_bind()
+
+    if bind.dialect.name != "postgresql":
+        yield True
+        return
+
+    key = _lock_key(name)
+
+    engine = cast(Engine, bind)
+
+    # no transaction is left open on the connection while the lock is held
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        query = text("SELECT pg_try_advisory_lock(:key)")
+        acquired = bool(conn.execute(query, {"key": key}).scalar())
+
+        while wait and not acquired:
+            sleep(LOCK_RETRY_INTERVAL)
+            acquired = bool(conn.execute(query, {"key": key}).scalar())
+
+        LOGGER.debug(f"lock {name} acquired={acquired}")
+
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
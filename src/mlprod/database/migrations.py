@@ -0,0 +1,357 @@
+"""Versioned changes to the schema of an existing database.
+
+`Base.metadata.create_all` creates the missing tables, but it does not change the tables
+that already exist. Each migration is a function that receives a connection inside a
+transaction and applies one change. Migrations are applied in order of version and
+recorded in the `schema_versions` table, so each one runs only once.
+
+Migrations must be idempotent: on a new database, the tables are created with the
+latest schema before the migrations run.
+
+Migrations that only build indexes run outside of a transaction on PostgreSQL, so the
+indexes are built concurrently, without blocking the writes to a live database.
+"""
+
+from sqlalchemy import Connection, Engine, Index, Table, insert, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+from typing import Callable, cast
+
+from .keys import surrogate_keys
+from .locks import advisory_lock, LOCK_MIGRATIONS
+from .partitions import is_partitioned, partition_legacy_tables
+from .tables import Base, ContentCounter, Event, Inference, Result, SchemaVersion
+
+import logging
+import re
+
+LOGGER = logging.getLogger("mlprod.database.migrations")
+
+Migration = Callable[[Connection], None]
+
+# migrations that run outside of a transaction on PostgreSQL
+_NON_TRANSACTIONAL: set[Migration] = set()
+
+
+def _drop_invalid_index(conn: Connection, name: str) -> None:
+    """Drop an index left invalid by an interrupted concurrent build."""
+    invalid = conn.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid)"
+        ),
+        {"name": name},
+    ).scalar()
+
+    if invalid:
+        LOGGER.warning(f"dropping invalid index {name}")
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def _create_index_concurrently(conn: Connection, index: Index) -> None:
+    """Build an index without blocking the writes to its table, on PostgreSQL.
+
+    Indexes of partitioned tables cannot be built concurrently: the index is created on
+    the parent table only, built concurrently on each partition, and then attached.
+
+    :param conn:
+        Connection to the database, in autocommit mode.
+    :param index:
+        Index to create, if it does not exist.
+    """
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+    match = re.match(r"CREATE (UNIQUE )?INDEX IF NOT EXISTS (\S+) ON (\S+) (.*)", ddl)
+
+    if match is None:
+        raise ValueError(f"Unexpected definition of index {index.name}: {ddl}")
+
+    unique, name, table, definition = match.groups()
+    unique = unique or ""
+
+    _drop_invalid_index(conn, name)
+
+    if not is_partitioned(conn, table):
+        LOGGER.info(f"building index {name} concurrently")
+        conn.execute(
+            text(
+                f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                f"ON {table} {definition}"
+            )
+        )
+        return
+
+    conn.execute(
+        text(f"CREATE {unique}INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+    )
+
+    partitions = (
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:table AS regclass)"
+            ),
+            {"table": table},
+        )
+        .scalars()
+        .all()
+    )
+
+    for partition in partitions:
+        # partitions created after the index get their own index automatically
+        attached = conn.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_index x ON x.indexrelid = c.oid "
+                "WHERE i.inhparent = CAST(:name AS regclass) "
+                "AND x.indrelid = CAST(:partition AS regclass))"
+            ),
+            {"name": name, "partition": partition},
+        ).scalar()
+
+        if attached:
+            continue
+
+        child = f"{partition}_{name.removeprefix('ix_')}"[:63]
+
+        LOGGER.info(f"building index {child} concurrently")
+        _drop_invalid_index(conn, child)
+        conn.execute(
+            text(
+                f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {child} "
+                f"ON {partition} {definition}"
+            )
+        )
+        conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {child}"))
+
+
+def _create_indexes(*indexes: Index) -> Migration:
+    """Migration that creates the given indexes, if they do not exist.
+
+    On PostgreSQL the indexes are built concurrently, outside of a transaction.
+    """
+
+    def migration(conn: Connection) -> None:
+        for index in indexes:
+            if conn.dialect.name == "postgresql":
+                _create_index_concurrently(conn, index)
+            else:
+                index.create(conn, checkfirst=True)
+
+    _NON_TRANSACTIONAL.add(migration)
+
+    return migration
+
+
+def _catalog_triggers(*tables: str) -> Migration:
+    """Migration that increases the version of the given tables on each change.
+
+    On databases other than PostgreSQL, the version is increased by the write path.
+    """
+
+    def migration(conn: Connection) -> None:
+        if conn.dialect.name != "postgresql":
+            return
+
+        conn.execute(
+            text(
+                "CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$ "
+                "BEGIN "
+                "INSERT INTO catalog_versions (name, version, time_update) "
+                "VALUES (TG_ARGV[0], 1, now()) "
+                "ON CONFLICT (name) DO UPDATE "
+                "SET version = catalog_versions.version + 1, time_update = now(); "
+                "RETURN NULL; "
+                "END $$ LANGUAGE plpgsql"
+            )
+        )
+
+        for table in tables:
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_version ON {table}"))
+            conn.execute(
+                text(
+                    f"CREATE TRIGGER {table}_version "
+                    f"AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version('{table}')"
+                )
+            )
+
+    return migration
+
+
+def _content_counters(*tables: str) -> Migration:
+    """Migration that counts the rows of the given tables on each insert and delete.
+
+    The counters are filled with the current number of rows. Creating the triggers
+    blocks the writes to the tables until the end of the migration, so no row is missed.
+    On databases other than PostgreSQL, nothing is done and the rows are counted.
+    """
+
+    def migration(conn: Connection) -> None:
+        if conn.dialect.name != "postgresql":
+            return
+
+        ContentCounter.__table__.create(conn, checkfirst=True)  # type: ignore
+
+        # rows are counted once per statement, from its transition table
+        conn.execute(
+            text(
+                "CREATE OR REPLACE FUNCTION count_content_rows() RETURNS trigger AS $$ "
+                "BEGIN "
+                "IF TG_OP = 'TRUNCATE' THEN "
+                "UPDATE content_counters SET value = 0, time_update = now() "
+                "WHERE name = TG_TABLE_NAME; "
+                "ELSIF TG_OP = 'INSERT' THEN "
+                "UPDATE content_counters "
+                "SET value = value + (SELECT count(*) FROM changed_rows), "
+                "time_update = now() WHERE name = TG_TABLE_NAME; "
+                "ELSE "
+                "UPDATE content_counters "
+                "SET value = value - (SELECT count(*) FROM changed_rows), "
+                "time_update = now() WHERE name = TG_TABLE_NAME; "
+                "END IF; "
+                "RETURN NULL; "
+                "END $$ LANGUAGE plpgsql"
+            )
+        )
+
+        for table in tables:
+            # transition tables can be used only by triggers on a single event
+            for event, transition in [
+                ("insert", "NEW TABLE AS changed_rows"),
+                ("delete", "OLD TABLE AS changed_rows"),
+                ("truncate", None),
+            ]:
+                trigger = f"{table}_count_{event}"
+                referencing = f"REFERENCING {transition} " if transition else ""
+
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger} ON {table}"))
+                conn.execute(
+                    text(
+                        f"CREATE TRIGGER {trigger} AFTER {event.upper()} ON {table} "
+                        f"{referencing}"
+                        "FOR EACH STATEMENT EXECUTE FUNCTION count_content_rows()"
+                    )
+                )
+
+            conn.execute(
+                text(
+                    "INSERT INTO content_counters (name, value, time_update) "
+                    f"SELECT '{table}', count(*), now() FROM {table} "
+                    "ON CONFLICT (name) DO UPDATE "
+                    "SET value = EXCLUDED.value, time_update = now()"
+                )
+            )
+
+    return migration
+
+
+def _index(table: type[Base], name: str) -> Index:
+    """Find an index of a table by name."""
+    return next(i for i in cast(Table, table.__table__).indexes if i.name == name)
+
+
+# (version, name, migration), versions must be increasing
+MIGRATIONS: list[tuple[int, str, Migration]] = [
+    (
+        1,
+        "results hot-path indexes",
+        # the indexes on the inference_id are created by migration 7
+        _create_indexes(_index(Result, "ix_results_shown_result_id")),
+    ),
+    (
+        2,
+        "events time index",
+        _create_indexes(_index(Event, "ix_events_time_event")),
+    ),
+    (
+        3,
+        "partitioned results and inferences",
+        partition_legacy_tables,
+    ),
+    (
+        4,
+        "integer ids for inferences and models",
+        surrogate_keys,
+    ),
+    (
+        5,
+        "catalog version triggers",
+        _catalog_triggers("locations"),
+    ),
+    (
+        6,
+        "content counters",
+        _content_counters("locations"),
+    ),
+    (
+        7,
+        "inference id indexes",
+        _create_indexes(
+            _index(Inference, "ix_inferences_inference_id"),
+            _index(Result, "ix_results_inference_id_location_id"),
+            _index(Result, "ix_results_inference_id_score"),
+        ),
+    ),
+]
+
+
+def applied_versions(db: Session) -> set[int]:
+    """Returns the versions of the migrations already applied to the database."""
+    return {v for (v,) in db.query(SchemaVersion.version).all()}
+
+
+def run_migrations(db: Session) -> list[int]:
+    """Apply the pending migrations to the database.
+
+    Processes starting at the same time wait for each other, so each migration is
+    applied once. Each migration runs in its own transaction, together with its record
+    in the `schema_versions` table.
+
+    :param db:
+        Session with the connection to the database.
+
+    :return:
+        The versions of the applied migrations.
+    """
+    applied = []
+
+    with advisory_lock(db, LOCK_MIGRATIONS, wait=True):
+        done = applied_versions(db)
+        db.commit()
+
+        for version, name, migration in MIGRATIONS:
+            if version in done:
+                continue
+
+            LOGGER.info(f"applying migration {version}: {name}")
+
+            # sessions are always bound to an engine
+            bind = cast(Engine, db.get_bind())
+            record = insert(SchemaVersion).values(version=version, name=name)
+
+            if migration in _NON_TRANSACTIONAL and bind.dialect.name == "postgresql":
+                # i.e. CREATE INDEX CONCURRENTLY cannot run inside a transaction
+                with bind.connect().execution_options(
+                    isolation_level="AUTOCOMMIT"
+                ) as conn:
+                    migration(conn)
+
+                with bind.begin() as conn:
+                    conn.execute(record)
+
+            else:
+                with bind.begin() as conn:
+                    migration(conn)
+                    conn.execute(record)
+
+            applied.append(version)
+
+    if applied:
+        LOGGER.info(f"applied migrations {applied}")
+    else:
+        LOGGER.info("database schema is up to date")
+
+    return applied
@@ -0,0 +1,437 @@
+"""Partitions of the largest tables and retention of the results.
+
+On PostgreSQL, the `results` table is partitioned by ranges of result_id and the
+`inferences` table by month of creation. Partitions are created in advance by
+`ensure_partitions`, a default partition receives the rows outside of all the ranges.
+
+Only queries filtering on the partition key are pruned to a few partitions: lookups of
+results by inference_id, as the ones of the inference and labelling endpoints, cannot be
+pruned and probe the index of each partition of `results`. Their cost grows with the
+number of partitions, that is kept low by the retention and by a large partition size.
+
+Results never shown to the users are not used for training: after the retention time
+they are exported to compressed files and deleted. Results referenced by the `datasets`
+table are always kept. Partitions of old results left empty are dropped. Scores stored
+in packed mode are deleted after the retention time, without export.
+
+On other databases, tables are not partitioned and only the retention is applied.
+"""
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from sqlalchemy import Connection, Table, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from typing import cast
+
+from . import crud
+from .keys import surrogate_keys
+from .snapshot import HAS_PARQUET
+from .tables import Inference, Result
+
+import logging
+import os
+
+import pandas as pd
+
+LOGGER = logging.getLogger("mlprod.database.partitions")
+
+# number of result ids in each partition of the results table
+RESULTS_PARTITION_SIZE = int(os.environ.get("RESULTS_PARTITION_SIZE", "5000000"))
+# number of partitions created in advance
+PARTITIONS_AHEAD = int(os.environ.get("PARTITIONS_AHEAD", "2"))
+# days after which results never shown are deleted, 0 to keep them forever
+RESULTS_RETENTION_DAYS = float(os.environ.get("RESULTS_RETENTION_DAYS", "0"))
+# export results to files before deleting them
+RESULTS_ARCHIVE = os.environ.get("RESULTS_ARCHIVE", "true") == "true"
+# folder where the exported results are stored
+RESULTS_ARCHIVE_DIR = Path(os.environ.get("RESULTS_ARCHIVE_DIR", "./archive"))
+# number of results exported and deleted at once
+RESULTS_ARCHIVE_BATCH = int(os.environ.get("RESULTS_ARCHIVE_BATCH", "100000"))
+
+
+def _is_postgres(conn: Connection) -> bool:
+    return conn.dialect.name == "postgresql"
+
+
+def is_partitioned(conn: Connection, table: str) -> bool:
+    """Returns True if the given table is partitioned."""
+    return bool(
+        conn.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+                "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table)"
+            ),
+            {"table": table},
+        ).scalar()
+    )
+
+
+def _month(time: datetime, shift: int = 0) -> datetime:
+    """First instant of the month of the given time, shifted by some months."""
+    months = time.year * 12 + time.month - 1 + shift
+    return datetime(months // 12, months % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _default_has_rows(
+    conn: Connection, parent: str, key: str, low: str, high: str
+) -> bool:
+    """Returns True if the default partition has rows in the given range."""
+    default = f"{parent}_default"
+
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": default}).scalar():
+        return bool(
+            conn.execute(
+                text(
+                    f"SELECT EXISTS (SELECT 1 FROM {default} "
+                    f"WHERE {key} >= {low} AND {key} < {high})"
+                )
+            ).scalar()
+        )
+
+    return False
+
+
+def _create_partition(
+    conn: Connection, parent: str, key: str, name: str, low: str, high: str
+) -> bool:
+    """Create a range partition, if its range is not covered by another partition.
+
+    A partition cannot be attached while the default partition has rows in its range:
+    these rows are moved to the new partition, created as a standalone table and then
+    attached. If the rows cannot be moved, the partition is not created and an error is
+    logged, since the following rows in that range keep going to the default partition.
+    """
+    moving = False
+
+    try:
+        with conn.begin_nested():
+            moving = _default_has_rows(conn, parent, key, low, high)
+
+            if not moving:
+                conn.execute(
+                    text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent} "
+                        f"FOR VALUES FROM ({low}) TO ({high})"
+                    )
+                )
+                return True
+
+            LOGGER.warning(f"moving rows of {parent}_default to partition {name}")
+
+            conn.execute(text(f"CREATE TABLE {name} (LIKE {parent})"))
+            conn.execute(
+                text(
+                    f"WITH moved AS (DELETE FROM {parent}_default "
+                    f"WHERE {key} >= {low} AND {key} < {high} RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved"
+                )
+            )
+            conn.execute(
+                text(
+                    f"ALTER TABLE {parent} ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ({low}) TO ({high})"
+                )
+            )
+        return True
+
+    except DBAPIError as e:
+        if moving:
+            LOGGER.error(
+                f"partition {name} not created, rows of {parent}_default in its range "
+                f"must be moved manually: {e.orig}"
+            )
+        else:
+            LOGGER.warning(f"partition {name} not created: {e.orig}")
+        return False
+
+
+def _max_result_id(conn: Connection) -> int:
+    return conn.execute(
+        text("SELECT COALESCE(max(result_id), 0) FROM results")
+    ).scalar()  # type: ignore
+
+
+def _ensure_partitions(conn: Connection, ahead: int) -> None:
+    if is_partitioned(conn, "results"):
+        k0 = _max_result_id(conn) // RESULTS_PARTITION_SIZE
+
+        for k in range(k0, k0 + ahead + 1):
+            low, high = k * RESULTS_PARTITION_SIZE, (k + 1) * RESULTS_PARTITION_SIZE
+            _create_partition(
+                conn, "results", "result_id", f"results_p{k}", str(low), str(high)
+            )
+
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS results_default PARTITION OF results DEFAULT"
+            )
+        )
+
+    if is_partitioned(conn, "inferences"):
+        now = datetime.now(timezone.utc)
+
+        for shift in range(0, ahead + 1):
+            begin, end = _month(now, shift), _month(now, shift + 1)
+            _create_partition(
+                conn,
+                "inferences",
+                "time_creation",
+                f"inferences_p{begin.strftime('%Y%m')}",
+                f"'{begin.isoformat()}'",
+                f"'{end.isoformat()}'",
+            )
+
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS inferences_default "
+                "PARTITION OF inferences DEFAULT"
+            )
+        )
+
+
+def ensure_partitions(db: Session, ahead: int = PARTITIONS_AHEAD) -> None:
+    """Create the partitions for the current and the next ranges of the tables.
+
+    :param db:
+        Session with the connection to the database.
+    :param ahead:
+        Number of partitions to create after the current one.
+    """
+    conn = db.connection()
+
+    if not _is_postgres(conn):
+        return
+
+    _ensure_partitions(conn, ahead)
+    db.commit()
+
+    LOGGER.info("partitions are up to date")
+
+
+def _rename_legacy(conn: Connection, name: str) -> str:
+    """Rename a table and its indexes, so a new table with the same name can be created."""
+    legacy = f"{name}_legacy"
+
+    indexes = (
+        conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+            {"table": name},
+        )
+        .scalars()
+        .all()
+    )
+
+    conn.execute(text(f"ALTER TABLE {name} RENAME TO {legacy}"))
+
+    for index in indexes:
+        conn.execute(text(f"ALTER INDEX {index} RENAME TO {index}_legacy"))
+
+    return legacy
+
+
+def _move_foreign_keys(conn: Connection, legacy: str, name: str) -> None:
+    """Make the foreign keys that reference the legacy table reference the new one."""
+    rows = conn.execute(
+        text(
+            "SELECT CAST(conrelid AS regclass), conname, pg_get_constraintdef(oid) "
+            "FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = CAST(:table AS regclass)"
+        ),
+        {"table": legacy},
+    ).all()
+
+    for table, constraint, definition in rows:
+        definition = definition.replace(f"REFERENCES {legacy}(", f"REFERENCES {name}(")
+        conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {constraint}"))
+        conn.execute(
+            text(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} {definition}")
+        )
+
+
+def partition_legacy_tables(conn: Connection) -> None:
+    """Convert the existing results and inferences tables to partitioned tables.
+
+    Each existing table becomes the first partition of a new partitioned table, so no
+    data is copied.
+
+    :param conn:
+        Connection to the database, inside a transaction.
+    """
+    if not _is_postgres(conn):
+        return
+
+    # the legacy tables must have the same columns of the new ones
+    surrogate_keys(conn)
+
+    if not is_partitioned(conn, "results"):
+        LOGGER.info("converting results to a partitioned table")
+
+        seq = conn.execute(
+            text("SELECT pg_get_serial_sequence('results', 'result_id')")
+        ).scalar()
+
+        legacy = _rename_legacy(conn, "results")
+
+        if seq is not None:
+            conn.execute(text(f"ALTER SEQUENCE {seq} RENAME TO {legacy}_result_id_seq"))
+
+        cast(Table, Result.__table__).create(conn, checkfirst=True)
+
+        max_id: int = conn.execute(
+            text(f"SELECT COALESCE(max(result_id), 0) FROM {legacy}")
+        ).scalar_one()
+        high = (max_id // RESULTS_PARTITION_SIZE + 1) * RESULTS_PARTITION_SIZE
+
+        conn.execute(
+            text(
+                f"ALTER TABLE results ATTACH PARTITION {legacy} "
+                f"FOR VALUES FROM (MINVALUE) TO ({high})"
+            )
+        )
+
+        if max_id > 0:
+            conn.execute(
+                text(
+                    "SELECT setval(pg_get_serial_sequence('results', 'result_id'), :id)"
+                ),
+                {"id": max_id},
+            )
+
+        _move_foreign_keys(conn, legacy, "results")
+
+    if not is_partitioned(conn, "inferences"):
+        LOGGER.info("converting inferences to a partitioned table")
+
+        legacy = _rename_legacy(conn, "inferences")
+
+        cast(Table, Inference.__table__).create(conn, checkfirst=True)
+
+        max_time = conn.execute(
+            text(f"SELECT max(time_creation) FROM {legacy}")
+        ).scalar()
+        end = _month(max_time or datetime.now(timezone.utc), 1)
+
+        conn.execute(
+            text(
+                f"ALTER TABLE inferences ATTACH PARTITION {legacy} "
+                f"FOR VALUES FROM (MINVALUE) TO ('{end.isoformat()}')"
+            )
+        )
+
+        _move_foreign_keys(conn, legacy, "inferences")
+
+    _ensure_partitions(conn, PARTITIONS_AHEAD)
+
+
+def _write_archive(df: pd.DataFrame, folder: Path) -> Path:
+    """Export a batch of results to a compressed file."""
+    os.makedirs(folder, exist_ok=True)
+
+    name = f"results.{df['result_id'].min()}-{df['result_id'].max()}"
+
+    if HAS_PARQUET:
+        path = folder / f"{name}.parquet"
+        df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+    else:
+        path = folder / f"{name}.tsv.gz"
+        df.to_csv(path, sep="\t", index=False, compression="gzip")
+
+    return path
+
+
+def archive_results(
+    db: Session,
+    retention: timedelta,
+    folder: Path | None = RESULTS_ARCHIVE_DIR,
+    batch_size: int = RESULTS_ARCHIVE_BATCH,
+) -> int:
+    """Delete the results never shown to the users, after exporting them to files.
+
+    :param db:
+        Session with the connection to the database.
+    :param retention:
+        Only results of inferences older than this are deleted.
+    :param folder:
+        Folder where the results are exported, if None they are only deleted.
+    :param batch_size:
+        Number of results exported and deleted at once.
+
+    :return:
+        The number of deleted results.
+    """
+    before = datetime.now() - retention
+    total = 0
+
+    while True:
+        df = crud.read_expired_results(db, before, batch_size)
+
+        if df.shape[0] == 0:
+            break
+
+        if folder is not None:
+            path = _write_archive(df, folder)
+            LOGGER.info(f"archived {df.shape[0]} results to {path}")
+
+        crud.delete_results(db, df["result_id"].to_list())
+        total += df.shape[0]
+
+    # packed scores are not archived: the shown and labelled ones are also rows
+    n = crud.delete_result_scores_before(db, before)
+    if n:
+        LOGGER.info(f"deleted packed scores of {n} inferences")
+
+    return total
+
+
+def drop_empty_partitions(db: Session) -> list[str]:
+    """Drop the partitions of the results table left empty by the retention.
+
+    The partitions of the current and of the next ranges are never dropped.
+
+    :param db:
+        Session with the connection to the database.
+
+    :return:
+        The names of the dropped partitions.
+    """
+    conn = db.connection()
+
+    if not _is_postgres(conn) or not is_partitioned(conn, "results"):
+        return []
+
+    k0 = _max_result_id(conn) // RESULTS_PARTITION_SIZE
+
+    names = (
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'results'"
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+    dropped = []
+    for name in names:
+        if name == "results_default":
+            continue
+        if name.startswith("results_p") and int(name[len("results_p") :]) >= k0:
+            continue
+
+        if conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})")).scalar():
+            continue
+
+        conn.execute(text(f"ALTER TABLE results DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+
+    db.commit()
+
+    if dropped:
+        LOGGER.info(f"dropped empty partitions {dropped}")
+
+    return dropped
@@ -0,0 +1,350 @@
+"""On-disk snapshots of the training datasets.
+
+A dataset is identified by the watermark of the results (see
+`crud.get_dataset_watermark`), the stamp of the labels (see `crud.get_label_stamp`), its
+size, and its columns. With the same key the database produces the same rows, so the
+snapshot can be used instead of a new query. Labels given after a snapshot has been
+saved change the stamp, and the snapshot is not used anymore.
+
+Only the newest SNAPSHOT_KEEP snapshots are kept, and none older than
+SNAPSHOT_MAX_AGE_DAYS days.
+
+Snapshots are stored as compressed Parquet files when `pyarrow` is available,
+otherwise as a folder with a NumPy `.npy` file for each column.
+"""
+
+from pathlib import Path
+from sqlalchemy.orm import Session
+from typing import Callable, Iterator
+
+from . import crud
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+LOGGER = logging.getLogger("mlprod.database.snapshot")
+
+# number of newest snapshots kept on disk
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "4"))
+# days after which a snapshot is deleted
+SNAPSHOT_MAX_AGE_DAYS = float(os.environ.get("SNAPSHOT_MAX_AGE_DAYS", "7"))
+
+COL_RESULT_ID: str = "result_id"
+FILE_COLUMNS: str = "columns.json"
+
+
+def _snapshot_name(watermark: int, stamp: int, size: int, columns: list[str]) -> str:
+    """Name of a snapshot, without extension."""
+    digest = hashlib.sha1("\t".join(columns).encode()).hexdigest()[:8]
+    return f"dataset.{watermark}.{stamp}.{size}.{digest}"
+
+
+def _find_snapshot(
+    folder: Path, watermark: int, stamp: int, size: int, columns: list[str]
+) -> Path | None:
+    """Find the smallest snapshot with the given key and at least the given size."""
+    if not folder.exists():
+        return None
+
+    digest = _snapshot_name(watermark, stamp, size, columns).split(".")[-1]
+
+    candidates = []
+    for path in folder.glob(f"dataset.{watermark}.{stamp}.*.{digest}*"):
+        if path.name.endswith(".tmp"):
+            continue
+        candidates.append((int(path.name.split(".")[3]), path))
+
+    candidates = [(s, p) for s, p in candidates if s >= size]
+
+    if not candidates:
+        return None
+
+    return min(candidates)[1]
+
+
+def write_snapshot(df: pd.DataFrame, path: Path) -> Path:
+    """Writes a DataFrame to disk in a columnar format.
+
+    The snapshot is written to a temporary location first, then moved to the final
+    path, so concurrent readers never see a partial file.
+
+    :param df:
+        DataFrame to save, columns must be numeric.
+    :param path:
+        Path of the snapshot, without extension.
+
+    :return:
+        The path of the written snapshot.
+    """
+    os.makedirs(path.parent, exist_ok=True)
+
+    if HAS_PARQUET:
+        path = path.with_name(path.name + ".parquet")
+        tmp = path.with_name(path.name + ".tmp")
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp, path)
+
+    else:
+        path = path.with_name(path.name + ".npy.d")
+        tmp = path.with_name(path.name + ".tmp")
+        os.makedirs(tmp, exist_ok=True)
+
+        columns = df.columns.to_list()
+        for i, col in enumerate(columns):
+            np.save(tmp / f"{i}.npy", df[col].to_numpy())
+
+        with open(tmp / FILE_COLUMNS, "w+") as f:
+            json.dump(columns, f)
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    LOGGER.info(f"snapshot: dataset of shape {df.shape} saved to {path}")
+
+    return path
+
+
+def prune_snapshots(
+    folder: Path,
+    keep: int = SNAPSHOT_KEEP,
+    max_age_days: float = SNAPSHOT_MAX_AGE_DAYS,
+    exclude: Path | None = None,
+) -> int:
+    """Delete the oldest snapshots in a folder.
+
+    :param folder:
+        Folder where the snapshots are stored.
+    :param keep:
+        Number of newest snapshots to keep.
+    :param max_age_days:
+        Snapshots older than this are deleted, even if among the newest.
+    :param exclude:
+        Snapshot that is never deleted, i.e. the one just written.
+
+    :return:
+        The number of deleted snapshots.
+    """
+    if not folder.exists():
+        return 0
+
+    snapshots = sorted(
+        (
+            (path.stat().st_mtime, path)
+            for path in folder.glob("dataset.*")
+            if not path.name.endswith(".tmp") and path != exclude
+        ),
+        reverse=True,
+    )
+
+    oldest = time.time() - max_age_days * 86400
+    n_keep = keep - (exclude is not None)
+
+    deleted = 0
+    for i, (mtime, path) in enumerate(snapshots):
+        if i < n_keep and mtime >= oldest:
+            continue
+
+        try:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            deleted += 1
+        except OSError as e:
+            # another process can delete the same snapshot
+            LOGGER.warning(f"snapshot: could not delete {path}: {e}")
+
+    if deleted:
+        LOGGER.info(f"snapshot: deleted {deleted} old snapshots from {folder}")
+
+    return deleted
+
+
+def read_snapshot(path: Path, size: int | None = None) -> pd.DataFrame:
+    """Reads a snapshot from disk by memory mapping it.
+
+    :param path:
+        Path of the snapshot, as returned by `write_snapshot`.
+    :param size:
+        If set, only the first rows are returned.
+    """
+    if path.name.endswith(".parquet"):
+        df = pd.read_parquet(path, engine="pyarrow", memory_map=True)
+
+    else:
+        with open(path / FILE_COLUMNS, "r") as f:
+            columns: list[str] = json.load(f)
+
+        df = pd.DataFrame(
+            {
+                col: np.load(path / f"{i}.npy", mmap_mode="r")
+                for i, col in enumerate(columns)
+            },
+            copy=False,
+        )
+
+    LOGGER.info(f"snapshot: dataset of shape {df.shape} loaded from {path}")
+
+    if size is not None:
+        df = df[:size]
+
+    return df
+
+
+def iter_snapshot(
+    path: Path,
+    chunk_size: int,
+    offset: int = 0,
+    size: int | None = None,
+    columns: list[str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    """Reads a snapshot from disk in chunks.
+
+    :param path:
+        Path of the snapshot, as returned by `write_snapshot`.
+    :param chunk_size:
+        Number of records in each chunk.
+    :param offset:
+        Number of first records to skip.
+    :param size:
+        If set, maximum number of records to read.
+    :param columns:
+        If set, only these columns are returned.
+    """
+    end = None if size is None else offset + size
+
+    if path.name.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        pos = 0
+        with pq.ParquetFile(path, memory_map=True) as pf:
+            for batch in pf.iter_batches(batch_size=chunk_size, columns=columns):
+                begin, pos = pos, pos + batch.num_rows
+
+                if pos <= offset:
+                    continue
+                if end is not None and begin >= end:
+                    break
+
+                chunk = batch.to_pandas()
+                lo = max(offset - begin, 0)
+                hi = None if end is None else end - begin
+                yield chunk[lo:hi]
+
+    else:
+        df = read_snapshot(path)
+        if columns is not None:
+            df = df[columns]
+
+        df = df[offset:end]
+
+        for begin in range(0, df.shape[0], chunk_size):
+            yield df[begin : begin + chunk_size]
+
+
+def stream_dataset(
+    db: Session,
+    watermark: int,
+    size: int,
+    columns: list[str],
+    folder: Path,
+    chunk_size: int = 10_000,
+    offset: int = 0,
+) -> Callable[[], Iterator[pd.DataFrame]]:
+    """Source of the chunks of a dataset, from a snapshot if available or the database.
+
+    The source can be read multiple times, always with the same data. Results in the
+    dataset are not registered: use `crud.register_dataset_query` for this.
+
+    :param db:
+        Session with the connection to the database.
+    :param watermark:
+        Watermark of the dataset, see `crud.get_dataset_watermark`.
+    :param size:
+        Size of the dataset.
+    :param columns:
+        Columns to keep in the dataset.
+    :param folder:
+        Folder where the snapshots are stored.
+    :param chunk_size:
+        Number of records in each chunk.
+    :param offset:
+        Number of newest records to skip.
+
+    :return:
+        A function that returns a new iterator over the chunks.
+    """
+    cols = [COL_RESULT_ID] + [c for c in columns if c != COL_RESULT_ID]
+
+    stamp = crud.get_label_stamp(db, watermark, offset + size)
+
+    path = _find_snapshot(folder, watermark, stamp, offset + size, cols)
+
+    if path is not None:
+        LOGGER.info(f"snapshot: streaming from {path}")
+        return lambda: iter_snapshot(path, chunk_size, offset, size, columns)
+
+    LOGGER.info(f"snapshot: streaming from database with watermark={watermark}")
+    return lambda: crud.iter_dataset(db, size, watermark, chunk_size, offset, columns)
+
+
+def load_dataset(
+    db: Session, task_id: str, size: int, columns: list[str], folder: Path
+) -> pd.DataFrame:
+    """Creates a dataset for the given training task, using a snapshot if available.
+
+    When a snapshot with the current watermark and labels exists, the data are read
+    from disk and only the ids of the results are registered in the database. Otherwise
+    the dataset is created from the database, a new snapshot is saved, and the oldest
+    snapshots are deleted.
+
+    :param db:
+        Session with the connection to the database.
+    :param task_id:
+        Id of the training task to be used as id of the dataset.
+    :param size:
+        Size of the dataset.
+    :param columns:
+        Columns to keep in the dataset.
+    :param folder:
+        Folder where the snapshots are stored.
+    """
+    watermark = crud.get_dataset_watermark(db)
+    # read before the dataset: labels given meanwhile make the snapshot stale
+    stamp = crud.get_label_stamp(db, watermark, size)
+
+    cols = [COL_RESULT_ID] + [c for c in columns if c != COL_RESULT_ID]
+
+    path = _find_snapshot(folder, watermark, stamp, size, cols)
+
+    if path is not None:
+        LOGGER.info(
+            f"snapshot: hit for watermark={watermark} labels={stamp} size={size}"
+        )
+        df = read_snapshot(path, size)
+        crud.register_dataset(db, task_id, df[COL_RESULT_ID].to_numpy())
+
+    else:
+        LOGGER.info(
+            f"snapshot: miss for watermark={watermark} labels={stamp} size={size}"
+        )
+        df = crud.create_dataset(db, task_id, size, watermark)[cols]
+        path = write_snapshot(df, folder / _snapshot_name(watermark, stamp, size, cols))
+        prune_snapshots(folder, exclude=path)
+
+    return df[columns]
@@ -1,13 +1,14 @@
-from .crud import count_locations, count_models, create_model
+from .catalog import load_locations
+from .crud import count_models, create_model
 from .database import DataBase
+from .locks import advisory_lock, LOCK_CONTENT
+from .migrations import run_migrations
+from .partitions import ensure_partitions
 from .tables import Base
-from .tables import Location
 
 from pathlib import Path
 
 import logging
-import numpy as np
-import pandas as pd
 
 LOGGER = logging.getLogger("mlprod.database.startup")
 
@@ -19,25 +20,18 @@ def init_content() -> None:
     try:
         db = DataBase()
 
-        with db.engine.begin() as conn:
-            LOGGER.info("database creation started")
-            Base.metadata.create_all(conn, checkfirst=True)
-            LOGGER.info("database creation completed")
+        # replicas starting together wait for each other and initialize only once
+        with db.session() as session, advisory_lock(session, LOCK_CONTENT, wait=True):
+            with db.engine.begin() as conn:
+                LOGGER.info("database creation started")
+                Base.metadata.create_all(conn, checkfirst=True)
+                LOGGER.info("database creation completed")
 
-        with db.session() as session:
-            n_locations = count_locations(session)
+            LOGGER.info("database migrations started")
+            run_migrations(session)
+            ensure_partitions(session)
 
-            if n_locations == 0:
-                LOGGER.info(
-                    "no locations found in database, "
-                    "populating from dataset_locations.tsv file"
-                )
-
-                df = pd.read_csv("./data/dataset_locations.tsv", sep="\t")
-                df["id"] = np.arange(df.shape[0])
-
-                session.bulk_insert_mappings(Location, df.to_dict(orient="records"))  # type: ignore
-                session.commit()
+            load_locations(session)
 
             n_models = count_models(session)
 
@@ -52,8 +46,6 @@ def init_content() -> None:
                     use_percentage=1.0,
                 )
 
-            session.close()
-
     except Exception as e:
         LOGGER.error("Error during database initialization")
         LOGGER.exception(e)
@@ -0,0 +1,107 @@
+"""Statistics on the content of the database, without scanning the tables.
+
+The number of rows of a table is read in one of the modes set by CONTENT_STATS:
+
+- `exact`: a `SELECT count(*)`, that scans the whole table on PostgreSQL;
+- `counters`: the counters kept by triggers in the `content_counters` table, exact
+  and read with a single lookup, at the cost of a small update on each write;
+- `estimate`: the number of rows estimated by the planner, updated by (auto)vacuum.
+
+Counters are kept only for the tables in COUNTED_TABLES: the counter of a table is a
+single row, updated by each write, that would serialize the frequent inserts of users.
+In `counters` mode, the other tables are estimated. Databases other than PostgreSQL
+always use exact counts. When a counter or an estimate is not available, the rows are
+counted.
+"""
+
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import Session
+
+from . import crud
+
+import logging
+import os
+
+LOGGER = logging.getLogger("mlprod.database.stats")
+
+# how the rows of the tables are counted: exact, counters, or estimate
+CONTENT_STATS = os.environ.get("CONTENT_STATS", "counters")
+
+# tables whose rows are counted by triggers, written rarely
+COUNTED_TABLES = ("locations",)
+
+# exact count of the rows of each table
+_COUNTS = {
+    "locations": crud.count_locations,
+    "users": crud.count_users,
+}
+
+
+def count_rows(db: Session, tables: list[str]) -> dict[str, int]:
+    """Returns the number of rows of the given tables, in the configured mode.
+
+    :param db:
+        Session with the connection to the database.
+    :param tables:
+        Names of the tables, among `locations` and `users`.
+    """
+    counts: dict[str, int] = dict()
+
+    if db.get_bind().dialect.name == "postgresql" and CONTENT_STATS != "exact":
+        estimated = tables
+
+        if CONTENT_STATS == "counters":
+            counts = crud.get_content_counters(
+                db, [t for t in tables if t in COUNTED_TABLES]
+            )
+            estimated = [t for t in tables if t not in COUNTED_TABLES]
+
+        for table in estimated:
+            estimate = crud.estimate_rows(db, table)
+            if estimate is not None:
+                counts[table] = estimate
+
+    for table in tables:
+        if table not in counts:
+            LOGGER.debug(f"counting rows of {table}")
+            counts[table] = _COUNTS[table](db)
+
+    return counts
+
+
+def content_info(db: Session, window: timedelta = timedelta(days=1)) -> dict:
+    """Returns the size of the content tables and the recent activity.
+
+    The activity is read from the counts of the events, so it includes only the events
+    already written to the database.
+
+    :param db:
+        Session with the connection to the database.
+    :param window:
+        Interval, before now, in which the activity is measured (default: one day).
+
+    :return:
+        A dictionary with the fields of `ContentInfo`.
+    """
+    counts = count_rows(db, ["locations", "users"])
+
+    since = datetime.now(timezone.utc) - window
+    events = crud.sum_event_counts(
+        db, since, ["inference_start", "results", "selection", "good_inference"]
+    )
+
+    inferences = events["inference_start"]
+    labels = events["selection"]
+
+    return {
+        "locations": counts["locations"],
+        "users": counts["users"],
+        "stats": CONTENT_STATS
+        if db.get_bind().dialect.name == "postgresql"
+        else "exact",
+        "inferences": inferences,
+        "results": events["results"],
+        "labels": labels,
+        "label_rate": labels / inferences if inferences else 0.0,
+        "good_rate": events["good_inference"] / labels if labels else 0.0,
+    }
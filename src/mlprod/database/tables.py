@@ -1,5 +1,16 @@
 from pathlib import Path
-from sqlalchemy import TypeDecorator, ForeignKey, String, DateTime, Date
+from sqlalchemy import (
+    BigInteger,
+    TypeDecorator,
+    ForeignKey,
+    Index,
+    LargeBinary,
+    Sequence,
+    String,
+    DateTime,
+    Date,
+    text,
+)
 from sqlalchemy.sql.functions import now
 from sqlalchemy.orm import relationship, mapped_column, Mapped, DeclarativeBase
 
@@ -99,15 +110,29 @@ class Location(Base):
 
 # ---- Inference tables ----
 
+# compact ids of the inferences, used instead of the task_id by the other tables
+INFERENCE_ID_SEQ = Sequence("inferences_inference_id_seq")
+
 
 class Inference(Base):
-    """Table used to store the inference requests from the users, and the results."""
+    """Table used to store the inference requests from the users, and the results.
+
+    The `task_id` is the id of the Celery task, used only to find an inference. The
+    other tables refer to an inference by its `inference_id`.
+
+    On PostgreSQL the table is partitioned by month of creation, see `partitions`.
+    """
 
     __tablename__ = "inferences"
+    __table_args__ = {"postgresql_partition_by": "RANGE (time_creation)"}
 
     task_id: Mapped[str] = mapped_column(primary_key=True, index=True)
+    # part of the primary key, since it is the partition key
     time_creation: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), server_default=now()
+        DateTime(timezone=True), server_default=now(), primary_key=True
+    )
+    inference_id: Mapped[int] = mapped_column(
+        BigInteger, INFERENCE_ID_SEQ, nullable=False, index=True
     )
     time_get: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), default=None, nullable=True
@@ -122,14 +147,31 @@ class Inference(Base):
 
 
 class Result(Base):
-    """Table used to store the inference results from the ML model."""
+    """Table used to store the inference results from the ML model.
+
+    On PostgreSQL the table is partitioned by ranges of result_id, see `partitions`.
+    """
 
     __tablename__ = "results"
+    __table_args__ = (
+        # results of an inference, and labels of a location
+        Index("ix_results_inference_id_location_id", "inference_id", "location_id"),
+        # top scored results of an inference
+        Index("ix_results_inference_id_score", "inference_id", "score"),
+        # newest results shown to the users, used to build the datasets
+        Index(
+            "ix_results_shown_result_id",
+            "result_id",
+            postgresql_where=text("shown"),
+            sqlite_where=text("shown"),
+        ),
+        {"postgresql_partition_by": "RANGE (result_id)"},
+    )
 
     result_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, index=True
     )
-    task_id: Mapped[str] = mapped_column(nullable=False)
+    inference_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.user_id"))
     location_id: Mapped[int] = mapped_column(ForeignKey("locations.location_id"))
     score: Mapped[float] = mapped_column(nullable=False)
@@ -140,13 +182,72 @@ class Result(Base):
     location = relationship("Location")
 
 
+class ResultScores(Base):
+    """Table used to store all the scores of an inference as packed arrays.
+
+    When the worker stores the results in packed mode, the scores of an inference are a
+    single record instead of a row of the `results` table for each location. Locations
+    are sorted by descending score, their ids are stored as little-endian int32 and the
+    scores as little-endian float32. Rows of the `results` table are created only for
+    the locations shown to the user or labelled.
+    """
+
+    __tablename__ = "result_scores"
+
+    inference_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.user_id"))
+    time_creation: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now(), index=True
+    )
+    location_ids: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    scores: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
+class ShadowInference(Base):
+    """Table used to store the agreement between the active model and a candidate model.
+
+    A candidate model scores, in shadow mode, a sample of the inference requests.
+    """
+
+    __tablename__ = "shadow_inferences"
+
+    task_id: Mapped[str] = mapped_column(primary_key=True, index=True)
+    model_id: Mapped[str] = mapped_column(ForeignKey("models.task_id"), index=True)
+    time_creation: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now()
+    )
+    top_k: Mapped[int] = mapped_column(nullable=False)
+    top_k_overlap: Mapped[float] = mapped_column(nullable=False)
+    rank_correlation: Mapped[float] = mapped_column(nullable=False)
+    score_mae: Mapped[float] = mapped_column(nullable=False)
+
+
+class ShadowResult(Base):
+    """Table used to store the scores of a candidate model.
+
+    Only the locations ranked in the top positions by the active model are stored, since
+    they are the only ones that can be shown to the user and receive a label.
+    """
+
+    __tablename__ = "shadow_results"
+
+    task_id: Mapped[str] = mapped_column(
+        ForeignKey("shadow_inferences.task_id"), primary_key=True
+    )
+    location_id: Mapped[int] = mapped_column(
+        ForeignKey("locations.location_id"), primary_key=True
+    )
+    score: Mapped[float] = mapped_column(nullable=False)
+
+
 # ---- Monitoring and metrics tables ----
 
 
 class Event(Base):
     """Table used to store the events that can be generated by the application.
 
-    This is very similar to a log file.
+    This is very similar to a log file. Raw events are stored only if enabled, the
+    counts of the events are always stored in the `event_counts` table.
     """
 
     __tablename__ = "events"
@@ -154,22 +255,39 @@ class Event(Base):
     event_id: Mapped[int] = mapped_column(primary_key=True, index=True)
     event: Mapped[str] = mapped_column(default="")
     time_event: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), server_default=now()
+        DateTime(timezone=True), server_default=now(), index=True
     )
 
 
+class EventCount(Base):
+    """Table used to store the number of events of each type in buckets of one minute.
+
+    Dashboards should read this table instead of the raw events.
+    """
+
+    __tablename__ = "event_counts"
+
+    time_bucket: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True
+    )
+    event: Mapped[str] = mapped_column(primary_key=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+
 # ---- Retraining tables ----
 
 
 class Dataset(Base):
     """Table used to store information on dataset used during the training of a model.
 
-    Use the filed `task_id` to find the used model.
+    Use the field `model_id` to find the used model.
     """
 
     __tablename__ = "datasets"
 
-    task_id: Mapped[str] = mapped_column(primary_key=True, index=True)
+    model_id: Mapped[int] = mapped_column(
+        ForeignKey("models.model_id"), primary_key=True
+    )
     result_id: Mapped[int] = mapped_column(
         ForeignKey("results.result_id"), primary_key=True
     )
@@ -180,15 +298,20 @@ class Dataset(Base):
     result = relationship("Result")
 
 
+# compact ids of the models, used instead of the task_id by the other tables
+MODEL_ID_SEQ = Sequence("models_model_id_seq")
+
+
 class Model(Base):
     """Table used to store information regarding models generated by the training task.
 
-    Use the field `task_id` to find the used dataset.
+    Use the field `model_id` to find the used dataset.
     """
 
     __tablename__ = "models"
 
     task_id: Mapped[str] = mapped_column(primary_key=True, index=True)
+    model_id: Mapped[int] = mapped_column(MODEL_ID_SEQ, nullable=False, unique=True)
     time_creation: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=now()
     )
@@ -205,3 +328,82 @@ class Model(Base):
     test_pre: Mapped[float] = mapped_column(default=0.0)
     test_rec: Mapped[float] = mapped_column(default=0.0)
     test_f1: Mapped[float] = mapped_column(default=0.0)
+
+
+# ---- Schema tables ----
+
+
+class SchemaVersion(Base):
+    """Table used to store the migrations applied to the database schema."""
+
+    __tablename__ = "schema_versions"
+
+    version: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(nullable=False)
+    time_applied: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now()
+    )
+
+
+class CatalogSource(Base):
+    """Table used to store the checksum of the files loaded in the catalog tables."""
+
+    __tablename__ = "catalog_sources"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    checksum: Mapped[str] = mapped_column(nullable=False)
+    records: Mapped[int] = mapped_column(nullable=False)
+    time_loaded: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now(), onupdate=now()
+    )
+
+
+class CatalogVersion(Base):
+    """Table used to store the version of each catalog table.
+
+    The version is increased on each change of the table, by a trigger on PostgreSQL,
+    so cached copies of the table can be checked with a cheap lookup.
+    """
+
+    __tablename__ = "catalog_versions"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(nullable=False, default=1)
+    time_update: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now(), onupdate=now()
+    )
+
+
+class ContentCounter(Base):
+    """Table used to store the number of rows of the content tables written rarely.
+
+    On PostgreSQL the counters are kept up to date by triggers, so the size of a table
+    is read without scanning it. See `stats` for the counted tables.
+    """
+
+    __tablename__ = "content_counters"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    time_update: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now(), onupdate=now()
+    )
+
+
+class CatalogChange(Base):
+    """Table used to log the records changed by the bulk updates of a catalog table.
+
+    Each row is a record changed by an update that moved the version of the table from
+    `previous` to `version`. A cached copy of the table can then be updated by reading
+    only these records, if all the updates since its version are logged.
+    """
+
+    __tablename__ = "catalog_changes"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(primary_key=True)
+    record_id: Mapped[int] = mapped_column(primary_key=True)
+    previous: Mapped[int] = mapped_column(nullable=False)
+    time_creation: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=now()
+    )
@@ -0,0 +1,232 @@
+"""Prometheus metrics of the connection pool of the database engine, and of the queries.
+
+Metrics are collected in the process that owns the engine: the API exports them through
+the `/metrics` endpoint. With multiple processes (PROMETHEUS_MULTIPROC_DIR) the gauges
+are summed over the live processes. The metrics of the pools are labelled with the name
+of the pool: `primary`, or `replica` for the read replica.
+
+When SQL_TIMING is enabled, each statement is timed and tagged with the function of
+`crud` that executed it. Statements slower than SQL_SLOW_MS milliseconds are logged,
+without the values of their parameters. When disabled, no hook is installed.
+
+The Celery workers have no metrics endpoint: their metrics are collected but not
+exported, so on the workers only the log of the slow queries is available.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, ExecutionContext
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import ConnectionPoolEntry, QueuePool
+
+from time import perf_counter
+from types import FrameType
+from typing import Any
+
+import logging
+import os
+import sys
+
+LOGGER = logging.getLogger("mlprod.database.telemetry")
+
+# time each query and log the slow ones
+SQL_TIMING = os.environ.get("SQL_TIMING", "false") == "true"
+# queries slower than this (in milliseconds) are logged
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "100"))
+
+# modules whose functions are used as tag of the queries, from the most specific
+_TAG_MODULES = ("mlprod.database.crud", "mlprod.")
+
+# time spent waiting for a connection from the pool
+POOL_CHECKOUT_TIME = Histogram(
+    "database_pool_checkout_seconds",
+    "Time spent waiting for a connection from the pool in seconds",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0),
+)
+# checkouts that failed because the pool was exhausted
+POOL_TIMEOUTS = Counter(
+    "database_pool_timeouts",
+    "Total number of checkouts failed because the pool was exhausted",
+    ["pool"],
+)
+# connections in use
+POOL_CHECKED_OUT = Gauge(
+    "database_pool_checked_out",
+    "Number of connections checked out from the pool",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+# connections opened above the size of the pool
+POOL_OVERFLOW = Gauge(
+    "database_pool_overflow",
+    "Number of connections opened above the size of the pool",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+# configured size of the pool
+POOL_SIZE = Gauge(
+    "database_pool_size",
+    "Number of connections kept in the pool",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+# time spent executing each query, by calling function
+QUERY_TIME = Histogram(
+    "database_query_seconds",
+    "Time spent executing a query in seconds",
+    ["operation", "statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+# queries slower than the threshold
+SLOW_QUERIES = Counter(
+    "database_slow_queries",
+    "Total number of queries slower than the threshold",
+    ["operation"],
+)
+
+
+def _pool_name(pool: QueuePool) -> str:
+    """Name of the pool used as label, set by the `pool_logging_name` of the engine."""
+    return getattr(pool, "logging_name", None) or "primary"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that tracks the time spent waiting for a connection."""
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        """Get a connection from the pool, waiting if none is available."""
+        begin = perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            POOL_TIMEOUTS.labels(_pool_name(self)).inc()
+            raise
+        finally:
+            POOL_CHECKOUT_TIME.labels(_pool_name(self)).observe(perf_counter() - begin)
+
+
+def _update_gauges(pool: QueuePool) -> None:
+    """Set the occupancy gauges from the current state of the pool."""
+    name = _pool_name(pool)
+    POOL_CHECKED_OUT.labels(name).set(pool.checkedout())
+    POOL_OVERFLOW.labels(name).set(max(pool.overflow(), 0))
+    POOL_SIZE.labels(name).set(pool.size())
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Track the occupancy of the pool of the given engine.
+
+    The waiting time is tracked only when the engine uses an `InstrumentedQueuePool`.
+
+    :param engine:
+        Engine to instrument, only engines with a QueuePool are supported.
+    """
+    if not isinstance(engine.pool, QueuePool):
+        LOGGER.info(f"pool telemetry not available for {type(engine.pool).__name__}")
+        return
+
+    # the pool is replaced when the engine is disposed, listeners are kept
+    @event.listens_for(engine, "checkout")
+    def on_checkout(*args: Any) -> None:
+        _update_gauges(engine.pool)  # type: ignore
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(*args: Any) -> None:
+        _update_gauges(engine.pool)  # type: ignore
+
+    _update_gauges(engine.pool)
+
+
+def _operation() -> str:
+    """Name of the function of the application that is executing a query.
+
+    Public functions of `crud` are preferred, so the helpers they share are tagged with
+    their caller. Queries executed outside the application are tagged as `other`.
+    """
+    frame: FrameType | None = sys._getframe(2)
+    fallback = None
+
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+
+        if module == _TAG_MODULES[0] and not frame.f_code.co_name.startswith("_"):
+            return f"crud.{frame.f_code.co_name}"
+
+        if (
+            fallback is None
+            and module.startswith(_TAG_MODULES[1])
+            and module != __name__
+        ):
+            fallback = f"{module.rsplit('.', 1)[-1]}.{frame.f_code.co_name}"
+
+        frame = frame.f_back
+
+    return fallback or "other"
+
+
+def _redact(parameters: Any, executemany: bool) -> str:
+    """Description of the parameters of a query, without their values."""
+    if executemany:
+        return f"<{len(parameters)} sets of parameters>"
+
+    if isinstance(parameters, dict):
+        return str({k: type(v).__name__ for k, v in parameters.items()})
+
+    if isinstance(parameters, (list, tuple)):
+        return str([type(v).__name__ for v in parameters])
+
+    return "<none>"
+
+
+def instrument_queries(engine: Engine) -> None:
+    """Time the queries executed by the given engine, if SQL_TIMING is enabled.
+
+    :param engine:
+        Engine to instrument.
+    """
+    if not SQL_TIMING:
+        return
+
+    slow = SQL_SLOW_MS / 1000
+
+    # the execution context can be None, the timing is kept by the connection
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(
+        conn: Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: ExecutionContext | None,
+        executemany: bool,
+    ) -> None:
+        conn.info["mlprod_timing"] = _operation(), perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(
+        conn: Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: ExecutionContext | None,
+        executemany: bool,
+    ) -> None:
+        timing = conn.info.pop("mlprod_timing", None)
+        if timing is None:
+            return
+
+        operation, begin = timing
+        elapsed = perf_counter() - begin
+
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+        QUERY_TIME.labels(operation, verb).observe(elapsed)
+
+        if elapsed >= slow:
+            SLOW_QUERIES.labels(operation).inc()
+            LOGGER.warning(
+                f"slow query in {operation}: {elapsed * 1000:.1f} ms, "
+                f"{' '.join(statement.split())[:1000]} "
+                f"parameters={_redact(parameters, executemany)}"
+            )
+
+    LOGGER.info(f"query timing enabled, slow queries above {SQL_SLOW_MS} ms")
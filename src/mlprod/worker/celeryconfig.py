@@ -1,3 +1,5 @@
+import os
+
 result_expires = 3600
 
 # Ignore other content
@@ -18,4 +20,54 @@ imports = (
 include = [
     "mlprod.worker.tasks.inference",
     "mlprod.worker.tasks.train",
+    "mlprod.worker.tasks.shadow",
+    "mlprod.worker.tasks.online",
+    "mlprod.worker.tasks.scheduler",
+    "mlprod.worker.tasks.maintenance",
 ]
+
+# candidate models are evaluated on a dedicated low-priority queue
+task_routes = {
+    "mlprod.worker.tasks.shadow.*": {"queue": "shadow"},
+}
+
+# periodic tasks, executed by Celery beat
+beat_schedule = dict()
+
+# interval in seconds between online updates of the active model, 0 to disable
+online_update_interval = float(os.environ.get("ONLINE_UPDATE_INTERVAL", "0"))
+
+if online_update_interval > 0:
+    beat_schedule["online-update"] = {
+        "task": "mlprod.worker.tasks.online.online_update",
+        "schedule": online_update_interval,
+    }
+
+# interval in seconds between checks for new labels to retrain a model, 0 to disable
+retrain_check_interval = float(os.environ.get("RETRAIN_CHECK_INTERVAL", "0"))
+
+if retrain_check_interval > 0:
+    beat_schedule["retraining-check"] = {
+        "task": "mlprod.worker.tasks.scheduler.retraining_check",
+        "schedule": retrain_check_interval,
+    }
+
+# interval in seconds between deletions of expired raw events, 0 to disable
+events_purge_interval = float(os.environ.get("EVENTS_PURGE_INTERVAL", "0"))
+
+if events_purge_interval > 0:
+    beat_schedule["purge-events"] = {
+        "task": "mlprod.worker.tasks.maintenance.purge_events",
+        "schedule": events_purge_interval,
+    }
+
+# interval in seconds between maintenances of the partitions and retention, 0 to disable
+partition_maintenance_interval = float(
+    os.environ.get("PARTITION_MAINTENANCE_INTERVAL", "0")
+)
+
+if partition_maintenance_interval > 0:
+    beat_schedule["partition-maintenance"] = {
+        "task": "mlprod.worker.tasks.maintenance.partition_maintenance",
+        "schedule": partition_maintenance_interval,
+    }
@@ -1,8 +1,21 @@
 __all__ = [
     "Model",
     "train_model",
+    "train_model_distributed",
+    "train_model_streaming",
+    "update_model_online",
+    "distill_model",
     "evaluate",
+    "bootstrap",
+    "confidence_interval",
+    "run_sweep",
 ]
 
 from mlprod.worker.models.pipeline import PipelineModel as Model
-from mlprod.worker.models.train import train_model, evaluate
+from mlprod.worker.models.train import train_model
+from mlprod.worker.models.distributed import train_model_distributed
+from mlprod.worker.models.streaming import train_model_streaming
+from mlprod.worker.models.online import update_model_online
+from mlprod.worker.models.distill import distill_model
+from mlprod.worker.models.evaluation import evaluate, bootstrap, confidence_interval
+from mlprod.worker.models.sweep import run_sweep
@@ -0,0 +1,115 @@
+from pathlib import Path
+from typing import Iterator
+
+from mlprod.worker.models.evaluation import evaluate
+from mlprod.worker.models.model import StudentModel
+from mlprod.worker.models.pipeline import PipelineModel, FILE_METADATA, FILE_STUDENT
+from mlprod.worker.models.train import train_epochs
+
+import torch
+
+import json
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger("mlprod.worker.models.distill")
+
+
+def distill_model(
+    teacher: PipelineModel,
+    X: np.ndarray,
+    X_test: np.ndarray,
+    Y_test: np.ndarray,
+    hidden_size: int = 8,
+    epochs: int = 20,
+    batch_size: int = 256,
+    learning_rate: float = 0.001,
+    random_state: int = 42,
+) -> dict[str, float]:
+    """Train a compact student network on the scores of a trained model.
+
+    The student uses the same pre-processing of the teacher and learns its scores (soft
+    labels) instead of the original labels, so any record can be used for training, also
+    without a label. The student is saved in the folder of the teacher and described in
+    the `student` entry of the teacher's metadata.
+
+    :param teacher:
+        Trained model to distil.
+    :param X:
+        Records used for distillation, not pre-processed (i.e. the combinations of users
+        and locations of the catalog).
+    :param X_test:
+        Records used to compare the student with the teacher, not pre-processed.
+    :param Y_test:
+        Labels of the test records, as a column vector.
+    :param hidden_size:
+        Number of hidden units of the student, 0 for a linear model (default: 8).
+    :param epochs:
+        Number of passes over the distillation records (default: 20).
+    :param batch_size:
+        Size of the mini-batches (default: 256).
+    :param learning_rate:
+        Learning rate of the Adam optimizer (default: 0.001).
+    :param random_state:
+        Seed for random generation (default: 42).
+
+    :return:
+        The loss of the student, its ROC AUC and the ROC AUC of the teacher on the test
+        records, and the mean absolute difference between their scores.
+    """
+    torch.manual_seed(random_state)
+    r = np.random.default_rng(random_state)
+
+    X_tr = teacher.transform(X)
+
+    with torch.no_grad():
+        Y_tr = teacher.model(torch.FloatTensor(X_tr)).numpy()
+
+    def batches() -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        ids = r.permutation(X_tr.shape[0])
+        for begin in range(0, ids.shape[0], batch_size):
+            batch = ids[begin : begin + batch_size]
+            yield X_tr[batch], Y_tr[batch]
+
+    LOGGER.info(
+        f"distillation: training student with {hidden_size} hidden units "
+        f"on {X_tr.shape[0]} records"
+    )
+
+    student = StudentModel(X_tr.shape[1], hidden_size).to("cpu")
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+
+    metrics = train_epochs(student, batches, epochs, [], optimizer=optimizer)
+
+    student.eval()
+
+    # compare student and teacher on the test records
+    X_ts = torch.FloatTensor(teacher.transform(X_test))
+
+    with torch.no_grad():
+        y_teacher = teacher.model(X_ts).numpy()
+        y_student = student(X_ts).numpy()
+
+    metrics["auc"] = evaluate(Y_test, y_student, ["auc"])["auc"]
+    metrics["teacher_auc"] = evaluate(Y_test, y_teacher, ["auc"])["auc"]
+    metrics["score_mae"] = float(np.abs(y_teacher - y_student).mean())
+
+    for k, v in metrics.items():
+        LOGGER.info(f"distillation metric {k}: {v:.4}")
+
+    # save next to the teacher
+    path = Path(teacher.path)
+
+    torch.save(student.state_dict(), path / FILE_STUDENT)
+
+    teacher.metadata["student"] = {
+        "hidden_size": hidden_size,
+        "n_records": X_tr.shape[0],
+    } | {k: float(v) for k, v in metrics.items()}
+
+    with open(path / FILE_METADATA, "w+") as f:
+        json.dump(teacher.metadata, f, indent=4)
+
+    LOGGER.info(f"distillation: student saved to {path / FILE_STUDENT}")
+
+    return metrics
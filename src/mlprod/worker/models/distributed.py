@@ -0,0 +1,200 @@
+from multiprocessing.queues import SimpleQueue
+from pathlib import Path
+from torch.nn.parallel import DistributedDataParallel
+
+from mlprod.worker.models.evaluation import evaluate
+from mlprod.worker.models.model import Model
+from mlprod.worker.models.parallel import (
+    get_mp_context,
+    limit_torch_threads,
+    threads_per_process,
+)
+from mlprod.worker.models.train import (
+    DEFAULT_MODELS_DIR,
+    balanced_batches,
+    fit_preprocessing,
+    save_model,
+    train_epochs,
+)
+
+import torch
+import torch.distributed as dist
+
+import pandas as pd
+import logging
+import numpy as np
+import socket
+
+LOGGER = logging.getLogger("mlprod.worker.models.distributed")
+
+
+def _free_port() -> int:
+    """Find a free local port for the process group rendezvous."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        port: int = s.getsockname()[1]
+        return port
+
+
+def _train_rank(
+    rank: int,
+    world_size: int,
+    port: int,
+    X: np.ndarray,
+    Y: np.ndarray,
+    path_state: Path,
+    epochs: int,
+    batch_size: int,
+    frac1: float,
+    random_state: int,
+    metrics_list: list[str],
+    results: SimpleQueue[dict[str, float]],
+) -> None:
+    """Training loop of a single process of the group."""
+    limit_torch_threads(threads_per_process(world_size))
+
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+    )
+
+    try:
+        # each rank samples only from its own shard of the records
+        X_rank = X[rank::world_size]
+        Y_rank = Y[rank::world_size]
+
+        n, x_output = X.shape
+
+        # the work of an epoch is split between the ranks
+        batch_count = int(n / (batch_size * world_size))
+        r = np.random.default_rng([random_state, rank])
+
+        # same initial weights everywhere, DDP also broadcasts the ones of rank 0
+        torch.manual_seed(random_state)
+        model = Model(x_output).to("cpu")
+        ddp_model = DistributedDataParallel(model)
+
+        metrics = train_epochs(
+            ddp_model,
+            lambda: balanced_batches(X_rank, Y_rank, batch_size, frac1, batch_count, r),
+            epochs,
+            [],
+        )
+
+        # metrics are computed on the predictions of all the ranks
+        with torch.no_grad():
+            model.eval()
+            y_preds = model(torch.FloatTensor(X_rank)).numpy().reshape(-1)
+
+        gathered = [None] * world_size if rank == 0 else None
+        dist.gather_object((Y_rank.reshape(-1), y_preds, metrics["loss"]), gathered)
+
+        if rank == 0:
+            y_trues = np.concatenate([g[0] for g in gathered])  # type: ignore
+            y_preds = np.concatenate([g[1] for g in gathered])  # type: ignore
+
+            metrics = {"loss": float(np.mean([g[2] for g in gathered]))}  # type: ignore
+            metrics = metrics | evaluate(y_trues, y_preds, metrics_list)
+
+            torch.save(model.state_dict(), path_state)
+            results.put(metrics)
+
+    finally:
+        dist.destroy_process_group()
+
+
+def train_model_distributed(
+    dataset: pd.DataFrame,
+    path: Path = DEFAULT_MODELS_DIR,
+    world_size: int = 2,
+    k_best: int = 20,
+    epochs: int = 100,
+    batch_size: int = 8,
+    frac1: float = 0.5,
+    random_state: int = 42,
+    metrics_list: list[str] = list(),
+) -> dict[str, float]:
+    """Train the model with data parallelism over multiple local processes.
+
+    The pre-processing is fitted once, then each process trains a replica of the network
+    on its own shard of the records, with its own balanced sampling. Gradients are
+    averaged between the processes with the `gloo` backend of torch distributed.
+
+    Metrics are computed on the predictions of the trained network over all the
+    records, not on the last epoch as in `train_model`.
+
+    :param dataset:
+        Pandas' DataFrame for training.
+    :param world_size:
+        Number of processes to use (default: 2).
+
+    For the other parameters, see `train_model`.
+
+    :return:
+        A dictionary with the value of each tracked metric.
+    """
+    n_records, x_input = dataset.drop("label", axis=1).shape
+
+    X, Y = fit_preprocessing(dataset, path, k_best)
+
+    port = _free_port()
+
+    LOGGER.info(f"training: starting {world_size} processes on port {port}")
+
+    ctx = get_mp_context()
+    results: SimpleQueue[dict[str, float]] = ctx.SimpleQueue()
+    path_state = path / "state.tmp"
+
+    processes = [
+        ctx.Process(  # type: ignore[attr-defined]
+            target=_train_rank,
+            args=(
+                rank,
+                world_size,
+                port,
+                X,
+                Y,
+                path_state,
+                epochs,
+                batch_size,
+                frac1,
+                random_state,
+                metrics_list,
+                results,
+            ),
+        )
+        for rank in range(world_size)
+    ]
+
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Distributed training failed on ranks {failed}")
+
+    metrics: dict[str, float] = results.get()
+
+    for k, v in metrics.items():
+        LOGGER.info(f"train metric {k}: {v:.4}")
+
+    _, x_output = X.shape
+
+    model = Model(x_output)
+    model.load_state_dict(torch.load(path_state))
+    path_state.unlink()
+
+    save_model(
+        model,
+        path,
+        dataset.drop("label", axis=1).columns.to_list(),
+        x_input,
+        n_records,
+        random_state,
+    )
+
+    return metrics
@@ -0,0 +1,199 @@
+from joblib import Parallel, delayed
+from numpy.typing import ArrayLike
+
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger("mlprod.worker.models.evaluation")
+
+
+class _SortedScores:
+    """Scores sorted once, with the groups of tied values, shared by all the metrics."""
+
+    def __init__(self, y_trues: ArrayLike, y_preds: ArrayLike) -> None:
+        y_trues = np.asarray(y_trues).reshape(-1).astype(bool)
+        y_preds = np.asarray(y_preds, dtype="float").reshape(-1)
+
+        if y_trues.shape != y_preds.shape:
+            raise ValueError("True values and predictions have different sizes!")
+
+        self.n: int = y_trues.shape[0]
+
+        # the only sort: ascending scores
+        self.order: np.ndarray = np.argsort(y_preds, kind="mergesort")
+
+        self.y_trues: np.ndarray = y_trues[self.order]
+        self.y_preds: np.ndarray = y_preds[self.order]
+
+        # groups of tied scores, as start index of each group
+        distinct = np.ones(self.n, dtype=bool)
+        distinct[1:] = self.y_preds[1:] != self.y_preds[:-1]
+        self.group_starts: np.ndarray = np.flatnonzero(distinct)
+
+    def metrics(
+        self, weights: np.ndarray, metrics_list: list[str], pred_threshold: float
+    ) -> dict[str, np.ndarray]:
+        """Compute the metrics for a batch of weights over the records.
+
+        :param weights:
+            Matrix of shape (batches, records) with the weight of each record, in the
+            order of the sorted scores. A row of ones gives the plain metrics.
+        :param metrics_list:
+            List of metrics to compute.
+        :param pred_threshold:
+            Threshold for class definition.
+
+        :return:
+            A dictionary with an array of values, one for each row of the weights.
+        """
+        w_pos = weights * self.y_trues
+        w_neg = weights * ~self.y_trues
+
+        metrics: dict[str, np.ndarray] = dict()
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if "auc" in metrics_list:
+                # Mann-Whitney statistic over the groups of tied scores
+                pos = np.add.reduceat(w_pos, self.group_starts, axis=1)
+                neg = np.add.reduceat(w_neg, self.group_starts, axis=1)
+                neg_below = np.cumsum(neg, axis=1) - neg
+
+                num = (pos * (neg_below + 0.5 * neg)).sum(axis=1)
+                metrics["auc"] = num / (pos.sum(axis=1) * neg.sum(axis=1))
+
+            # scores are sorted: predicted positives are a suffix of the records
+            cut = np.searchsorted(self.y_preds, pred_threshold, side="right")
+
+            # confusion matrix
+            tp = w_pos[:, cut:].sum(axis=1)
+            fp = w_neg[:, cut:].sum(axis=1)
+            fn = w_pos[:, :cut].sum(axis=1)
+            tn = w_neg[:, :cut].sum(axis=1)
+
+            pre = np.nan_to_num(tp / (tp + fp))
+            rec = np.nan_to_num(tp / (tp + fn))
+
+            if "acc" in metrics_list:
+                metrics["acc"] = (tp + tn) / (tp + tn + fp + fn)
+            if "pre" in metrics_list:
+                metrics["pre"] = pre
+            if "rec" in metrics_list:
+                metrics["rec"] = rec
+            if "f1" in metrics_list:
+                metrics["f1"] = np.nan_to_num(2 * tp / (2 * tp + fp + fn))
+
+        return metrics
+
+
+def evaluate(
+    y_trues: ArrayLike,
+    y_preds: ArrayLike,
+    metrics_list: list[str],
+    pred_threshold: float = 0.5,
+) -> dict[str, float]:
+    """Evaluate the performance over a list of given metrics.
+
+    All the metrics are computed in a single pass: the scores are sorted once for the
+    ROC AUC and the other metrics are derived from the same confusion matrix.
+
+    :param y_trues:
+        True values to test against.
+    :param y_preds:
+        Direct output values of the model (discretization is done internally).
+    :param metrics_list:
+        List of metrics to track. Possible values are `auc` (ROC AUC curve), `acc` (accuracy),
+        `pre` (Precision), `rec` (Recall), `f1` (f1 score).
+    :param pred_threshold:
+        Threshold for class definition: 1 above this threshold, otherwise class 0.
+
+    :return:
+        A dictionary with the metric value for each metric entry in the `metrics_list` argument.
+    """
+    scores = _SortedScores(y_trues, y_preds)
+    weights = np.ones((1, scores.n))
+
+    metrics = scores.metrics(weights, metrics_list, pred_threshold)
+
+    if "auc" in metrics and np.isnan(metrics["auc"][0]):
+        raise ValueError("ROC AUC is not defined when only one class is present!")
+
+    return {k: v[0].item() for k, v in metrics.items()}
+
+
+def bootstrap(
+    y_trues: ArrayLike,
+    y_preds: ArrayLike,
+    metrics_list: list[str],
+    pred_threshold: float = 0.5,
+    n_resamples: int = 1000,
+    batch_size: int = 100,
+    random_state: int = 42,
+    n_jobs: int = -1,
+) -> dict[str, np.ndarray]:
+    """Distribution of the metrics over bootstrap resamples of the records.
+
+    Each resample is represented by the number of times each record is drawn, so the
+    scores are sorted only once. Batches of resamples are evaluated in parallel.
+
+    Resamples depend only on the `random_state` and the number of records, therefore
+    two models evaluated on the same records with the same seed are paired: the
+    difference of their distributions is the distribution of the difference.
+
+    :param y_trues:
+        True values to test against.
+    :param y_preds:
+        Direct output values of the model.
+    :param metrics_list:
+        List of metrics to track, see `evaluate` for possible values.
+    :param pred_threshold:
+        Threshold for class definition: 1 above this threshold, otherwise class 0.
+    :param n_resamples:
+        Number of bootstrap resamples (default: 1000).
+    :param batch_size:
+        Number of resamples evaluated together by a single job (default: 100).
+    :param random_state:
+        Seed for random generation (default: 42).
+    :param n_jobs:
+        Number of parallel jobs (default: -1, which means one for each core).
+
+    :return:
+        A dictionary with an array of `n_resamples` values for each metric.
+    """
+    scores = _SortedScores(y_trues, y_preds)
+
+    seeds = np.random.SeedSequence(random_state).spawn(
+        int(np.ceil(n_resamples / batch_size))
+    )
+    sizes = [min(batch_size, n_resamples - i * batch_size) for i in range(len(seeds))]
+
+    def _batch(seed: np.random.SeedSequence, size: int) -> dict[str, np.ndarray]:
+        r = np.random.default_rng(seed)
+        counts = r.multinomial(scores.n, np.full(scores.n, 1 / scores.n), size=size)
+        # draws are in the order of the records, weights in the order of the scores
+        return scores.metrics(counts[:, scores.order], metrics_list, pred_threshold)
+
+    # numpy releases the GIL, threads avoid copying the data to other processes
+    batches = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_batch)(s, n) for s, n in zip(seeds, sizes)
+    )
+
+    return {k: np.concatenate([b[k] for b in batches]) for k in batches[0].keys()}
+
+
+def confidence_interval(
+    samples: np.ndarray, alpha: float = 0.05
+) -> tuple[float, float]:
+    """Percentile confidence interval of a bootstrap distribution.
+
+    Undefined values (i.e. ROC AUC of resamples with a single class) are ignored.
+
+    :param samples:
+        Values of a metric, one for each resample.
+    :param alpha:
+        Significance level (default: 0.05, for a 95% interval).
+
+    :return:
+        Lower and upper bound of the interval.
+    """
+    low, high = np.nanquantile(samples, [alpha / 2, 1 - alpha / 2])
+    return float(low), float(high)
@@ -14,6 +14,8 @@ class Model(nn.Module):
         """
         super(Model, self).__init__()
 
+        self.input_size = input_size
+
         self.layers = [
             nn.Linear(input_size, 64),
             nn.Dropout(0.3),
@@ -33,3 +35,44 @@ class Model(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward pass of the model."""
         return self.net(x)
+
+
+class StudentModel(nn.Module):
+    """This is a compact network trained to reproduce the scores of a `Model`."""
+
+    def __init__(self, input_size: int = 20, hidden_size: int = 8) -> None:
+        """Creates a new student model instance.
+
+        :param input_size:
+            Number of input features.
+        :param hidden_size:
+            Number of units of the hidden layer. With 0, the model is a logistic
+            regression on the input features.
+        """
+        super(StudentModel, self).__init__()
+
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+
+        if hidden_size > 0:
+            self.layers = [
+                nn.Linear(input_size, hidden_size),
+                nn.ReLU(),
+                nn.Linear(hidden_size, 1),
+                nn.Sigmoid(),
+            ]
+        else:
+            self.layers = [
+                nn.Linear(input_size, 1),
+                nn.Sigmoid(),
+            ]
+
+        self.net = nn.Sequential(*self.layers)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        """Applies the model to the input data."""
+        return super().__call__(x)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward pass of the model."""
+        return self.net(x)
@@ -0,0 +1,64 @@
+from typing import Iterator
+
+from mlprod.worker.models.model import Model
+from mlprod.worker.models.train import train_epochs
+
+import torch
+
+import copy
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger("mlprod.worker.models.online")
+
+
+def update_model_online(
+    model: Model,
+    X: np.ndarray,
+    Y: np.ndarray,
+    batch_size: int = 16,
+    learning_rate: float = 0.01,
+    epochs: int = 1,
+    random_state: int = 42,
+) -> tuple[Model, dict[str, float]]:
+    """Apply a few SGD steps on new data to a copy of a trained network.
+
+    The given network is not modified.
+
+    :param model:
+        Trained network to update.
+    :param X:
+        New records, already pre-processed.
+    :param Y:
+        Labels of the new records, as a column vector.
+    :param batch_size:
+        Size of the mini-batches (default: 16).
+    :param learning_rate:
+        Learning rate of the SGD optimizer (default: 0.01).
+    :param epochs:
+        Number of passes over the new records (default: 1).
+    :param random_state:
+        Seed for random generation (default: 42).
+
+    :return:
+        The updated copy of the network and the loss on the new records.
+    """
+    updated = copy.deepcopy(model)
+
+    r = np.random.default_rng(random_state)
+
+    def batches() -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        ids = r.permutation(X.shape[0])
+        for begin in range(0, ids.shape[0], batch_size):
+            batch = ids[begin : begin + batch_size]
+            yield X[batch], Y[batch]
+
+    optimizer = torch.optim.SGD(updated.parameters(), lr=learning_rate)
+
+    metrics = train_epochs(updated, batches, epochs, [], optimizer=optimizer)
+
+    updated.eval()
+
+    LOGGER.info(f"online: updated on {X.shape[0]} records, loss={metrics['loss']:.4}")
+
+    return updated, metrics
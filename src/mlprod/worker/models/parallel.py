@@ -0,0 +1,58 @@
+from multiprocessing.context import BaseContext
+
+import logging
+import multiprocessing
+import os
+
+import torch
+
+LOGGER = logging.getLogger("mlprod.worker.models.parallel")
+
+
+def available_cores() -> int:
+    """Number of CPU cores this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on all platforms (i.e. macOS)
+        return os.cpu_count() or 1
+
+
+def threads_per_process(n_processes: int) -> int:
+    """Number of torch threads each process can use without oversubscribing the cores.
+
+    :param n_processes:
+        Number of processes that will run concurrently.
+    """
+    return max(1, available_cores() // max(1, n_processes))
+
+
+def limit_torch_threads(n_threads: int) -> None:
+    """Limit the number of threads torch uses in the current process.
+
+    Used as initializer for the processes in a pool.
+
+    :param n_threads:
+        Maximum number of intra-op threads.
+    """
+    torch.set_num_threads(n_threads)
+    LOGGER.debug(f"process {os.getpid()} limited to {n_threads} torch threads")
+
+
+def get_mp_context(method: str = "spawn") -> BaseContext:
+    """Get a multiprocessing context that is allowed to create child processes.
+
+    Celery's prefork workers are daemonic processes and the standard library does not
+    allow them to have children. In this case, the context is taken from *billiard*,
+    the fork of multiprocessing used by Celery, which does not have this limitation.
+
+    :param method:
+        Start method for the processes (default: spawn, safe to use with torch).
+    """
+    if multiprocessing.current_process().daemon:
+        import billiard
+
+        context: BaseContext = billiard.get_context(method)
+        return context
+
+    return multiprocessing.get_context(method)
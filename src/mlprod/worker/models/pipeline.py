@@ -1,4 +1,4 @@
-from .model import Model
+from .model import Model, StudentModel
 
 from sklearn.feature_selection import SelectKBest
 from sklearn.preprocessing import MinMaxScaler
@@ -17,6 +17,7 @@ FILE_METADATA: str = "metadata.json"
 FILE_MMS: str = "mms.model"
 FILE_SKB: str = "skb.model"
 FILE_MODEL: str = "neuralnet.model"
+FILE_STUDENT: str = "student.model"
 
 DEFAULT_MODELS_PATH = Path("./models/")
 
@@ -29,7 +30,9 @@ class PipelineModel:
     disk.
     """
 
-    def __init__(self, path: Path = DEFAULT_MODELS_PATH) -> None:
+    def __init__(
+        self, path: Path = DEFAULT_MODELS_PATH, student_tolerance: float | None = None
+    ) -> None:
         """Creates a new model by loading the required data from the given path.
 
         :param path:
@@ -39,6 +42,11 @@ class PipelineModel:
             - skb.model
             - neuralnet.model
             These files are produced both by the notebook and by the training tasks.
+            The folder can also contain a distilled student model (student.model).
+        :param student_tolerance:
+            If set, and a student model is available, the student is used for scoring
+            when its ROC AUC is lower than the AUC of the full model by at most this
+            value (default: None, the full model is always used).
         """
         super().__init__()
 
@@ -51,6 +59,7 @@ class PipelineModel:
         self.path_mms: str = str(os.path.join(self.path, FILE_MMS))
         self.path_skb: str = str(os.path.join(self.path, FILE_SKB))
         self.path_model: str = str(os.path.join(self.path, FILE_MODEL))
+        self.path_student: str = str(os.path.join(self.path, FILE_STUDENT))
 
         LOGGER.info(f"Load metadata from {self.path_metadata}")
 
@@ -69,9 +78,46 @@ class PipelineModel:
         nn_state_dict = torch.load(self.path_model)
         self.model: Model = Model(self.metadata["x_output"])
         self.model.load_state_dict(nn_state_dict)
+        self.model.eval()
+
+        # network used for scoring
+        self.network: torch.nn.Module = self.model
+        self.student: StudentModel | None = None
+
+        if student_tolerance is not None and "student" in self.metadata:
+            info = self.metadata["student"]
+            auc_drop = info["teacher_auc"] - info["auc"]
+
+            if auc_drop <= student_tolerance:
+                LOGGER.info(
+                    f"Loading student model from {self.path_student}, "
+                    f"ROC AUC drop {auc_drop:.4}"
+                )
+                self.student = StudentModel(self.model.input_size, info["hidden_size"])
+                self.student.load_state_dict(torch.load(self.path_student))
+                self.student.eval()
+                self.network = self.student
+            else:
+                LOGGER.info(
+                    f"Student model not used, ROC AUC drop {auc_drop:.4} "
+                    f"above tolerance {student_tolerance:.4}"
+                )
 
         LOGGER.info("All artifacts loaded")
 
+    def transform(self, x: np.ndarray) -> np.ndarray:
+        """Applies only the pre-processing to the input data.
+
+        :param x:
+            Input values. Can be a single record or multiple records.
+
+        :return:
+            The features used as input by the neural network.
+        """
+        x_temp = self.mms.transform(x)
+        features: np.ndarray = self.skb.transform(x_temp)
+        return features
+
     def __call__(self, x: np.ndarray) -> np.ndarray:
         """Applies the pipeline to the input data.
 
@@ -81,10 +127,8 @@ class PipelineModel:
         :return:
             A score value for each input record.
         """
-        x_temp = self.mms.transform(x)
-        x_temp = self.skb.transform(x_temp)
-
-        x_temp = torch.FloatTensor(x_temp)
+        x_temp = torch.FloatTensor(self.transform(x))
 
-        y = self.model(x_temp)
+        with torch.no_grad():
+            y = self.network(x_temp)
         return y.detach().numpy().astype("float")
@@ -0,0 +1,170 @@
+from pathlib import Path
+from scipy.stats import chi2 as chi2_distribution
+from sklearn.feature_selection import SelectKBest, chi2
+from sklearn.preprocessing import MinMaxScaler
+from typing import Callable, Iterable, Iterator
+
+from mlprod.worker.models.model import Model
+from mlprod.worker.models.pipeline import FILE_MMS, FILE_SKB
+from mlprod.worker.models.train import (
+    DEFAULT_MODELS_DIR,
+    balanced_batches,
+    save_model,
+    train_epochs,
+)
+
+import pandas as pd
+import joblib
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger("mlprod.worker.models.streaming")
+
+Chunks = Callable[[], Iterable[pd.DataFrame]]
+
+
+def _split(chunk: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """Split a chunk in features and labels."""
+    X = chunk.drop("label", axis=1).values
+    Y = chunk["label"].values.reshape(-1, 1)  # type: ignore
+    return X, Y
+
+
+def fit_preprocessing_streaming(
+    chunks: Chunks, path: Path, k_best: int = 20
+) -> tuple[MinMaxScaler, SelectKBest, list[str], int]:
+    """Fit and save the pre-processing models with two passes over the chunks.
+
+    The first pass fits the MinMaxScaler incrementally. The second pass accumulates the
+    statistics of the chi-squared test on the scaled values: the sum of the features
+    for each class and the number of records for each class.
+
+    :param chunks:
+        Function that returns a new iterable over the chunks of the dataset.
+    :param path:
+        Folder where the pre-processing models are saved.
+    :param k_best:
+        Number of features to extract with SelectKBest algorithm (default: 20).
+
+    :return:
+        The fitted models, the list of features, and the number of records.
+    """
+    path_mms: Path = path / FILE_MMS
+    path_skb: Path = path / FILE_SKB
+
+    # Preprocessing: MinMaxScaler ---------------------------------------------
+    mms = MinMaxScaler()
+    features: list[str] = []
+    n_records = 0
+
+    for chunk in chunks():
+        if not features:
+            features = chunk.drop("label", axis=1).columns.to_list()
+
+        X, _ = _split(chunk)
+        mms.partial_fit(X)
+        n_records += X.shape[0]
+
+    if n_records == 0:
+        raise ValueError("Dataset is empty!")
+
+    joblib.dump(mms, path_mms)
+
+    LOGGER.info(f"training: MinMaxScaler fitted on {n_records} records")
+
+    # Preprocessing: FeatureSelection -----------------------------------------
+    observed = np.zeros((2, len(features)))
+    class_count = np.zeros(2)
+
+    for chunk in chunks():
+        X, Y = _split(chunk)
+        X = mms.transform(X)
+        y = Y.reshape(-1) > 0
+
+        observed[0] += X[~y].sum(axis=0)
+        observed[1] += X[y].sum(axis=0)
+        class_count += [(~y).sum(), y.sum()]
+
+    # same statistic as sklearn's chi2 with two classes
+    class_prob = class_count / class_count.sum()
+    expected = np.outer(class_prob, observed.sum(axis=0))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = ((observed - expected) ** 2 / expected).sum(axis=0)
+
+    skb = SelectKBest(chi2, k=k_best)
+    skb.scores_ = scores
+    skb.pvalues_ = chi2_distribution.sf(scores, 1)
+    skb.n_features_in_ = len(features)
+
+    joblib.dump(skb, path_skb)
+
+    LOGGER.info(f"training: SelectKBest saved to {path_skb}")
+
+    return mms, skb, features, n_records
+
+
+def train_model_streaming(
+    chunks: Chunks,
+    path: Path = DEFAULT_MODELS_DIR,
+    k_best: int = 20,
+    epochs: int = 100,
+    batch_size: int = 8,
+    frac1: float = 0.5,
+    random_state: int = 42,
+    metrics_list: list[str] = list(),
+    track_batches: int = 1000,
+) -> dict[str, float]:
+    """Train the model without loading the whole dataset in memory.
+
+    The dataset is read as a sequence of chunks: peak memory depends on the size of a
+    chunk and not on the size of the dataset. Each chunk is read once to fit the
+    MinMaxScaler, once to fit the SelectKBest, and once for each epoch. Balanced
+    mini-batches are sampled inside each chunk.
+
+    :param chunks:
+        Function that returns a new iterable over the chunks of the dataset. Each chunk
+        is a Pandas' DataFrame with a `label` column. The order must be the same on
+        each call.
+    :param track_batches:
+        Number of mini-batches at the end of the last epoch used to compute the
+        metrics (default: 1000).
+
+    For the other parameters, see `train_model`.
+
+    :return:
+        A dictionary with the value of each tracked metric.
+    """
+    mms, skb, features, n_records = fit_preprocessing_streaming(chunks, path, k_best)
+
+    # Training: setup ---------------------------------------------------------
+    x_input = len(features)
+    x_output = int(skb.get_support().sum())
+
+    r = np.random.default_rng(random_state)
+
+    LOGGER.info(f"training: creating model with input {x_output}")
+
+    model = Model(x_output).to("cpu")
+
+    def batches() -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        for chunk in chunks():
+            X, Y = _split(chunk)
+            X = skb.transform(mms.transform(X))
+
+            if Y.min() == Y.max():
+                LOGGER.warning("training: skipped chunk with a single class")
+                continue
+
+            batch_count = int(X.shape[0] / batch_size)
+            yield from balanced_batches(X, Y, batch_size, frac1, batch_count, r)
+
+    # Training: run -----------------------------------------------------------
+    metrics = train_epochs(model, batches, epochs, metrics_list, track_batches)
+
+    for k, v in metrics.items():
+        LOGGER.info(f"train metric {k}: {v:.4}")
+
+    save_model(model, path, features, x_input, n_records, random_state)
+
+    return metrics
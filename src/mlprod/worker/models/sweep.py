@@ -0,0 +1,199 @@
+from itertools import product
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+
+from mlprod.worker.models.parallel import (
+    get_mp_context,
+    limit_torch_threads,
+    threads_per_process,
+    available_cores,
+)
+from mlprod.worker.models.evaluation import evaluate
+from mlprod.worker.models.pipeline import PipelineModel
+from mlprod.worker.models.train import train_model
+
+import json
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+LOGGER = logging.getLogger("mlprod.worker.models.sweep")
+
+FILE_SWEEP: str = "sweep.json"
+
+DEFAULT_GRID: dict[str, list[Any]] = {
+    "k_best": [10, 15, 20],
+    "epochs": [50, 100],
+    "batch_size": [8, 32],
+    "frac1": [0.5],
+}
+
+# data shared with all the trials of a pool, set once per process by the initializer
+_TRIAL_DATA: dict[str, Any] = {}
+
+
+def expand_grid(grid: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    """Expand a grid of parameters in the list of all its combinations.
+
+    :param grid:
+        Dictionary with a list of values for each parameter of `train_model`.
+
+    :return:
+        A list of dictionaries, one for each combination of parameters.
+    """
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in product(*grid.values())]
+
+
+def _init_trial(
+    n_threads: int,
+    df_train: pd.DataFrame,
+    df_valid: pd.DataFrame,
+    metrics_list: list[str],
+) -> None:
+    """Initializer of each process of the pool: limit threads and store shared data."""
+    limit_torch_threads(n_threads)
+
+    _TRIAL_DATA["train"] = df_train
+    _TRIAL_DATA["valid"] = df_valid
+    _TRIAL_DATA["metrics"] = metrics_list
+
+
+def _run_trial(trial: int, path: Path, params: dict[str, Any]) -> dict[str, Any]:
+    """Train and evaluate a single configuration of parameters."""
+    df_train: pd.DataFrame = _TRIAL_DATA["train"]
+    df_valid: pd.DataFrame = _TRIAL_DATA["valid"]
+    metrics_list: list[str] = _TRIAL_DATA["metrics"]
+
+    os.makedirs(path, exist_ok=True)
+
+    LOGGER.info(f"sweep: trial {trial} started with params {params}")
+
+    begin = perf_counter()
+
+    metrics_tr = train_model(df_train, path=path, metrics_list=metrics_list, **params)
+
+    time_train = perf_counter() - begin
+
+    # evaluate on the validation split
+    X = df_valid.drop("label", axis=1).values
+    Y = df_valid["label"].values.reshape(-1, 1)  # type: ignore
+
+    y_preds = PipelineModel(path)(X)
+    metrics_va = evaluate(Y, y_preds, metrics_list)
+
+    time_total = perf_counter() - begin
+
+    LOGGER.info(f"sweep: trial {trial} completed in {time_total:.2f}s")
+
+    return {
+        "trial": trial,
+        "params": params,
+        "train": {k: float(v) for k, v in metrics_tr.items()},
+        "valid": {k: float(v) for k, v in metrics_va.items()},
+        "time_train": time_train,
+        "time_total": time_total,
+    }
+
+
+def run_sweep(
+    df_train: pd.DataFrame,
+    df_valid: pd.DataFrame,
+    path: Path,
+    grid: dict[str, list[Any]] | None = None,
+    metrics_list: list[str] = ["acc", "pre", "rec", "f1", "auc"],
+    target: str = "auc",
+    n_jobs: int = 0,
+) -> dict[str, Any]:
+    """Train several configurations in parallel and keep only the best one.
+
+    Each configuration is trained in its own process, in a sub-folder of the given path,
+    and evaluated on the validation split. The artifacts of the best configuration are
+    then copied to the given path, so that it can be loaded as a normal model. All the
+    trials, with their metrics and timings, are saved to the `sweep.json` file.
+
+    :param df_train:
+        Pandas' DataFrame for training.
+    :param df_valid:
+        Pandas' DataFrame for the evaluation of each trial. It must not be the data
+        later used to evaluate the chosen model, since the choice is biased toward it.
+    :param path:
+        Folder where the best model will be saved.
+    :param grid:
+        Dictionary with a list of values to test for each parameter of `train_model`
+        (default: None, which means `DEFAULT_GRID`).
+    :param metrics_list:
+        List of metrics to track, see `train_model` for possible values.
+    :param target:
+        Validation metric used to choose the best trial, higher is better (default: auc).
+    :param n_jobs:
+        Number of parallel processes (default: 0, which means one for each core,
+        limited by the number of configurations).
+
+    :return:
+        A dictionary with the best trial and the list of all trials.
+    """
+    if target not in metrics_list:
+        raise ValueError(f"Target metric {target} not in the list of metrics!")
+
+    configs = expand_grid(grid or DEFAULT_GRID)
+
+    if n_jobs <= 0:
+        n_jobs = available_cores()
+    n_jobs = min(n_jobs, len(configs))
+
+    n_threads = threads_per_process(n_jobs)
+
+    LOGGER.info(
+        f"sweep: {len(configs)} configurations on {n_jobs} processes "
+        f"with {n_threads} threads each"
+    )
+
+    sweep_dir = path / "sweep"
+    args = [(i, sweep_dir / f"trial.{i:03d}", c) for i, c in enumerate(configs)]
+
+    begin = perf_counter()
+
+    ctx = get_mp_context()
+    with ctx.Pool(
+        processes=n_jobs,
+        initializer=_init_trial,
+        initargs=(n_threads, df_train, df_valid, metrics_list),
+    ) as pool:
+        trials: list[dict[str, Any]] = pool.starmap(_run_trial, args)
+
+    time_sweep = perf_counter() - begin
+
+    best = max(trials, key=lambda t: t["valid"][target])
+
+    LOGGER.info(
+        f"sweep: completed in {time_sweep:.2f}s, best trial {best['trial']} "
+        f"with validation {target}={best['valid'][target]:.4} and params {best['params']}"
+    )
+
+    # promote the best trial as the model of this folder
+    best_dir = args[best["trial"]][1]
+    for file in best_dir.iterdir():
+        shutil.copy2(file, path / file.name)
+
+    results = {
+        "target": target,
+        "n_jobs": n_jobs,
+        "n_threads": n_threads,
+        "time_sweep": time_sweep,
+        "best": best,
+        "trials": trials,
+    }
+
+    with open(path / FILE_SWEEP, "w+") as f:
+        json.dump(results, f, indent=4)
+
+    LOGGER.info(f"sweep: results saved to {path / FILE_SWEEP}")
+
+    # artifacts of the other trials are not needed anymore
+    shutil.rmtree(sweep_dir)
+
+    return results
@@ -1,15 +1,12 @@
+from collections import deque
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 from sklearn.feature_selection import SelectKBest, chi2
-from sklearn.metrics import (
-    accuracy_score,
-    f1_score,
-    precision_score,
-    recall_score,
-    roc_auc_score,
-)
 from sklearn.preprocessing import MinMaxScaler
 
+from mlprod.worker.models.evaluation import evaluate
 from mlprod.worker.models.model import Model
+from mlprod.worker.models.pipeline import FILE_METADATA, FILE_MMS, FILE_SKB, FILE_MODEL
 
 import torch
 import torch.nn as nn
@@ -25,47 +22,27 @@ LOGGER = logging.getLogger("mlprod.worker.models.train")
 DEFAULT_MODELS_DIR = Path("./models")
 
 
-def train_model(
-    dataset: pd.DataFrame,
-    path: Path = DEFAULT_MODELS_DIR,
-    k_best: int = 20,
-    epochs: int = 100,
-    batch_size: int = 8,
-    frac1: float = 0.5,
-    random_state: int = 42,
-    metrics_list: list[str] = list(),
-) -> dict[str, dict[str, list[float]]]:
-    """Train the model. If required it can also evaluate the model against a test set.
+def fit_preprocessing(
+    dataset: pd.DataFrame, path: Path, k_best: int = 20
+) -> tuple[np.ndarray, np.ndarray]:
+    """Fit and save the pre-processing models, then transform the dataset.
 
     :param dataset:
-        Pandas' DataFrame for training.
+        Pandas' DataFrame for training, with a `label` column.
+    :param path:
+        Folder where the pre-processing models are saved.
     :param k_best:
         Number of features to extract with SelectKBest algorithm (default: 20).
-    :param epochs:
-        Number of epochs to run during training (default: 100).
-    :param batch_size:
-        Size of the mini-batches (default: 8).
-    :param frac1:
-        Proportion of the labels equal to 1 (default: 0.5 which mean same quantity as 0).
-    :param random_state:
-        Seed for random generation (default: 42).
-    :param metrics_list:
-        List of metrics to check for evaluation, also with the test set if availble. (Default: None, which means no metrics except Loss will be tracked).
-        Possible values are `auc` (ROC AUC curve), `acc` (accuracy), `pre` (Precision), `rec` (Recall), `f1` (f1 score).
 
     :return:
-        A dictionary with a list of results for each tracked metric.
+        The transformed features and the labels, as a column vector.
     """
-    path_mms: Path = path / "mms.model"
-    path_skb: Path = path / "skb.model"
-    path_model: Path = path / "neuralnet.model"
-    path_metadata: Path = path / "metadata.json"
+    path_mms: Path = path / FILE_MMS
+    path_skb: Path = path / FILE_SKB
 
     X = dataset.drop("label", axis=1).values
     Y = dataset["label"].values.reshape(-1, 1)  # type: ignore
 
-    n_records, x_input = X.shape
-
     # Preprocessing: MinMaxScaler ---------------------------------------------
     mms = MinMaxScaler()
     X = mms.fit_transform(X)
@@ -83,25 +60,39 @@ def train_model(
 
     LOGGER.info(f"training: SelectKBest saved to {path_skb}")
 
-    # Training: setup ---------------------------------------------------------
     if X.shape is None:
         raise ValueError("Shape of X input value is none!")
 
-    n, x_output = X.shape
+    return X, Y
 
-    batch_count = int(n / batch_size)
-    r = np.random.default_rng(random_state)
 
-    LOGGER.info(f"training: creating model with input {x_output}")
+def balanced_batches(
+    X: np.ndarray,
+    Y: np.ndarray,
+    batch_size: int,
+    frac1: float,
+    batch_count: int,
+    r: np.random.Generator,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Generates mini-batches with a fixed proportion of labels equal to 1.
 
-    model = Model(x_output).to("cpu")
+    Records are sampled with replacement from each class.
 
-    optimizer = torch.optim.Adam(model.parameters())
-    criterion = nn.BCELoss()
-
-    metrics = {"loss": []}
+    :param X:
+        Input features.
+    :param Y:
+        Labels, as a column vector.
+    :param batch_size:
+        Size of the mini-batches.
+    :param frac1:
+        Proportion of the labels equal to 1.
+    :param batch_count:
+        Number of mini-batches to generate.
+    :param r:
+        Random generator used for sampling.
+    """
+    n, _ = X.shape
 
-    # Training: run -----------------------------------------------------------
     mask = (Y == 0).reshape(-1)
 
     X_tr_0 = X[mask]
@@ -116,20 +107,65 @@ def train_model(
     batch0_size = min(n, int(batch_size * (1 - frac1)))
     batch1_size = min(n, int(batch_size * frac1))
 
+    for _ in range(batch_count):
+        sample_ids_0 = r.choice(n0, size=batch0_size)
+        sample_ids_1 = r.choice(n1, size=batch1_size)
+
+        x_tr = np.vstack((X_tr_0[sample_ids_0], X_tr_1[sample_ids_1]))
+        y_tr = np.vstack((Y_tr_0[sample_ids_0], Y_tr_1[sample_ids_1]))
+
+        yield x_tr, y_tr
+
+
+def train_epochs(
+    model: nn.Module,
+    batches: Callable[[], Iterable[tuple[np.ndarray, np.ndarray]]],
+    epochs: int,
+    metrics_list: list[str],
+    track_batches: int = 0,
+    optimizer: torch.optim.Optimizer | None = None,
+) -> dict[str, float]:
+    """Run the training loop of a model.
+
+    :param model:
+        Model to train, it can also be a wrapper of `Model` (i.e. for distributed
+        training).
+    :param batches:
+        Function that returns the mini-batches of an epoch.
+    :param epochs:
+        Number of epochs to run.
+    :param metrics_list:
+        List of metrics to track on the last epoch, see `evaluate` for possible values.
+    :param track_batches:
+        Number of mini-batches, at the end of the last epoch, used to compute the
+        metrics (default: 0, which means all of them).
+    :param optimizer:
+        Optimizer of the model parameters (default: None, which means Adam).
+
+    :return:
+        A dictionary with the value of each tracked metric on the last epoch.
+    """
+    if optimizer is None:
+        optimizer = torch.optim.Adam(model.parameters())
+    criterion = nn.BCELoss()
+
+    maxlen = track_batches or None
+
+    loss_btc: deque[float] = deque(maxlen=maxlen)
+    y_preds: deque[np.ndarray] = deque(maxlen=maxlen)
+    y_trues: deque[np.ndarray] = deque(maxlen=maxlen)
+
     for epoch in range(epochs):
         LOGGER.info(f"training: epoch {epoch}/{epochs}")
 
         # train
         model.train()
 
-        loss_btc, y_preds, y_trues = [], [], []
-        for _ in range(batch_count):
-            sample_ids_0 = r.choice(n0, size=batch0_size)
-            sample_ids_1 = r.choice(n1, size=batch1_size)
-
-            x_tr = np.vstack((X_tr_0[sample_ids_0], X_tr_1[sample_ids_1]))
-            y_tr = np.vstack((Y_tr_0[sample_ids_0], Y_tr_1[sample_ids_1]))
+        loss_btc.clear()
+        y_preds.clear()
+        y_trues.clear()
 
+        for x_tr, y_tr in batches():
             x = torch.FloatTensor(x_tr).to("cpu")
             y = torch.FloatTensor(y_tr).to("cpu")
 
@@ -144,24 +180,49 @@ def train_model(
             loss.backward()
             optimizer.step()
 
-            y_preds.append(out.detach().numpy())
-            y_trues.append(y_tr)
+            y_preds.append(out.detach().numpy().reshape(-1))
+            y_trues.append(y_tr.reshape(-1))
 
     LOGGER.info("training: completed")
 
-    y_preds = np.array(y_preds).reshape(-1)
-    y_trues = np.array(y_trues).reshape(-1)
-
     # Training: record metrics --------------------------------------------
     metrics = {}
 
-    loss_btc_mean = np.array(loss_btc).mean()
-    metrics["loss"] = loss_btc_mean
+    metrics["loss"] = np.array(loss_btc).mean()
 
-    metrics = metrics | evaluate(y_trues, y_preds, metrics_list)
+    if y_preds:
+        metrics = metrics | evaluate(
+            np.concatenate(y_trues), np.concatenate(y_preds), metrics_list
+        )
 
-    for k, v in metrics.items():
-        LOGGER.info(f"train metric {k}: {v:.4}")
+    return metrics
+
+
+def save_model(
+    model: Model,
+    path: Path,
+    features: list[str],
+    x_input: int,
+    n_records: int,
+    random_state: int,
+) -> None:
+    """Save the trained network and its metadata.
+
+    :param model:
+        Trained network.
+    :param path:
+        Folder where the model is saved.
+    :param features:
+        Input features, in order.
+    :param x_input:
+        Number of input features.
+    :param n_records:
+        Number of records used for training.
+    :param random_state:
+        Seed used for random generation.
+    """
+    path_model: Path = path / FILE_MODEL
+    path_metadata: Path = path / FILE_METADATA
 
     torch.save(model.state_dict(), path_model)
 
@@ -170,9 +231,9 @@ def train_model(
     with open(path_metadata, "w+") as f:
         json.dump(
             {
-                "features": dataset.drop("label", axis=1).columns.to_list(),
+                "features": features,
                 "x_input": x_input,
-                "x_output": x_output,
+                "x_output": model.input_size,
                 "n_records": n_records,
                 "seed": random_state,
             },
@@ -182,42 +243,70 @@ def train_model(
 
     LOGGER.info(f"training: metadata saved to {path_metadata}")
 
-    return metrics
-
 
-def evaluate(
-    y_trues, y_preds, metrics_list: list[str], pred_threshold: float = 0.5
+def train_model(
+    dataset: pd.DataFrame,
+    path: Path = DEFAULT_MODELS_DIR,
+    k_best: int = 20,
+    epochs: int = 100,
+    batch_size: int = 8,
+    frac1: float = 0.5,
+    random_state: int = 42,
+    metrics_list: list[str] = list(),
 ) -> dict[str, float]:
-    """Evaluate the performance over a list of given metrics.
+    """Train the model. If required it can also evaluate the model against a test set.
 
-    :param y_trues:
-        True values to test against.
-    :param y_preds:
-        Direct output values of the model (discretization is done internally).
+    :param dataset:
+        Pandas' DataFrame for training.
+    :param k_best:
+        Number of features to extract with SelectKBest algorithm (default: 20).
+    :param epochs:
+        Number of epochs to run during training (default: 100).
+    :param batch_size:
+        Size of the mini-batches (default: 8).
+    :param frac1:
+        Proportion of the labels equal to 1 (default: 0.5 which mean same quantity as 0).
+    :param random_state:
+        Seed for random generation (default: 42).
     :param metrics_list:
-        List of metrics to track. Possible values are `auc` (ROC AUC curve), `acc` (accuracy),
-        `pre` (Precision), `rec` (Recall), `f1` (f1 score).
-    :param pred_threshold:
-        Threshold for class definition: 1 above this threshold, otherwise class 0.
+        List of metrics to check for evaluation, also with the test set if availble. (Default: None, which means no metrics except Loss will be tracked).
+        Possible values are `auc` (ROC AUC curve), `acc` (accuracy), `pre` (Precision), `rec` (Recall), `f1` (f1 score).
 
     :return:
-        A dictionary with the metric value for each metric entry in the `metrics_list` argument.
+        A dictionary with a list of results for each tracked metric.
     """
-    metrics = dict()
-
-    if "auc" in metrics_list:
-        metrics["auc"] = roc_auc_score(y_trues, y_preds)
-
-    # discretize
-    y_preds = (y_preds > pred_threshold).astype("int")
-
-    if "acc" in metrics_list:
-        metrics["acc"] = accuracy_score(y_trues, y_preds)
-    if "pre" in metrics_list:
-        metrics["pre"] = recall_score(y_trues, y_preds, zero_division=0)
-    if "rec" in metrics_list:
-        metrics["rec"] = precision_score(y_trues, y_preds, zero_division=0)
-    if "f1" in metrics_list:
-        metrics["f1"] = f1_score(y_trues, y_preds, zero_division=0)
+    n_records, x_input = dataset.drop("label", axis=1).shape
+
+    X, Y = fit_preprocessing(dataset, path, k_best)
+
+    # Training: setup ---------------------------------------------------------
+    n, x_output = X.shape
+
+    batch_count = int(n / batch_size)
+    r = np.random.default_rng(random_state)
+
+    LOGGER.info(f"training: creating model with input {x_output}")
+
+    model = Model(x_output).to("cpu")
+
+    # Training: run -----------------------------------------------------------
+    metrics = train_epochs(
+        model,
+        lambda: balanced_batches(X, Y, batch_size, frac1, batch_count, r),
+        epochs,
+        metrics_list,
+    )
+
+    for k, v in metrics.items():
+        LOGGER.info(f"train metric {k}: {v:.4}")
+
+    save_model(
+        model,
+        path,
+        dataset.drop("label", axis=1).columns.to_list(),
+        x_input,
+        n_records,
+        random_state,
+    )
 
     return metrics
@@ -1,16 +1,58 @@
 from celery import Task
 from pathlib import Path
+from sqlalchemy.orm import Session
 
-from mlprod.database import DataBase, crud
+from mlprod.database import DataBase, cache, crud
 from mlprod.worker.celery import worker
 from mlprod.worker.models import Model
 
+import numpy as np
 import pandas as pd
 import logging
+import os
+import random
 
 
 LOGGER = logging.getLogger("mlprod.worker.tasks.inference")
 
+# fraction of the inference requests also scored by a candidate model in shadow mode
+SHADOW_SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", "0.0"))
+# maximum drop in ROC AUC of a distilled student to serve it instead of the full model
+STUDENT_TOLERANCE = float(os.environ.get("STUDENT_TOLERANCE", "0.01"))
+# how the scores are stored: "rows" (a result for each location) or "packed" (arrays)
+RESULTS_STORAGE = os.environ.get("RESULTS_STORAGE", "rows")
+
+if RESULTS_STORAGE not in ("rows", "packed"):
+    raise ValueError(
+        f"Unknown RESULTS_STORAGE {RESULTS_STORAGE}, must be rows or packed"
+    )
+
+
+def prepare_data(
+    session: Session, user_id: int, features: list[str]
+) -> tuple[pd.DataFrame, list[int]]:
+    """Build the input of a model: the user combined with all the locations.
+
+    :param session:
+        Session with the connection to the database.
+    :param user_id:
+        ID of the user.
+    :param features:
+        Features required by the model, in order.
+
+    :return:
+        A DataFrame with a record for each location and the list of location ids.
+    """
+    user = crud.read_user(session, user_id, features)
+    locs = cache.read_locations(session, features)
+
+    locs_id = locs["location_id"].tolist()
+
+    # fields of the locations take precedence over the ones of the user
+    df = locs.assign(**{k: v for k, v in user.items() if k not in locs.columns})
+
+    return df.reindex(columns=features), locs_id
+
 
 class InferenceTask(Task):
     """Abstraction of Celery's Task class."""
@@ -47,26 +89,33 @@ def inference(self: InferenceTask, user_id: int) -> None:
         if self.model is None or self.path != db_model.path:
             LOGGER.info(f"Reloading model from path {db_model.path}")
             self.path = db_model.path
-            self.model = Model(self.path)
+            self.model = Model(self.path, student_tolerance=STUDENT_TOLERANCE)
 
         # get data to process
-        user = crud.get_user(session, user_id)
-        locs = crud.get_locations(session)
-
-        locs_id = [loc.location_id for loc in locs]
-
-        df = pd.DataFrame(
-            [user.__dict__ | loc.__dict__ for loc in locs],
-            columns=self.model.metadata["features"],
-        )
+        df, locs_id = prepare_data(session, user_id, self.model.metadata["features"])
 
         # apply model to data
         score = self.model(df.values)
 
-        df["score"] = score
-        df["user_id"] = user_id
-        df["location_id"] = locs_id
-        df["task_id"] = str(self.request.id)
+        inference_id = crud.get_inference(session, str(self.request.id)).inference_id
 
-        # save task id, user_id, and scores to database
-        crud.create_results(session, df)
+        # save inference id, user_id, and scores to database
+        if RESULTS_STORAGE == "packed":
+            crud.create_result_scores(
+                session, inference_id, user_id, np.array(locs_id), score
+            )
+
+        else:
+            df["score"] = score
+            df["user_id"] = user_id
+            df["location_id"] = locs_id
+            df["inference_id"] = inference_id
+
+            crud.create_results(session, df)
+
+    # candidate models work on a different queue, out of the user's critical path
+    if SHADOW_SAMPLE_RATE > 0 and random.random() < SHADOW_SAMPLE_RATE:
+        worker.send_task(
+            "mlprod.worker.tasks.shadow.shadow_inference",
+            args=(str(self.request.id), user_id),
+        )
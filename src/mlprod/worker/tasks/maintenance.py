@@ -0,0 +1,83 @@
+from mlprod.database import crud, partitions, DataBase
+from mlprod.database.events import EVENTS_TTL_DAYS
+from mlprod.database.partitions import (
+    RESULTS_ARCHIVE,
+    RESULTS_ARCHIVE_DIR,
+    RESULTS_RETENTION_DAYS,
+)
+from mlprod.worker.celery import worker
+
+from celery import Task
+from datetime import datetime, timedelta
+from typing import Any
+
+import logging
+
+LOGGER = logging.getLogger("mlprod.worker.tasks.maintenance")
+
+
+class MaintenanceTask(Task):
+    """Abstraction of Celery's Task class."""
+
+    abstract = True
+
+    def __init__(self) -> None:
+        """Initialize the MaintenanceTask."""
+        super().__init__()
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the run method of the task."""
+        return self.run(*args, **kwargs)
+
+
+@worker.task(
+    ignore_result=True,
+    bind=True,
+    base=MaintenanceTask,
+)
+def purge_events(self: MaintenanceTask) -> int:
+    """Delete the raw events older than their retention time.
+
+    :return:
+        The number of deleted events.
+    """
+    if EVENTS_TTL_DAYS <= 0:
+        return 0
+
+    with DataBase().session() as session:
+        n = crud.delete_events_before(
+            session, datetime.now() - timedelta(days=EVENTS_TTL_DAYS)
+        )
+
+    LOGGER.info(f"maintenance: deleted {n} events older than {EVENTS_TTL_DAYS} days")
+
+    return n
+
+
+@worker.task(
+    ignore_result=True,
+    bind=True,
+    base=MaintenanceTask,
+)
+def partition_maintenance(self: MaintenanceTask) -> int:
+    """Create the next partitions and apply the retention to the results.
+
+    :return:
+        The number of deleted results.
+    """
+    n = 0
+
+    with DataBase().session() as session:
+        partitions.ensure_partitions(session)
+
+        if RESULTS_RETENTION_DAYS > 0:
+            n = partitions.archive_results(
+                session,
+                timedelta(days=RESULTS_RETENTION_DAYS),
+                RESULTS_ARCHIVE_DIR if RESULTS_ARCHIVE else None,
+            )
+            LOGGER.info(f"maintenance: deleted {n} results never shown")
+
+        partitions.drop_empty_partitions(session)
+
+    return n
@@ -0,0 +1,289 @@
+from mlprod.database import crud, DataBase
+from mlprod.database.locks import advisory_lock, LOCK_TRAINING
+from mlprod.worker.celery import worker
+from mlprod.worker.models import Model, evaluate, update_model_online
+from mlprod.worker.models.pipeline import (
+    FILE_METADATA,
+    FILE_MMS,
+    FILE_SKB,
+    FILE_MODEL,
+)
+
+from celery import Task
+from datetime import datetime, timedelta
+from pathlib import Path
+from sqlalchemy.orm import Session
+from typing import Any
+
+import torch
+
+import os
+import json
+import logging
+import shutil
+import numpy as np
+
+LOGGER = logging.getLogger("mlprod.worker.tasks.online")
+
+DEFAULT_MODEL_DIR = Path(".") / "models"
+FILE_STATE = DEFAULT_MODEL_DIR / "online.json"
+
+# minimum number of new labelled records required for an update
+ONLINE_MIN_RECORDS = int(os.environ.get("ONLINE_MIN_RECORDS", "50"))
+# maximum number of new labelled records consumed by a single update
+ONLINE_MAX_RECORDS = int(os.environ.get("ONLINE_MAX_RECORDS", "5000"))
+# results of inferences younger than this (in seconds) can still receive a label
+ONLINE_LABEL_DELAY = int(os.environ.get("ONLINE_LABEL_DELAY", "600"))
+ONLINE_BATCH_SIZE = int(os.environ.get("ONLINE_BATCH_SIZE", "16"))
+ONLINE_LEARNING_RATE = float(os.environ.get("ONLINE_LEARNING_RATE", "0.01"))
+ONLINE_EPOCHS = int(os.environ.get("ONLINE_EPOCHS", "1"))
+# fraction of the newest labelled records held out to validate an update
+ONLINE_HOLDOUT_FRACTION = float(os.environ.get("ONLINE_HOLDOUT_FRACTION", "0.2"))
+# maximum drop in ROC AUC accepted for an update
+ONLINE_TOLERANCE = float(os.environ.get("ONLINE_TOLERANCE", "0.01"))
+
+
+class OnlineTask(Task):
+    """Abstraction of Celery's Task class."""
+
+    abstract = True
+
+    def __init__(self) -> None:
+        """Initialize the OnlineTask."""
+        super().__init__()
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the run method of the task."""
+        return self.run(*args, **kwargs)
+
+
+def _load_state(session: Session, model_id: str) -> dict[str, Any]:
+    """Read the state of the online updates for the given active model.
+
+    When the active model is not the last published by the online updates (i.e. a new
+    model has been trained), the state restarts from the active model and its dataset.
+    """
+    if FILE_STATE.exists():
+        with open(FILE_STATE, "r") as f:
+            state: dict[str, Any] = json.load(f)
+
+        if state["model_id"] == model_id:
+            return state
+
+    watermark = crud.get_model_watermark(session, model_id)
+    if watermark is None:
+        watermark = crud.get_dataset_watermark(session)
+
+    LOGGER.info(f"online: starting from model {model_id} with watermark {watermark}")
+
+    return {
+        "model_id": model_id,
+        "base_id": model_id,
+        "version": 0,
+        "watermark": watermark,
+        "rollbacks": 0,
+    }
+
+
+def _save_state(state: dict[str, Any]) -> None:
+    """Write the state of the online updates."""
+    tmp = FILE_STATE.with_name(FILE_STATE.name + ".tmp")
+    with open(tmp, "w+") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp, FILE_STATE)
+
+
+# metrics stored for the published models (same as declared in tables script)
+METRICS_LIST = ["acc", "pre", "rec", "f1", "auc"]
+
+
+def _auc(y_trues: np.ndarray, y_preds: np.ndarray) -> float | None:
+    """ROC AUC, or None if it is not defined."""
+    try:
+        return evaluate(y_trues, y_preds, ["auc"])["auc"]
+    except ValueError:
+        return None
+
+
+def _predict(network: torch.nn.Module, X: np.ndarray) -> np.ndarray:
+    """Scores of a network on records already transformed by the pipeline."""
+    with torch.no_grad():
+        y: np.ndarray = network(torch.FloatTensor(X)).numpy()
+    return y
+
+
+def _metrics(y_trues: np.ndarray, y_preds: np.ndarray) -> dict[str, float]:
+    """Metrics of a model, without the ROC AUC if only one class is present."""
+    if len(np.unique(y_trues)) > 1:
+        return evaluate(y_trues, y_preds, METRICS_LIST)
+
+    return evaluate(y_trues, y_preds, [m for m in METRICS_LIST if m != "auc"])
+
+
+def _publish(
+    parent: Model, network: torch.nn.Module, path: Path, metadata: dict[str, Any]
+) -> None:
+    """Save an updated network in a new model folder, next to the parent's artifacts."""
+    os.makedirs(path)
+
+    shutil.copy2(parent.path_mms, path / FILE_MMS)
+    shutil.copy2(parent.path_skb, path / FILE_SKB)
+
+    torch.save(network.state_dict(), path / FILE_MODEL)
+
+    # the student of the parent does not describe the updated network
+    metadata = {k: v for k, v in parent.metadata.items() if k != "student"} | metadata
+
+    with open(path / FILE_METADATA, "w+") as f:
+        json.dump(metadata, f, indent=4)
+
+
+@worker.task(
+    ignore_result=True,
+    bind=True,
+    base=OnlineTask,
+)
+def online_update(self: OnlineTask) -> None:
+    """Update the active model with the labels received since the last update.
+
+    A copy of the active network is updated with a few SGD steps on the new labels, then
+    validated against the newest of them, held out from the update: these records are
+    also newer than the data used to train the active model. If the ROC AUC drops more
+    than the tolerance, or it cannot be measured, the update is discarded. Otherwise, it
+    is published as a new versioned model and becomes the active one.
+
+    If the active model is an online update that performs worse than the model it
+    started from, the latter is activated again.
+    """
+    with DataBase().session() as session:
+        with advisory_lock(session, LOCK_TRAINING) as acquired:
+            if not acquired:
+                LOGGER.info("online: another training is running, update skipped")
+                return
+
+            db_model = crud.get_active_model(session)
+            state = _load_state(session, db_model.task_id)
+
+            df = crud.get_labelled_since(
+                session,
+                state["watermark"],
+                ONLINE_MAX_RECORDS,
+                timedelta(seconds=ONLINE_LABEL_DELAY),
+            )
+
+            if df.shape[0] < ONLINE_MIN_RECORDS:
+                LOGGER.info(f"online: only {df.shape[0]} new labels, update skipped")
+                return
+
+            # the newest records are held out, they are used by the next update
+            n_hold = int(df.shape[0] * ONLINE_HOLDOUT_FRACTION)
+            df_train, df_hold = df[: df.shape[0] - n_hold], df[df.shape[0] - n_hold :]
+
+            if n_hold == 0 or df_train.shape[0] == 0:
+                LOGGER.info("online: not enough labels to hold out, update skipped")
+                return
+
+            parent = Model(db_model.path)
+            features = parent.metadata["features"]
+
+            X = parent.transform(df_train[features].values)
+            Y = df_train["label"].values.reshape(-1, 1)  # type: ignore
+
+            network, metrics = update_model_online(
+                parent.model,
+                X,
+                Y,
+                batch_size=ONLINE_BATCH_SIZE,
+                learning_rate=ONLINE_LEARNING_RATE,
+                epochs=ONLINE_EPOCHS,
+            )
+
+            # labels consumed, whatever the outcome of the update
+            state["watermark"] = int(df_train["result_id"].max())
+
+            # guardrail: validate on the held out records, never seen by the models
+            X_hold = df_hold[features].values
+            Y_hold = df_hold["label"].values.reshape(-1, 1)  # type: ignore
+
+            y_preds = _predict(network, parent.transform(X_hold))
+
+            auc_parent = _auc(Y_hold, parent(X_hold))
+            auc_new = _auc(Y_hold, y_preds)
+
+            if auc_parent is not None and state["base_id"] != db_model.task_id:
+                base = Model(crud.get_model(session, state["base_id"]).path)
+                auc_base = _auc(Y_hold, base(X_hold))
+
+                if auc_base is not None and auc_parent < auc_base - ONLINE_TOLERANCE:
+                    LOGGER.warning(
+                        f"online: version {state['version']} has ROC AUC "
+                        f"{auc_parent:.4} worse than base model ({auc_base:.4}), "
+                        "rollback to base model"
+                    )
+                    crud.set_active_model(session, state["base_id"])
+
+                    state["model_id"] = state["base_id"]
+                    state["rollbacks"] += 1
+                    _save_state(state)
+                    return
+
+            if auc_parent is None or auc_new is None:
+                LOGGER.warning(
+                    "online: holdout with a single class, update cannot be validated "
+                    "and is discarded"
+                )
+                _save_state(state)
+                return
+
+            if auc_new < auc_parent - ONLINE_TOLERANCE:
+                LOGGER.warning(
+                    f"online: update has ROC AUC {auc_new:.4} worse than active model "
+                    f"({auc_parent:.4}), update discarded"
+                )
+                state["rollbacks"] += 1
+                _save_state(state)
+                return
+
+            # publish the new version
+            task_id = str(self.request.id)
+            version = state["version"] + 1
+
+            folder_name = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
+            path = DEFAULT_MODEL_DIR / f"model.{folder_name}.online.{version}"
+
+            _publish(
+                parent,
+                network,
+                path,
+                {
+                    "online": {
+                        "version": version,
+                        "parent": db_model.task_id,
+                        "base": state["base_id"],
+                        "watermark": state["watermark"],
+                        "n_updates": df_train.shape[0],
+                        "n_holdout": df_hold.shape[0],
+                        "loss": metrics["loss"],
+                        "holdout_auc": auc_new,
+                    }
+                },
+            )
+
+            crud.create_model(session, task_id, "SUCCESS", path)
+            crud.update_model(
+                session,
+                task_id,
+                metrics={
+                    "train": _metrics(Y, _predict(network, X)),
+                    "test": _metrics(Y_hold, y_preds),
+                },
+            )
+            crud.set_active_model(session, task_id)
+
+            LOGGER.info(
+                f"online: published version {version} as model {task_id} to {path}"
+            )
+
+            state["model_id"] = task_id
+            state["version"] = version
+            _save_state(state)
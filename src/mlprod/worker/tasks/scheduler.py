@@ -0,0 +1,121 @@
+from mlprod.database import crud, events, DataBase
+from mlprod.worker.celery import worker
+from mlprod.worker.tasks.train import training
+
+from celery import Task
+from datetime import timedelta
+from typing import Any
+from uuid import uuid4
+
+import os
+import logging
+
+LOGGER = logging.getLogger("mlprod.worker.tasks.scheduler")
+
+# number of new labelled results that triggers a training
+RETRAIN_MIN_LABELS = int(os.environ.get("RETRAIN_MIN_LABELS", "1000"))
+# change in the rate of positive labels that triggers a training, 0 to disable
+RETRAIN_DRIFT = float(os.environ.get("RETRAIN_DRIFT", "0.05"))
+# minimum number of new labelled results required to measure the drift
+RETRAIN_DRIFT_MIN_LABELS = int(os.environ.get("RETRAIN_DRIFT_MIN_LABELS", "200"))
+# trainings scheduled since more than this (in seconds) are considered lost
+RETRAIN_TIMEOUT = int(os.environ.get("RETRAIN_TIMEOUT", "3600"))
+
+
+class SchedulerTask(Task):
+    """Abstraction of Celery's Task class."""
+
+    abstract = True
+
+    def __init__(self) -> None:
+        """Initialize the SchedulerTask."""
+        super().__init__()
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the run method of the task."""
+        return self.run(*args, **kwargs)
+
+
+def label_drift(
+    count: int, positives: int, ref_count: int, ref_positives: int
+) -> float:
+    """Absolute change in the rate of positive labels against a reference.
+
+    :return:
+        The drift, or 0 if there are not enough records to measure it.
+    """
+    if count < RETRAIN_DRIFT_MIN_LABELS or ref_count == 0:
+        return 0.0
+
+    return abs(positives / count - ref_positives / ref_count)
+
+
+@worker.task(
+    ignore_result=True,
+    bind=True,
+    base=SchedulerTask,
+)
+def retraining_check(self: SchedulerTask) -> str | None:
+    """Start a training when enough new labels are available or their data drifted.
+
+    New labels are counted from the dataset of the newest trained model, even if it has
+    not been promoted: its data are not used for another training. The drift is the
+    change in the rate of positive labels between the new results and that dataset.
+    No training is started while another is scheduled or running.
+
+    :return:
+        The id of the training task, if one was started.
+    """
+    with DataBase().session() as session:
+        in_progress = crud.count_models_in_progress(
+            session, timedelta(seconds=RETRAIN_TIMEOUT)
+        )
+
+        if in_progress > 0:
+            LOGGER.info("scheduler: a training is already in progress")
+            return None
+
+        # models published by online updates, and the baseline, have no dataset
+        db_model = crud.get_last_trained_model(session)
+
+        if db_model is None:
+            watermark = 0
+            ref_count, ref_positives = 0, 0
+        else:
+            watermark = crud.get_model_watermark(session, db_model.task_id) or 0
+            ref_count, ref_positives = crud.count_dataset_labels(
+                session, db_model.task_id
+            )
+
+        count, positives = crud.count_labelled_since(session, watermark)
+
+        drift = label_drift(count, positives, ref_count, ref_positives)
+
+        LOGGER.info(
+            f"scheduler: {count} new labelled results since {watermark}, "
+            f"drift {drift:.4}"
+        )
+
+        if count >= RETRAIN_MIN_LABELS:
+            reason = "new labels"
+        elif RETRAIN_DRIFT > 0 and drift >= RETRAIN_DRIFT:
+            reason = "drift"
+        else:
+            return None
+
+        events.record_event(session, "training")
+
+        # the model is stored before the task is sent, so the worker always finds it
+        task_id = str(uuid4())
+        crud.create_model(session, task_id, "PENDING")
+
+        try:
+            training.apply_async(task_id=task_id)
+        except Exception as e:
+            LOGGER.error(f"scheduler: training {task_id} could not be scheduled: {e}")
+            crud.update_model(session, task_id, "FAILED")
+            return None
+
+        LOGGER.info(f"scheduler: training {task_id} started by {reason}")
+
+        return task_id
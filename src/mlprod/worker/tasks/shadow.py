@@ -0,0 +1,152 @@
+from celery import Task
+from pathlib import Path
+from typing import Any
+
+from mlprod.database import DataBase, crud
+from mlprod.worker.celery import worker
+from mlprod.worker.models import Model
+from mlprod.worker.tasks.inference import prepare_data
+
+import numpy as np
+import logging
+import os
+
+
+LOGGER = logging.getLogger("mlprod.worker.tasks.shadow")
+
+# number of locations, ranked by the active model, that are stored for the candidate
+SHADOW_TOP_K = int(os.environ.get("SHADOW_TOP_K", "10"))
+
+
+class ShadowTask(Task):
+    """Abstraction of Celery's Task class."""
+
+    abstract = True
+
+    def __init__(self) -> None:
+        """Initialize the ShadowTask."""
+        super().__init__()
+
+        self.model: Model | None = None
+        self.path: Path | None = None
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        """Call the run method of the task."""
+        return self.run(*args, **kwargs)
+
+
+def _ranks(x: np.ndarray) -> np.ndarray:
+    """Position of each value in the ascending order."""
+    ranks = np.empty(x.shape[0])
+    ranks[np.argsort(x, kind="mergesort")] = np.arange(x.shape[0])
+    return ranks
+
+
+def agreement(
+    scores_active: np.ndarray, scores_shadow: np.ndarray, top_k: int
+) -> dict[str, float]:
+    """Measures how much the scores of two models agree on the same locations.
+
+    :param scores_active:
+        Scores of the active model.
+    :param scores_shadow:
+        Scores of the candidate model, in the same order.
+    :param top_k:
+        Number of top ranked locations to compare.
+
+    :return:
+        A dictionary with the share of locations in common in the top positions, the
+        Spearman's rank correlation, and the mean absolute difference of the scores.
+    """
+    top_k = min(top_k, scores_active.shape[0])
+
+    top_active = np.argsort(-scores_active, kind="mergesort")[:top_k]
+    top_shadow = np.argsort(-scores_shadow, kind="mergesort")[:top_k]
+
+    overlap = np.intersect1d(top_active, top_shadow).shape[0] / max(top_k, 1)
+
+    corr = np.corrcoef(_ranks(scores_active), _ranks(scores_shadow))[0, 1]
+
+    return {
+        "top_k": top_k,
+        "top_k_overlap": float(overlap),
+        "rank_correlation": float(np.nan_to_num(corr)),
+        "score_mae": float(np.abs(scores_active - scores_shadow).mean()),
+    }
+
+
+@worker.task(
+    ignore_result=True,
+    bind=True,
+    base=ShadowTask,
+)
+def shadow_inference(self: ShadowTask, task_id: str, user_id: int) -> None:
+    """Score an already completed inference with the candidate model.
+
+    The results of the active model are not changed: the candidate scores are only
+    stored for comparison.
+
+    :param task_id:
+        ID of the inference task completed by the active model.
+    :param user_id:
+        ID of the user of the inference.
+    """
+    with DataBase().session() as session:
+        db_model = crud.get_candidate_model(session)
+
+        if db_model is None:
+            LOGGER.debug("No candidate model available for shadow inference")
+            return
+
+        if self.model is None or self.path != db_model.path:
+            LOGGER.info(f"Reloading shadow model from path {db_model.path}")
+            self.path = db_model.path
+            self.model = Model(self.path)
+
+        df, locs_id = prepare_data(session, user_id, self.model.metadata["features"])
+
+        scores_shadow = self.model(df.values).reshape(-1)
+
+        # scores of the active model, aligned to the locations of the candidate
+        locs_active, scores_active = crud.get_task_scores(session, task_id)
+
+        if locs_active.shape[0] == 0:
+            LOGGER.warning(f"No results found for inference {task_id}")
+            return
+
+        # locations changed in the catalog after the inference are not compared
+        position = {loc: i for i, loc in enumerate(locs_id)}
+        known = np.array([loc in position for loc in locs_active], dtype=bool)
+
+        if not known.all():
+            LOGGER.warning(
+                f"{(~known).sum()} locations of inference {task_id} are not in the "
+                "catalog anymore, skipped"
+            )
+            locs_active, scores_active = locs_active[known], scores_active[known]
+
+            if locs_active.shape[0] == 0:
+                return
+
+        idx = np.array([position[loc] for loc in locs_active])
+        scores_shadow = scores_shadow[idx]
+
+        values = agreement(scores_active, scores_shadow, SHADOW_TOP_K)
+
+        # only locations in the top positions of the active model can be labelled
+        top = np.argsort(-scores_active, kind="mergesort")[: values["top_k"]]
+
+        crud.create_shadow_results(
+            session,
+            task_id,
+            db_model.task_id,
+            values,
+            locs_active[top],
+            scores_shadow[top],
+        )
+
+        LOGGER.info(
+            f"Shadow inference {task_id} with model {db_model.task_id}: "
+            f"top-{values['top_k']} overlap={values['top_k_overlap']:.2} "
+            f"rank correlation={values['rank_correlation']:.2}"
+        )
@@ -1,10 +1,23 @@
-from mlprod.database import crud, DataBase
+from mlprod.database import cache, crud, snapshot, DataBase
+from mlprod.database.locks import advisory_lock, LOCK_TRAINING
 from mlprod.worker.celery import worker
-from mlprod.worker.models import Model, train_model, evaluate
+from mlprod.worker.models import (
+    Model,
+    train_model,
+    train_model_distributed,
+    train_model_streaming,
+    evaluate,
+    bootstrap,
+    confidence_interval,
+    run_sweep,
+    distill_model,
+)
 
 from celery import Task
 from datetime import datetime
 from pathlib import Path
+from sqlalchemy.orm import Session
+from typing import Any
 
 import os
 import logging
@@ -13,6 +26,41 @@ import pandas as pd
 LOGGER = logging.getLogger("mlprod.worker.tasks.training")
 
 DEFAULT_MODEL_DIR = Path(".") / "models"
+DEFAULT_DATASET_DIR = DEFAULT_MODEL_DIR / "datasets"
+
+# minimum gain in ROC AUC, at the lower bound of the confidence interval, to promote
+MIN_AUC_GAIN = float(os.environ.get("TRAINING_MIN_AUC_GAIN", "0.0"))
+# number of bootstrap resamples used to estimate the confidence interval
+BOOTSTRAP_RESAMPLES = int(os.environ.get("TRAINING_BOOTSTRAP_RESAMPLES", "1000"))
+# significance level of the confidence interval
+BOOTSTRAP_ALPHA = float(os.environ.get("TRAINING_BOOTSTRAP_ALPHA", "0.05"))
+# number of records read at once in streaming mode
+CHUNK_SIZE = int(os.environ.get("TRAINING_CHUNK_SIZE", "10000"))
+# number of users combined with all the locations to distil a student model
+DISTILL_USERS = int(os.environ.get("TRAINING_DISTILL_USERS", "50"))
+# fraction of the training split used to choose the best trial of a sweep
+SWEEP_VALID_FRACTION = float(os.environ.get("TRAINING_SWEEP_VALID_FRACTION", "0.2"))
+
+
+def catalog_dataset(
+    session: Session, features: list[str], n_users: int
+) -> pd.DataFrame:
+    """Build the combinations of some users with all the locations of the catalog.
+
+    :param session:
+        Session with the connection to the database.
+    :param features:
+        Features required by the model, in order.
+    :param n_users:
+        Number of users, chosen at random.
+    """
+    users = crud.read_sample_users(session, n_users, features)
+    locs = cache.read_locations(session, features)
+
+    # fields of the locations take precedence over the ones of the user
+    users = users.drop(columns=[c for c in users.columns if c in locs.columns])
+
+    return users.merge(locs, how="cross").reindex(columns=features)
 
 
 class TrainingTask(Task):
@@ -34,12 +82,51 @@ class TrainingTask(Task):
     bind=True,
     base=TrainingTask,
 )
-def training(self: TrainingTask):
-    """Execute model training."""
-    with DataBase().session() as session:
+def training(
+    self: TrainingTask,
+    sweep: bool = False,
+    grid: dict[str, list[Any]] | None = None,
+    world_size: int = 1,
+    streaming: bool = False,
+    distill: bool = False,
+    student_hidden: int = 8,
+):
+    """Execute model training.
+
+    :param sweep:
+        If True, train multiple configurations in parallel and keep only the best one.
+    :param grid:
+        Parameters to test during a sweep (default: None, which means the default grid).
+    :param world_size:
+        Number of processes for data-parallel training (default: 1, no parallelism).
+        Cannot be used together with a sweep.
+    :param streaming:
+        If True, the training data are read in chunks instead of being loaded in
+        memory. Cannot be used together with a sweep or data-parallel training.
+    :param distill:
+        If True, also train a compact student model on the scores of the new model over
+        the location catalog. The inference worker can serve it instead of the full model.
+    :param student_hidden:
+        Number of hidden units of the student model, 0 for a linear model (default: 8).
+    """
+    # the task_id will also be the model id
+    task_id = str(self.request.id)
+
+    with (
+        DataBase().session() as session,
+        advisory_lock(session, LOCK_TRAINING) as acquired,
+    ):
+        if not acquired:
+            LOGGER.warning(f"Training {task_id} skipped, another training is running")
+            crud.update_model(session, task_id, "SKIPPED")
+            return
+
         try:
-            # the task_id will also be the model id
-            task_id = str(self.request.id)
+            # parameters are checked by the API, tasks can also be sent by other clients
+            if sum([sweep, world_size > 1, streaming]) > 1:
+                raise ValueError(
+                    "Sweep, data-parallel, and streaming training cannot be used together!"
+                )
 
             # folder to store models need to be created before saving
             folder_name = datetime.now().strftime("%Y-%m-%d.%H-%M-%S")
@@ -63,18 +150,66 @@ def training(self: TrainingTask):
 
             cols = features + ["label"]
 
-            # create dataset
-            df: pd.DataFrame = crud.create_dataset(session, task_id, tr_size + ts_size)[
-                cols
-            ]
-
-            df_train = df[:tr_size]
-            df_test = df[tr_size:]
-
             # list of metrics to check (same as declared in tables script)
             metrics_list = ["acc", "pre", "rec", "f1", "auc"]
 
-            metrics_tr = train_model(df_train, path=path, metrics_list=metrics_list)
+            if streaming:
+                # only the test dataset is loaded in memory
+                watermark = crud.get_dataset_watermark(session)
+
+                chunks = snapshot.stream_dataset(
+                    session, watermark, tr_size, cols, DEFAULT_DATASET_DIR, CHUNK_SIZE
+                )
+                df_test = pd.concat(
+                    snapshot.stream_dataset(
+                        session,
+                        watermark,
+                        ts_size,
+                        cols,
+                        DEFAULT_DATASET_DIR,
+                        CHUNK_SIZE,
+                        offset=tr_size,
+                    )()
+                )
+
+                crud.register_dataset_query(
+                    session, task_id, tr_size + ts_size, watermark
+                )
+
+            else:
+                # create dataset, re-using the snapshot on disk if the data did not change
+                df: pd.DataFrame = snapshot.load_dataset(
+                    session, task_id, tr_size + ts_size, cols, DEFAULT_DATASET_DIR
+                )
+
+                df_train = df[:tr_size]
+                df_test = df[tr_size:]
+
+            if streaming:
+                metrics_tr = train_model_streaming(
+                    chunks, path=path, metrics_list=metrics_list
+                )
+            elif sweep:
+                # the test split is kept for the comparison with the active model:
+                # choosing the trial on it would bias the comparison toward the winner
+                n_valid = max(1, int(len(df_train) * SWEEP_VALID_FRACTION))
+                sweep_results = run_sweep(
+                    df_train[:-n_valid],
+                    df_train[-n_valid:],
+                    path,
+                    grid=grid,
+                    metrics_list=metrics_list,
+                )
+                metrics_tr = sweep_results["best"]["train"]
+            elif world_size > 1:
+                metrics_tr = train_model_distributed(
+                    df_train,
+                    path=path,
+                    world_size=world_size,
+                    metrics_list=metrics_list,
+                )
+            else:
+                metrics_tr = train_model(df_train, path=path, metrics_list=metrics_list)
 
             # reload new trained model
             model_new = Model(path)
@@ -89,18 +224,31 @@ def training(self: TrainingTask):
             model_old_metrics_ts = evaluate(Y, y_preds_old, metrics_list)
             model_new_metrics_ts = evaluate(Y, y_preds_new, metrics_list)
 
-            acc_new = model_old_metrics_ts["auc"]
-            acc_old = model_new_metrics_ts["auc"]
+            # paired bootstrap: same resamples for both models
+            boot_old = bootstrap(
+                Y, y_preds_old, ["auc"], n_resamples=BOOTSTRAP_RESAMPLES
+            )
+            boot_new = bootstrap(
+                Y, y_preds_new, ["auc"], n_resamples=BOOTSTRAP_RESAMPLES
+            )
+
+            auc_old = model_old_metrics_ts["auc"]
+            auc_new = model_new_metrics_ts["auc"]
+            gain_low, gain_high = confidence_interval(
+                boot_new["auc"] - boot_old["auc"], alpha=BOOTSTRAP_ALPHA
+            )
 
-            # check if the new model is better than the old one
-            if acc_new > acc_old:
+            # the new model is better only if the gain is not due to noise
+            if gain_low > MIN_AUC_GAIN:
                 LOGGER.info(
-                    f"Training {task_id} has better ROC AUC ({acc_new:.4}) than old model ({acc_old:.4})"
+                    f"Training {task_id} has better ROC AUC ({auc_new:.4}) than old model ({auc_old:.4}), "
+                    f"gain CI [{gain_low:.4}, {gain_high:.4}]"
                 )
                 use_percentage = 1.0
             else:
                 LOGGER.info(
-                    f"Training {task_id} has worst ROC AUC ({acc_new:.4}) than old model ({acc_old:.4})"
+                    f"Training {task_id} has no significant gain in ROC AUC ({auc_new:.4}) over old model ({auc_old:.4}), "
+                    f"gain CI [{gain_low:.4}, {gain_high:.4}]"
                 )
                 use_percentage = 0.0
 
@@ -110,6 +258,13 @@ def training(self: TrainingTask):
                 "test": model_new_metrics_ts,
             }
 
+            if distill:
+                X_catalog = catalog_dataset(session, features, DISTILL_USERS).values
+
+                model_new_metrics["student"] = distill_model(
+                    model_new, X_catalog, X, Y, hidden_size=student_hidden
+                )
+
             crud.update_model(
                 session,
                 task_id,
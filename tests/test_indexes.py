@@ -0,0 +1,145 @@
+"""The hot queries on the results use the indexes of the schema.
+
+The queries are captured while the functions of `crud` run, then explained. The tests
+run on SQLite in memory, and on PostgreSQL when TEST_DATABASE_URL is set: the database
+is emptied by the tests.
+"""
+
+from sqlalchemy import Connection, Engine, create_engine, event, text
+from sqlalchemy.orm import Session
+from typing import Any, Callable, Generator
+
+from mlprod.database import crud
+from mlprod.database.partitions import ensure_partitions
+from mlprod.database.tables import Base
+
+import os
+import pytest
+
+# PostgreSQL database used by the tests, they are skipped on it if not set
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "")
+
+# (hot query, index used, also checked on SQLite)
+HOT_QUERIES: list[tuple[Callable[[Session], Any], str, bool]] = [
+    # results shown to the user, ordered by score
+    (
+        lambda db: crud.get_results_locations(db, "task"),
+        "ix_results_inference_id_score",
+        True,
+    ),
+    # label of a result clicked by the user
+    (
+        lambda db: crud.update_result_label(db, "task", 1),
+        "ix_results_inference_id_location_id",
+        True,
+    ),
+    # last result of the datasets, on SQLite the result_id is the rowid
+    (
+        lambda db: crud.get_dataset_watermark(db),
+        "ix_results_shown_result_id",
+        False,
+    ),
+    # newest results of a dataset, on SQLite the result_id is the rowid
+    (
+        lambda db: crud.get_label_stamp(db, 1000, 100),
+        "ix_results_shown_result_id",
+        False,
+    ),
+]
+
+
+@pytest.fixture(
+    params=[
+        "sqlite://",
+        pytest.param(
+            TEST_DATABASE_URL,
+            marks=pytest.mark.skipif(
+                not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set"
+            ),
+        ),
+    ],
+    ids=["sqlite", "postgresql"],
+)
+def engine(request: pytest.FixtureRequest) -> Generator[Engine, None, None]:
+    """Engine of an empty database with the latest schema."""
+    engine = create_engine(request.param)
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    with Session(engine) as db:
+        ensure_partitions(db)
+
+    yield engine
+
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def _capture(engine: Engine, query: Callable[[Session], Any]) -> list[tuple[str, Any]]:
+    """Statements on the results executed by the given query, with their parameters."""
+    statements: list[tuple[str, Any]] = []
+
+    def listener(
+        conn: Connection, cursor: Any, statement: str, parameters: Any, *args: Any
+    ) -> None:
+        if "results" in statement:
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        with Session(engine) as db:
+            query(db)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+
+    return statements
+
+
+def _plan(conn: Connection, statement: str, parameters: Any) -> str:
+    """Plan chosen by the database for a statement."""
+    if conn.dialect.name == "postgresql":
+        rows = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).all()
+        return "\n".join(r[0] for r in rows)
+
+    rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return "\n".join(r[3] for r in rows)
+
+
+def _index_names(conn: Connection, name: str) -> set[str]:
+    """Names of an index, and of its indexes on the partitions of the table."""
+    if conn.dialect.name != "postgresql":
+        return {name}
+
+    children = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:name AS regclass)"
+        ),
+        {"name": name},
+    ).scalars()
+
+    return {name, *children}
+
+
+@pytest.mark.parametrize("query, index, on_sqlite", HOT_QUERIES)
+def test_hot_query_uses_index(
+    engine: Engine, query: Callable[[Session], Any], index: str, on_sqlite: bool
+) -> None:
+    """The plans of the statements of a hot query contain the name of its index."""
+    if engine.dialect.name != "postgresql" and not on_sqlite:
+        pytest.skip("index not used on SQLite")
+
+    statements = _capture(engine, query)
+    assert statements
+
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            # tables of the tests are empty, a sequential scan would always be cheaper
+            conn.execute(text("SET enable_seqscan = off"))
+
+        plans = "\n".join(_plan(conn, s, p) for s, p in statements)
+        names = _index_names(conn, index)
+
+    assert any(name in plans for name in names), plans